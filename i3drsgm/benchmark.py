@@ -0,0 +1,376 @@
+"""
+This module is used for benchmarking performance of the i3drsgm module.
+End-to-end benchmarks use the sample_data images with the stand-in app
+(standin_app.py) so can be run without the licensed I3DRSGMApp.
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+import tempfile
+import argparse
+import numpy as np
+import cv2
+from i3drsgm import I3DRSGM, StereoSupport, DisparityProcessor
+from i3drsgm import StereoCalibration
+from i3drsgm.transport import TRANSPORTS, ImageTransport
+
+# Get folder containing current script
+SCRIPT_FOLDER = os.path.dirname(os.path.realpath(__file__))
+RESOURCE_FOLDER = os.path.join(
+    SCRIPT_FOLDER, os.path.normpath("../sample_data"))
+STANDIN_APP_CMD = [
+    sys.executable, os.path.join(SCRIPT_FOLDER, "standin_app.py"), "api"]
+
+
+def sample_Q():
+    """Q matrix matching the sample data calibration (sim_*.yaml)"""
+    return np.array([
+        [1.0, 0.0, 0.0, -1224.0],
+        [0.0, 1.0, 0.0, -1024.0],
+        [0.0, 0.0, 0.0, 3478.26],
+        [0.0, 0.0, 8.33, 0.0]])
+
+
+def sample_disparity(rows=2048, cols=2448, seed=0):
+    """Random I3DRSGM style (negative) disparity image"""
+    rng = np.random.RandomState(seed)
+    return -rng.uniform(1, 400, (rows, cols)).astype(np.float32)
+
+
+def time_func(func, repeat=5):
+    """Return best time in seconds of 'repeat' calls to func"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def reprojectImageTo3D_loop(disp, Q, downsample_rate=1.0):
+    """Original per-pixel reprojection (for comparison only)"""
+    downsample_factor = 1/downsample_rate
+    w = (disp * Q[3, 2]) + Q[3, 3]
+    z = Q[2, 3] / w
+    y = np.full_like(z, 1)
+    x = np.full_like(z, 1)
+    num_rows, num_cols = disp.shape
+    for i in range(0, num_rows):
+        for j in range(0, num_cols):
+            x[i, j] = ((j * downsample_factor) + Q[0, 3]) / w[i, j]
+            y[i, j] = ((i * downsample_factor) + Q[1, 3]) / w[i, j]
+    return np.dstack((x, y, z))
+
+
+def bench_reproject(rows, cols, repeat, loop_rows=64):
+    """Benchmark reprojectImageTo3D against the per-pixel loop"""
+    Q = sample_Q()
+    disp = -sample_disparity(rows, cols)
+    out = np.empty((rows, cols, 3), np.float32)
+
+    StereoSupport.clear_reprojection_cache()
+    cold = time_func(
+        lambda: (StereoSupport.clear_reprojection_cache(),
+                 StereoSupport.reprojectImageTo3D(disp, Q)), repeat)
+    warm = time_func(
+        lambda: StereoSupport.reprojectImageTo3D(disp, Q), repeat)
+    warm_out = time_func(
+        lambda: StereoSupport.reprojectImageTo3D(disp, Q, out=out), repeat)
+    # Per-pixel loop is too slow to run on a full frame so
+    # time a band of rows and scale to the full frame
+    loop_rows = min(loop_rows, rows)
+    loop = time_func(
+        lambda: reprojectImageTo3D_loop(disp[:loop_rows], Q), 1)
+    loop = loop * rows / loop_rows
+
+    print("reprojectImageTo3D {}x{}".format(cols, rows))
+    print("  per-pixel loop (est): {:10.2f} ms".format(loop * 1000))
+    print("  vectorised (cold):    {:10.2f} ms".format(cold * 1000))
+    print("  vectorised (cached):  {:10.2f} ms".format(warm * 1000))
+    print("  vectorised (out=):    {:10.2f} ms".format(warm_out * 1000))
+    print("  speedup (out=):       {:10.1f} x".format(loop / warm_out))
+
+
+def bench_postprocess(rows, cols, repeat):
+    """Benchmark fused disparity post-processing"""
+    Q = sample_Q()
+    disp = sample_disparity(rows, cols)
+    disp[::97, ::89] = -99999
+    processor = DisparityProcessor(Q)
+
+    depth = time_func(
+        lambda: StereoSupport.depth_from_disp(disp, Q), repeat)
+    colormap = time_func(
+        lambda: StereoSupport.colormap_from_disparity(disp, Q), repeat)
+    fused = time_func(
+        lambda: processor.process(disp, depth=True, colormap=True), repeat)
+
+    print("disparity post-processing {}x{}".format(cols, rows))
+    print("  depth_from_disp:         {:10.2f} ms".format(depth * 1000))
+    print("  colormap_from_disparity: {:10.2f} ms".format(colormap * 1000))
+    print("  DisparityProcessor:      {:10.2f} ms".format(fused * 1000))
+
+
+def bench_transport(rows, cols, repeat):
+    """Benchmark encode/decode cost of each image transport"""
+    rng = np.random.RandomState(0)
+    # Smooth image to give compression something realistic to work with
+    img = cv2.GaussianBlur(
+        rng.randint(0, 256, (rows, cols)).astype(np.uint8), (7, 7), 0)
+    disp = sample_disparity(rows, cols)
+
+    print("image transport {}x{}".format(cols, rows))
+    print("  {:6s} {:>12s} {:>12s} {:>12s}".format(
+        "", "write (ms)", "read (ms)", "size (MB)"))
+    with tempfile.TemporaryDirectory() as folder:
+        for name, transport in TRANSPORTS.items():
+            if name != transport.name:
+                # Skip aliases
+                continue
+            filepath = transport.image_filepath(folder, name, img)
+            write = time_func(
+                lambda: transport.write_image(folder, name, img), repeat)
+            read = time_func(lambda: cv2.imread(filepath, -1), repeat)
+            size = os.path.getsize(filepath) / 1e6
+            print("  {:6s} {:12.2f} {:12.2f} {:12.2f}".format(
+                name, write * 1000, read * 1000, size))
+
+        print("disparity read {}x{}".format(cols, rows))
+        for name, compression in [("lzw", 5), ("none", 1)]:
+            filepath = os.path.join(folder, "disparity_"+name+".tif")
+            cv2.imwrite(filepath, disp,
+                        [cv2.IMWRITE_TIFF_COMPRESSION, compression])
+            read = time_func(
+                lambda: ImageTransport.read_disparity(filepath), repeat)
+            print("  tiff ({:4s}) {:12.2f} ms".format(name, read * 1000))
+
+
+# Heavy modules that should not be imported by 'import i3drsgm'
+LAZY_IMPORTS = [
+    "cv2", "wget", "zipfile", "subprocess", "asyncio", "urllib.request"]
+if sys.version_info < (3, 7):
+    # Without module __getattr__ AsyncI3DRSGM is imported eagerly
+    LAZY_IMPORTS.remove("asyncio")
+
+
+def import_time(module="i3drsgm", repeat=5, exclude=("numpy",)):
+    """
+    Return best import time in seconds of module in a new interpreter
+    (excluding time spent importing required dependencies e.g. numpy)
+    and list of LAZY_IMPORTS that were imported with it
+    """
+    code = "import sys, {}; print(','.join(m for m in {!r} " \
+        "if m in sys.modules))".format(module, LAZY_IMPORTS)
+    if sys.version_info < (3, 7):
+        return _import_wall_time(module, repeat, exclude)
+    best = None
+    loaded = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+        loaded = [m for m in result.stdout.strip().split(",") if m]
+        # Lines are 'import time: self [us] | cumulative | name'
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            cumulative[fields[2].strip()] = int(fields[1])
+        elapsed = cumulative[module]
+        for name in exclude:
+            elapsed -= cumulative.get(name, 0)
+        elapsed /= 1e6
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, loaded
+
+
+def _import_wall_time(module, repeat, exclude):
+    """
+    import_time for python versions without '-X importtime'
+    (wall-clock time of import after importing excluded modules)
+    """
+    code = "import sys, time\n"
+    code += "".join("import {}\n".format(name) for name in exclude)
+    code += "start = time.perf_counter()\n"
+    code += "import {}\n".format(module)
+    code += "print(repr(time.perf_counter() - start))\n"
+    code += "print(','.join(m for m in {!r} if m in sys.modules))\n".format(
+        LAZY_IMPORTS)
+    best = None
+    loaded = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", code], stdout=subprocess.PIPE,
+            universal_newlines=True, check=True)
+        lines = result.stdout.splitlines()
+        elapsed = float(lines[0])
+        loaded = [m for m in lines[1].strip().split(",") if m]
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, loaded
+
+
+def bench_import(repeat):
+    """Benchmark time taken to import i3drsgm"""
+    elapsed, loaded = import_time("i3drsgm", repeat)
+    print("import i3drsgm (excluding numpy)")
+    print("  import time:   {:10.2f} ms".format(elapsed * 1000))
+    print("  heavy modules: {}".format(", ".join(loaded) or "none"))
+    return elapsed
+
+
+def load_sample_pair(scale=1.0):
+    """Load and rectify sample_data image pair
+    :return: (left, right, Q) scaled by 'scale'"""
+    stcal = StereoCalibration(
+        os.path.join(RESOURCE_FOLDER, "sim_left.yaml"),
+        os.path.join(RESOURCE_FOLDER, "sim_right.yaml"))
+    left = cv2.imread(
+        os.path.join(RESOURCE_FOLDER, "sim_left.png"), cv2.IMREAD_GRAYSCALE)
+    right = cv2.imread(
+        os.path.join(RESOURCE_FOLDER, "sim_right.png"), cv2.IMREAD_GRAYSCALE)
+    if scale != 1.0:
+        left = cv2.resize(left, None, fx=scale, fy=scale,
+                          interpolation=cv2.INTER_AREA)
+        right = cv2.resize(right, None, fx=scale, fy=scale,
+                           interpolation=cv2.INTER_AREA)
+    image_size = (left.shape[1], left.shape[0])
+    left, right = stcal.rectify_pair(left, right)
+    return left, right, stcal.q_for_size(image_size)
+
+
+class StageTimer:
+    """Record latency of named stages over several frames"""
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, stage, func, *args, **kwargs):
+        """Run func and record elapsed time under stage"""
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        self.stages.setdefault(stage, []).append(elapsed)
+        return result
+
+    def report(self):
+        """Get {stage: {mean_ms, min_ms, max_ms, fps}} for all stages"""
+        report = {}
+        for stage, times in self.stages.items():
+            mean = sum(times) / len(times)
+            report[stage] = {
+                "mean_ms": mean * 1000,
+                "min_ms": min(times) * 1000,
+                "max_ms": max(times) * 1000,
+                "fps": 1.0 / mean if mean > 0 else float("inf"),
+            }
+        return report
+
+
+def bench_pipeline(frames, scale, disparity_range, transport="png"):
+    """Benchmark end-to-end matching and post-processing per stage"""
+    timer = StageTimer()
+    left, right, Q = timer.time("load+rectify", load_sample_pair, scale)
+    i3drsgm = I3DRSGM(app_cmd=STANDIN_APP_CMD, transport=transport)
+    if not i3drsgm.isInit():
+        raise Exception("Failed to initalise stand-in app")
+    try:
+        i3drsgm.setDisparityRange(disparity_range)
+        api = i3drsgm.i3drsgmAppAPI
+        tmp_folder = api.tmp_folder
+        for _ in range(frames):
+            # forwardMatch split into stages
+            left_filepath = timer.time(
+                "match:imwrite", i3drsgm.transport.write_image,
+                tmp_folder, "left_tmp", left)
+            right_filepath = timer.time(
+                "match:imwrite", i3drsgm.transport.write_image,
+                tmp_folder, "right_tmp", right)
+            timer.time(
+                "match:ipc", api.forwardMatchFiles,
+                left_filepath, right_filepath)
+            timer.time(
+                "match:imread", i3drsgm.transport.read_disparity,
+                os.path.join(tmp_folder, "disparity.tif"))
+            # Full forwardMatch
+            valid, disp = timer.time(
+                "forwardMatch", i3drsgm.forwardMatch, left, right)
+            if not valid:
+                raise Exception("Failed to match sample images")
+            timer.time(
+                "reprojectImageTo3D", StereoSupport.reprojectImageTo3D,
+                disp, Q)
+            timer.time(
+                "depth_from_disp", StereoSupport.depth_from_disp,
+                disp, Q)
+            timer.time(
+                "colormap_from_disparity",
+                StereoSupport.colormap_from_disparity, disp, Q)
+    finally:
+        i3drsgm.close()
+
+    report = timer.report()
+    frame_stages = [
+        "forwardMatch", "depth_from_disp", "colormap_from_disparity"]
+    frame_ms = sum(report[stage]["mean_ms"] for stage in frame_stages)
+    report["frame"] = {
+        "mean_ms": frame_ms, "fps": 1000.0 / frame_ms,
+        "frames": frames, "width": left.shape[1], "height": left.shape[0],
+        "disparity_range": disparity_range, "transport": transport}
+
+    print("pipeline {}x{} disparity range {} ({} frames)".format(
+        left.shape[1], left.shape[0], disparity_range, frames))
+    print("  {:26s} {:>10s} {:>10s} {:>10s} {:>8s}".format(
+        "stage", "mean (ms)", "min (ms)", "max (ms)", "fps"))
+    for stage, stats in report.items():
+        if stage == "frame":
+            continue
+        print("  {:26s} {:10.2f} {:10.2f} {:10.2f} {:8.2f}".format(
+            stage, stats["mean_ms"], stats["min_ms"], stats["max_ms"],
+            stats["fps"]))
+    print("  {:26s} {:10.2f} {:>10s} {:>10s} {:8.2f}".format(
+        "frame (match+depth+color)", frame_ms, "", "",
+        report["frame"]["fps"]))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=2048)
+    parser.add_argument('--cols', type=int, default=2448)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--frames', type=int, default=3,
+                        help='frames to run through pipeline benchmark')
+    parser.add_argument('--scale', type=float, default=0.5,
+                        help='scale of sample images in pipeline benchmark')
+    parser.add_argument('--disparity-range', type=int, default=160)
+    parser.add_argument('--transport', default="png",
+                        choices=sorted(TRANSPORTS.keys()))
+    parser.add_argument('--only', default=None,
+                        help='comma separated benchmarks to run '
+                             '(import,reproject,postprocess,transport,'
+                             'pipeline)')
+    parser.add_argument('--json', default=None,
+                        help='write pipeline results to json file')
+    args = parser.parse_args()
+    only = None if args.only is None else args.only.split(",")
+    if only is None or "import" in only:
+        bench_import(args.repeat)
+    if only is None or "reproject" in only:
+        bench_reproject(args.rows, args.cols, args.repeat)
+    if only is None or "postprocess" in only:
+        bench_postprocess(args.rows, args.cols, args.repeat)
+    if only is None or "transport" in only:
+        bench_transport(args.rows, args.cols, args.repeat)
+    if only is None or "pipeline" in only:
+        results = bench_pipeline(
+            args.frames, args.scale, args.disparity_range, args.transport)
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
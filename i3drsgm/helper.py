@@ -2,8 +2,7 @@
 import os
 import cv2
 import glob
-from stereo3d.stereocalibration import StereoCalibration
-from i3drsgm import I3DRSGM, StereoSupport
+from i3drsgm import I3DRSGM, StereoSupport, StereoCalibration
 
 if __name__ == "__main__":
     # Get folder containing current script
@@ -14,8 +13,7 @@ if __name__ == "__main__":
     # Load stereo calibration from yamls
     left_cal_file = os.path.join(resource_folder, "sim_left.yaml")
     right_cal_file = os.path.join(resource_folder, "sim_right.yaml")
-    stcal = StereoCalibration()
-    stcal.get_cal_from_yaml(left_cal_file, right_cal_file)
+    stcal = StereoCalibration(left_cal_file, right_cal_file)
 
     # Initalise I3DRSGM
     print("Intitalising I3DRSGM...")
@@ -32,7 +30,7 @@ if __name__ == "__main__":
         right_gray_img = cv2.cvtColor(right_img, cv2.COLOR_BGR2GRAY)
 
         # Get Q from calibration
-        Q = stcal.stereo_cal["q"]
+        Q = stcal.Q
 
         # Set matcher parameters
         i3drsgm_inst.setWindowSize(11)
@@ -4,13 +4,34 @@ I3DRSGM python package
 This module is for using I3DR Semi-Global Matcher in Python.
 """
 import os
-import subprocess
+import sys
+import time
 import shutil
 import numpy as np
-import cv2
-import wget
-import zipfile
-import sys
+import logging
+import threading
+import queue
+import tempfile
+import functools
+import itertools
+import atexit
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from .lazy import LazyModule
+from . import download
+from .transport import get_transport
+from .calibration import StereoCalibration  # noqa: F401
+from .cache import DisparityCache  # noqa: F401
+from .metrics import metrics, CallbackSink, HistogramSink  # noqa: F401
+from .tiling import match_tiled
+from .temporal import TemporalMatcher  # noqa: F401
+from . import compact
+from .compact import to_compact, from_compact  # noqa: F401
+from .colormap import ColormapRenderer  # noqa: F401
+
+logger = logging.getLogger(__name__)
+# OpenCV is imported on first use to keep package import fast
+cv2 = LazyModule("cv2")
 
 # Exceptions
 '''
@@ -22,6 +43,11 @@ class ImageSizeNotEqual(Exception):
 
 
 class StereoSupport:
+    # Maximum number of reprojection grids to keep cached
+    GRID_CACHE_SIZE = 8
+    _grid_cache = OrderedDict()
+    _grid_cache_lock = threading.Lock()
+
     def __init__(self):
         pass
 
@@ -39,7 +65,7 @@ class StereoSupport:
             return np.zeros(disparity.shape, np.uint8)
 
     @staticmethod
-    def image_resize(image, width=None, height=None, inter=cv2.INTER_AREA):
+    def image_resize(image, width=None, height=None, inter=None):
         """
         Resize image based on height or width while maintaning aspect ratio
         :param image: image matrix
@@ -55,6 +81,8 @@ class StereoSupport:
         :type height: int
         :type inter: int
         """
+        if inter is None:
+            inter = cv2.INTER_AREA
         # initialize the dimensions of the image to be resized and
         # grab the image size
         dim = None
@@ -86,13 +114,20 @@ class StereoSupport:
         return resized
 
     @staticmethod
-    def reprojectImageTo3D(disp, Q, downsample_rate=1.0):
-        # Get important values from Q matrix
-        wz = Q[2, 3]
-        q03 = Q[0, 3]
-        q13 = Q[1, 3]
-        q32 = Q[3, 2]
-        q33 = Q[3, 3]
+    def _reprojection_grid(shape, Q, downsample_rate=1.0, roi_offset=None):
+        # Get the row and column coordinate grids used in reprojection
+        # Grids are cached for each (shape, Q, downsample_rate, roi_offset)
+        # so streams of same sized frames only calculate these once
+        if roi_offset is None:
+            roi_offset = (0, 0)
+        key = (tuple(shape), np.asarray(Q, np.float64).tobytes(),
+               float(downsample_rate),
+               (float(roi_offset[0]), float(roi_offset[1])))
+        with StereoSupport._grid_cache_lock:
+            grid = StereoSupport._grid_cache.get(key)
+            if grid is not None:
+                StereoSupport._grid_cache.move_to_end(key)
+                return grid
 
         # Calculate downsample factor to correct
         # for downsampling applied to disparity image
@@ -100,155 +135,825 @@ class StereoSupport:
         # is not effected by the donwnsampling
         downsample_factor = 1/downsample_rate
 
-        # Calculate W from key values in Q matrix
-        w = (disp * q32) + q33
-        # Calculate Z channel of depth image
-        z = wz / w
-        # Fill x,y channel the same size as Z
-        y = np.full_like(z, 1)
-        x = np.full_like(z, 1)
-
-        # Calculate x and y elements
-        # Downsample factor is applied to compensate
-        # for using a downsampled disparity image
-        # this is needed as the index of the pixel
-        # (i and j) is used in the calculation
-        num_rows, num_cols = disp.shape
-        for i in range(0, num_rows):
-            for j in range(0, num_cols):
-                x[i, j] = ((j * downsample_factor) + q03) / w[i, j]
-                y[i, j] = ((i * downsample_factor) + q13) / w[i, j]
-
-        # Combine x,y,z into depth image
-        depth = cv2.merge((x, y, z))
+        # Pixel index (i and j) with downsample factor, ROI offset and
+        # Q offsets applied. Stored as a column (rows) and a
+        # row (cols) so they broadcast across the image
+        num_rows, num_cols = shape
+        cols = (np.arange(num_cols, dtype=np.float64) * downsample_factor)
+        cols = (cols + roi_offset[0] + Q[0, 3])
+        cols = cols.astype(np.float32).reshape(1, num_cols)
+        rows = (np.arange(num_rows, dtype=np.float64) * downsample_factor)
+        rows = (rows + roi_offset[1] + Q[1, 3])
+        rows = rows.astype(np.float32).reshape(num_rows, 1)
+        grid = (rows, cols)
+
+        with StereoSupport._grid_cache_lock:
+            StereoSupport._grid_cache[key] = grid
+            while len(StereoSupport._grid_cache) > \
+                    StereoSupport.GRID_CACHE_SIZE:
+                StereoSupport._grid_cache.popitem(last=False)
+        return grid
 
-        return depth
+    @staticmethod
+    def clear_reprojection_cache():
+        # Remove all cached reprojection grids
+        with StereoSupport._grid_cache_lock:
+            StereoSupport._grid_cache.clear()
 
     @staticmethod
-    def depth_from_disp(disp, Q, downsample_rate=1.0):
+    def reprojectImageTo3D(disp, Q, downsample_rate=1.0, out=None,
+                           roi_offset=None):
+        """
+        Reproject disparity image to 3D points
+        :param disp:
+            disparity image. Compact int16 disparity gives the same
+            result as it's float form (see i3drsgm.compact.from_compact)
+        :param Q: Q matrix from stereo calibration
+        :param downsample_rate:
+            rate disparity image has been downsampled by (default: 1.0)
+        :param out:
+            optional float32 array of shape (rows, cols, 3) to write the
+            result into. Re-using the same buffer across frames avoids any
+            per-frame allocation.
+        :param roi_offset:
+            (x, y) position in the full image of the first disparity
+            pixel when disparity is of a region of interest
+            (see I3DRSGM.forwardMatch)
+        :type disp: numpy
+        :type Q: numpy
+        :type downsample_rate: float
+        :type out: numpy
+        :type roi_offset: tuple
+        :return: x,y,z image of shape (rows, cols, 3)
+        """
+        num_rows, num_cols = disp.shape[:2]
+        if out is None:
+            out = np.empty((num_rows, num_cols, 3), np.float32)
+        elif out.shape != (num_rows, num_cols, 3) or \
+                out.dtype != np.float32:
+            raise ValueError(
+                "out must be float32 with shape {}".format(
+                    (num_rows, num_cols, 3)))
+
+        # Get cached pixel index grids (with Q offsets applied)
+        grid = StereoSupport._reprojection_grid(
+            (num_rows, num_cols), Q, downsample_rate, roi_offset)
+        with metrics.timer("reproject"):
+            StereoSupport._reproject(disp, Q, grid, out)
+        return out
 
+    @staticmethod
+    def _reproject(disp, Q, grid, out):
+        # Reproject disparity into out using pixel index grids
+        # (see '_reprojection_grid', rows may be a slice of the grid)
         # Get important values from Q matrix
-        q32 = Q[3, 2]
-        q33 = Q[3, 3]
+        wz = np.float32(Q[2, 3])
+        q32 = np.float32(Q[3, 2])
+        q33 = np.float32(Q[3, 3])
+        if compact.is_compact(disp):
+            # Compact disparity is reprojected as it's float form
+            # (see i3drsgm.compact.from_compact) so remove the
+            # fixed-point scale and sign of compact disparity
+            q32 = np.float32(-Q[3, 2] / compact.COMPACT_SCALE)
+        rows, cols = grid
+
+        x = out[:, :, 0]
+        y = out[:, :, 1]
+        z = out[:, :, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Calculate W from key values in Q matrix
+            # (stored in Z channel until Z is calculated)
+            np.multiply(disp, q32, out=z, casting='unsafe')
+            np.add(z, q33, out=z)
+            if compact.is_compact(disp):
+                # Invalid compact disparity is reprojected as
+                # I3DRSGM invalid disparity
+                np.copyto(
+                    z, np.float32(compact.INVALID_DISPARITY * Q[3, 2]) + q33,
+                    where=disp == compact.COMPACT_INVALID)
+            # Calculate x and y elements
+            np.divide(cols, z, out=x)
+            np.divide(rows, z, out=y)
+            # Calculate Z channel of depth image
+            np.divide(wz, z, out=z)
 
-        # I3DRSGM returns negative disparity so invert
-        disparity16 = -disp.astype(np.float32)
+    @staticmethod
+    def _batch_output(disps, out):
+        # Get frames, number of frames and (N, H, W, 3) output
+        # for batch processing of a disparity stack or iterator
+        if isinstance(disps, np.ndarray) and disps.ndim != 3:
+            raise ValueError("Disparity stack must have shape (N, H, W)")
+        if hasattr(disps, "__len__"):
+            num_frames = len(disps)
+        elif out is not None and not isinstance(out, str):
+            num_frames = out.shape[0]
+        else:
+            # Number of frames is needed to allocate output
+            disps = list(disps)
+            num_frames = len(disps)
+        frames = iter(disps)
+        first = next(frames, None)
+        if first is None:
+            if out is None or isinstance(out, str):
+                out = np.empty((0, 0, 0, 3), np.float32)
+            return [], 0, out
+        frames = itertools.chain([first], frames)
+        shape = (num_frames,) + first.shape[:2] + (3,)
+        if out is None:
+            out = np.empty(shape, np.float32)
+        elif isinstance(out, str):
+            out = np.lib.format.open_memmap(
+                out, mode="w+", dtype=np.float32, shape=shape)
+        elif out.shape != shape or out.dtype != np.float32:
+            raise ValueError(
+                "out must be float32 with shape {}".format(shape))
+        return frames, num_frames, out
 
-        # Calculate W from key values in Q matrix
-        w = (disparity16 * q32) + q33
+    @staticmethod
+    def _batch_frames(frames, num_frames, shape):
+        # Check each frame of batch fits the output
+        for n, disp in enumerate(frames):
+            if n >= num_frames:
+                raise ValueError("More frames than output frames")
+            if disp.shape[:2] != shape:
+                raise ValueError("All frames must be the same size")
+            yield n, disp
 
-        # Find elements in W less than 0 (invalid as would be behind camera)
-        w_zero_mask = w <= 0
-        # Filter disparity image to only allow valid disparities
-        disparity16[w_zero_mask != 0] = 0.0
-
-        # Find elements in W eq to 99999 (invalid disparity signifier)
-        d_inf_mask = disparity16 == 99999
-        # Filter disparity image to only allow valid disparities
-        disparity16[d_inf_mask != 0] = 0.0
-
-        # Calculate min max disparity (ignoring zeros)
-        masked_a = np.ma.masked_equal(disparity16, 0.0, copy=False)
-        minDisp = masked_a.min()
-        maxDisp = masked_a.max()
-
-        # Replace invalid disparities with minium disparity
-        disparity16[w_zero_mask != 0] = minDisp
-        # Replace invalid disparities with maximum disparity
-        disparity16[d_inf_mask != 0] = maxDisp
-
-        # Generate depth from disparity
-        print("Generating depth from disparity...")
-        depth = StereoSupport.reprojectImageTo3D(
-            disparity16, Q, downsample_rate)
-
-        # Filter depth image to only allow valid disparities
-        depth[w_zero_mask != 0] = [0, 0, 0]
-
-        # Split depth image into x,y,z channels
-        x, y, z = cv2.split(depth)
-        # Filter z to remove invalid values
-        z[w_zero_mask != 0] = 0.0
-        z[d_inf_mask != 0] = 0.0
-        # Re-combine depth image
-        depth = cv2.merge((x, y, z))
-
-        # Calculate min max depth
-        masked_depth = np.ma.masked_equal(z, 0.0, copy=False)
-        minDepth = masked_depth.min()
-        maxDepth = masked_depth.max()
-        print("Depth range: "+str(minDepth)+"m, "+str(maxDepth)+"m")
+    @staticmethod
+    def reprojectImageTo3DBatch(disps, Q, downsample_rate=1.0, out=None,
+                                num_threads=None, chunk_rows=128,
+                                roi_offset=None):
+        """
+        Reproject a stack or sequence of disparity images to 3D points.
+        Each frame is split into chunks of rows that are reprojected
+        in parallel (numpy releases the GIL) and written into a single
+        output so long sequences can be written to a memory mapped file.
+        :param disps:
+            (N, H, W) disparity stack or iterable of (H, W) disparity
+            images (see 'reprojectImageTo3D')
+        :param Q: Q matrix from stereo calibration shared by all frames
+        :param downsample_rate:
+            rate disparity images have been downsampled by (default: 1.0)
+        :param out:
+            optional float32 array (or np.memmap) of shape (N, H, W, 3)
+            to write the result into, or filepath of a .npy file to
+            create as a memory mapped output.
+            Iterables without a length are read into memory first
+            unless out is an array.
+        :param num_threads: number of threads (default: number of cpus)
+        :param chunk_rows: number of image rows processed by each task
+        :param roi_offset:
+            (x, y) position of region of interest disparity in the
+            full image (see 'reprojectImageTo3D')
+        :type disps: numpy
+        :type Q: numpy
+        :type downsample_rate: float
+        :type out: numpy
+        :type num_threads: int
+        :type chunk_rows: int
+        :type roi_offset: tuple
+        :return: x,y,z images of shape (N, H, W, 3)
+        """
+        frames, num_frames, out = StereoSupport._batch_output(disps, out)
+        shape = out.shape[1:3]
+        rows, cols = StereoSupport._reprojection_grid(
+            shape, Q, downsample_rate, roi_offset)
+        chunks = [slice(start, min(start + chunk_rows, shape[0]))
+                  for start in range(0, shape[0], chunk_rows)]
+
+        with metrics.timer("reproject_batch"), ThreadPoolExecutor(
+                max_workers=num_threads or os.cpu_count() or 1) as executor:
+            for n, disp in StereoSupport._batch_frames(
+                    frames, num_frames, shape):
+                list(executor.map(
+                    lambda chunk: StereoSupport._reproject(
+                        disp[chunk], Q, (rows[chunk], cols), out[n, chunk]),
+                    chunks))
+        return out
+
+    @staticmethod
+    def depth_from_disp_batch(disps, Q, downsample_rate=1.0, out=None,
+                              num_threads=None, chunk_rows=128,
+                              roi_offset=None):
+        """
+        Calculate depth images from a stack or sequence of
+        I3DRSGM disparity images. Results are the same as
+        'depth_from_disp' of each frame (invalid disparities are set
+        to [0, 0, 0]). See 'reprojectImageTo3DBatch' for parameters.
+        :return: depth images of shape (N, H, W, 3)
+        """
+        frames, num_frames, out = StereoSupport._batch_output(disps, out)
+        shape = out.shape[1:3]
+        grid = StereoSupport._reprojection_grid(
+            shape, Q, downsample_rate, roi_offset)
+        chunks = [slice(start, min(start + chunk_rows, shape[0]))
+                  for start in range(0, shape[0], chunk_rows)]
+        # Scratch buffers of DisparityProcessor are not thread safe
+        # so each thread uses it's own processor
+        local = threading.local()
+
+        def processor():
+            if not hasattr(local, "processor"):
+                local.processor = DisparityProcessor(Q, downsample_rate)
+            return local.processor
+
+        with metrics.timer("depth_from_disp_batch"), ThreadPoolExecutor(
+                max_workers=num_threads or os.cpu_count() or 1) as executor:
+            for n, disp in StereoSupport._batch_frames(
+                    frames, num_frames, shape):
+                # Valid disparity range of the whole frame is used
+                # to replace invalid disparities in every chunk
+                ranges = [r for r in executor.map(
+                    lambda chunk: processor()._prepare(disp[chunk]),
+                    chunks) if r != (0.0, 0.0)]
+                disparity_range = (0.0, 0.0)
+                if len(ranges) > 0:
+                    disparity_range = (min(r[0] for r in ranges),
+                                       max(r[1] for r in ranges))
+                list(executor.map(
+                    lambda chunk: processor()._depth_rows(
+                        disp[chunk], (grid[0][chunk], grid[1]),
+                        out[n, chunk], disparity_range),
+                    chunks))
+        return out
+
+    @staticmethod
+    def depth_from_disp(disp, Q, downsample_rate=1.0, roi_offset=None):
+        # Calculate depth image from I3DRSGM disparity
+        # Invalid disparities are set to [0, 0, 0]
+        # roi_offset is the (x, y) position of a region of interest
+        # disparity in the full image (see 'reprojectImageTo3D')
+        with metrics.timer("depth_from_disp"):
+            processor = DisparityProcessor(Q, downsample_rate)
+            logger.debug("Generating depth from disparity...")
+            result = processor.process(
+                disp, depth=True, roi_offset=roi_offset)
+            depth = result["depth"]
+
+        if logger.isEnabledFor(logging.DEBUG):
+            # Calculate min max depth
+            minDepth, maxDepth = DisparityProcessor.valid_range(
+                depth[:, :, 2], depth[:, :, 2] != 0)
+            logger.debug("Depth range: %sm, %sm", minDepth, maxDepth)
 
         return depth
 
     @staticmethod
     def colormap_from_disparity(disp, Q, downsample_rate=1.0):
         # Display normalised disparity with colormap in OpenCV windows
+        with metrics.timer("colormap_from_disparity"):
+            processor = DisparityProcessor(Q, downsample_rate)
+            logger.debug("Applying colormap to disparity...")
+            result = processor.process(disp, depth=False, colormap=True)
+        return result["colormap"]
 
-        # Get important values from Q matrix
-        q32 = Q[3, 2]
-        q33 = Q[3, 3]
+    # Point cloud point (x, y, z, red, green, blue) as stored in PLY files
+    POINT_DTYPE = np.dtype([
+        ("x", "<f4"), ("y", "<f4"), ("z", "<f4"),
+        ("red", "u1"), ("green", "u1"), ("blue", "u1")])
 
-        # I3DRSGM returns negative disparity so invert
-        disparity16 = -disp.astype(np.float32)
+    @staticmethod
+    def valid_disparity_mask(disp, Q):
+        # Get mask of valid pixels in I3DRSGM disparity image
+        # Invalid pixels are behind the camera (w <= 0)
+        # or marked as invalid by I3DRSGM (99999)
+        # Accepts float or compact int16 disparity
+        disparity = compact.positive_disparity(disp)
+        disparity *= np.float32(Q[3, 2])
+        disparity += np.float32(Q[3, 3])
+        valid = disparity > 0
+        valid &= ~compact.invalid_mask(disp)
+        return valid
 
-        # Calculate W from key values in Q matrix
-        w = (disparity16 * q32) + q33
+    @staticmethod
+    def _point_colors(image, shape):
+        # Get RGB colors for points from image (resized to shape)
+        if image.shape[:2] != shape:
+            image = cv2.resize(
+                image, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+        if image.dtype != np.uint8:
+            image = cv2.convertScaleAbs(image)
+        if image.ndim == 2:
+            return image
+        # OpenCV images are BGR
+        return image[:, :, ::-1]
 
-        # Find elements in W less than 0 (invalid as would be behind camera)
-        w_zero_mask = w <= 0
-        # Filter disparity image to only allow valid disparities
-        disparity16[w_zero_mask != 0] = 0.0
+    @staticmethod
+    def iter_points_from_disp(disp, Q, downsample_rate=1.0, image=None,
+                              chunk_rows=256, valid=None, roi_offset=None):
+        """
+        Generate valid points from disparity image in chunks of rows
+        :param disp: disparity image from I3DRSGM (or compact disparity)
+        :param Q: Q matrix from stereo calibration
+        :param downsample_rate:
+            rate disparity image has been downsampled by (default: 1.0)
+        :param image:
+            optional (rectified left) image to color points.
+            Expected to be grayscale or BGR, resized if needed.
+        :param chunk_rows:
+            number of image rows processed at a time
+            (limits peak memory on large images)
+        :param valid: mask of valid pixels (see 'valid_disparity_mask')
+        :param roi_offset:
+            (x, y) position of region of interest disparity in the
+            full image (see 'reprojectImageTo3D')
+        :type disp: numpy
+        :type Q: numpy
+        :type downsample_rate: float
+        :type image: numpy
+        :type chunk_rows: int
+        :type valid: numpy
+        :type roi_offset: tuple
+        :return: generator of structured arrays of POINT_DTYPE
+        """
+        if valid is None:
+            valid = StereoSupport.valid_disparity_mask(disp, Q)
+        colors = None
+        if image is not None:
+            colors = StereoSupport._point_colors(image, disp.shape[:2])
+        # Get important values from Q matrix
+        wz = np.float32(Q[2, 3])
+        q32 = np.float32(Q[3, 2])
+        q33 = np.float32(Q[3, 3])
+        rows, cols = StereoSupport._reprojection_grid(
+            disp.shape[:2], Q, downsample_rate, roi_offset)
+        for start in range(0, disp.shape[0], chunk_rows):
+            end = min(start + chunk_rows, disp.shape[0])
+            i, j = np.nonzero(valid[start:end])
+            i += start
+            # Only reproject valid pixels
+            w = (compact.positive_disparity(disp[i, j]) * q32) + q33
+            points = np.empty(i.size, StereoSupport.POINT_DTYPE)
+            points["x"] = cols[0, j] / w
+            points["y"] = rows[i, 0] / w
+            points["z"] = wz / w
+            if colors is None:
+                points["red"] = 255
+                points["green"] = 255
+                points["blue"] = 255
+            elif colors.ndim == 2:
+                gray = colors[i, j]
+                points["red"] = gray
+                points["green"] = gray
+                points["blue"] = gray
+            else:
+                rgb = colors[i, j]
+                points["red"] = rgb[:, 0]
+                points["green"] = rgb[:, 1]
+                points["blue"] = rgb[:, 2]
+            yield points
 
-        # Find elements in W eq to 99999 (invalid disparity signifier)
-        d_inf_mask = disparity16 == 99999
-        # Filter disparity image to only allow valid disparities
-        disparity16[d_inf_mask != 0] = 0.0
+    @staticmethod
+    def points_from_disp(disp, Q, downsample_rate=1.0, image=None,
+                         chunk_rows=256, roi_offset=None):
+        """
+        Get valid points from disparity image as a structured array
+        (see 'iter_points_from_disp' for parameters)
+        :return: structured array of POINT_DTYPE
+        """
+        chunks = list(StereoSupport.iter_points_from_disp(
+            disp, Q, downsample_rate, image, chunk_rows,
+            roi_offset=roi_offset))
+        if len(chunks) == 0:
+            return np.empty(0, StereoSupport.POINT_DTYPE)
+        return np.concatenate(chunks)
 
-        # Calculate min max disparity (ignoring zeros)
-        masked_a = np.ma.masked_equal(disparity16, 0.0, copy=False)
-        minDisp = masked_a.min()
-        maxDisp = masked_a.max()
+    @staticmethod
+    def clip_points(points, depth_range):
+        """
+        Remove points outside of a depth range
+        :param points: structured array of POINT_DTYPE
+        :param depth_range:
+            (min, max) z of points to keep (either can be None)
+        :type points: numpy
+        :type depth_range: tuple
+        :return: structured array of POINT_DTYPE
+        """
+        min_z, max_z = depth_range
+        keep = np.ones(points.shape[0], np.bool_)
+        if min_z is not None:
+            keep &= points["z"] >= min_z
+        if max_z is not None:
+            keep &= points["z"] <= max_z
+        return points[keep]
+
+    @staticmethod
+    def voxel_downsample(points, voxel_size):
+        """
+        Downsample points to one point per occupied voxel.
+        Points are binned by hashing their voxel index and replaced by
+        the mean position and color of the points in each voxel.
+        :param points: structured array of POINT_DTYPE
+        :param voxel_size: size of voxel edges (in the units of Q)
+        :type points: numpy
+        :type voxel_size: float
+        :return: structured array of POINT_DTYPE
+        """
+        if voxel_size <= 0:
+            raise ValueError("voxel_size must be greater than 0")
+        if points.shape[0] == 0:
+            return points.copy()
+        xyz = np.stack([points["x"], points["y"], points["z"]], axis=1)
+        index = np.floor(xyz / voxel_size).astype(np.int64)
+        index -= index.min(axis=0)
+        dims = index.max(axis=0) + 1
+        if float(np.prod(dims.astype(np.float64))) < 2 ** 62:
+            # Linear voxel index is a collision free hash
+            key = np.ravel_multi_index(index.T, dims)
+            _, inverse, counts = np.unique(
+                key, return_inverse=True, return_counts=True)
+        else:
+            # Too many voxels for a linear index
+            _, inverse, counts = np.unique(
+                index, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        voxels = np.empty(counts.shape[0], StereoSupport.POINT_DTYPE)
+        for field in ["x", "y", "z"]:
+            voxels[field] = np.bincount(
+                inverse, weights=points[field]) / counts
+        for field in ["red", "green", "blue"]:
+            voxels[field] = np.rint(np.bincount(
+                inverse, weights=points[field]) / counts)
+        return voxels
+
+    @staticmethod
+    def point_cloud(disp, Q, downsample_rate=1.0, image=None,
+                    depth_range=None, voxel_size=None, chunk_rows=256,
+                    roi_offset=None):
+        """
+        Get point cloud of valid points from disparity image.
+        Only valid points are reprojected (see 'valid_disparity_mask'),
+        then points are optionally clipped to a depth range and
+        downsampled to a voxel grid.
+        (see 'iter_points_from_disp' for parameters)
+        :param depth_range:
+            optional (min, max) z of points to keep (see 'clip_points')
+        :param voxel_size:
+            optional size of voxels to downsample points to
+            (see 'voxel_downsample')
+        :type depth_range: tuple
+        :type voxel_size: float
+        :return:
+            (points, report) where points is a structured array of
+            POINT_DTYPE and report is a list with the 'stage', 'input'
+            and 'output' number of points and 'output_bytes' of each
+            stage ('compact', 'clip', 'voxel')
+        """
+        def stage(name, num_input, points):
+            return {"stage": name, "input": num_input,
+                    "output": points.shape[0],
+                    "output_bytes": points.nbytes}
+
+        report = []
+        with metrics.timer("point_cloud.compact"):
+            valid = StereoSupport.valid_disparity_mask(disp, Q)
+            chunks = list(StereoSupport.iter_points_from_disp(
+                disp, Q, downsample_rate, image, chunk_rows, valid,
+                roi_offset))
+            if len(chunks) == 0:
+                points = np.empty(0, StereoSupport.POINT_DTYPE)
+            else:
+                points = np.concatenate(chunks)
+        report.append(stage("compact", valid.size, points))
+        if depth_range is not None:
+            num_input = points.shape[0]
+            with metrics.timer("point_cloud.clip"):
+                points = StereoSupport.clip_points(points, depth_range)
+            report.append(stage("clip", num_input, points))
+        if voxel_size is not None:
+            num_input = points.shape[0]
+            with metrics.timer("point_cloud.voxel"):
+                points = StereoSupport.voxel_downsample(points, voxel_size)
+            report.append(stage("voxel", num_input, points))
+        return points, report
 
-        # Replace invalid disparities with minium disparity
-        disparity16[w_zero_mask != 0] = minDisp
-        # Replace invalid disparities with maximum disparity
-        disparity16[d_inf_mask != 0] = maxDisp
-        # Normalise disparity
-        disp_scaled = StereoSupport.scale_disparity(disparity16)
+    @staticmethod
+    def write_ply(filepath, disp, Q, downsample_rate=1.0, image=None,
+                  chunk_rows=256, roi_offset=None):
+        """
+        Write valid points from disparity image to binary PLY file.
+        Points are written in chunks of rows so the full point cloud
+        is never held in memory.
+        (see 'iter_points_from_disp' for parameters)
+        :param filepath: output PLY filepath
+        :type filepath: str
+        :return: number of points written
+        :rtype: int
+        """
+        valid = StereoSupport.valid_disparity_mask(disp, Q)
+        num_points = int(np.count_nonzero(valid))
+        header = "ply\n"
+        header += "format binary_little_endian 1.0\n"
+        header += "element vertex {}\n".format(num_points)
+        header += "property float x\n"
+        header += "property float y\n"
+        header += "property float z\n"
+        header += "property uchar red\n"
+        header += "property uchar green\n"
+        header += "property uchar blue\n"
+        header += "end_header\n"
+        with open(filepath, "wb") as f:
+            f.write(header.encode("ascii"))
+            for points in StereoSupport.iter_points_from_disp(
+                    disp, Q, downsample_rate, image, chunk_rows, valid,
+                    roi_offset):
+                f.write(points.tobytes())
+        return num_points
+
+
+class DisparityProcessor:
+    """
+    Single pass post-processing of I3DRSGM disparity images.
+    Invalid masks and the valid disparity range are calculated once
+    per frame and shared between all requested outputs.
+    Scratch buffers are re-used between frames of the same size
+    so an instance should not be shared between threads.
+    """
+    # Disparity value used by I3DRSGM to signify an invalid disparity
+    INVALID_DISPARITY = 99999
+
+    def __init__(self, Q, downsample_rate=1.0, colormap=None):
+        """
+        :param Q: Q matrix from stereo calibration
+        :param downsample_rate:
+            rate disparity image has been downsampled by (default: 1.0)
+        :param colormap: opencv colormap (default: cv2.COLORMAP_JET)
+        :type Q: numpy
+        :type downsample_rate: float
+        :type colormap: int
+        """
+        self.Q = np.asarray(Q, np.float64)
+        self.downsample_rate = downsample_rate
+        if colormap is None:
+            colormap = cv2.COLORMAP_JET
+        self.colormap = colormap
+        self._shape = None
+        self._disp = None
+        self._w = None
+        self._w_zero_mask = None
+        self._d_inf_mask = None
+        self._invalid_mask = None
+
+    def _allocate(self, shape):
+        # Allocate scratch buffers (only when image size changes)
+        if self._shape != shape:
+            self._shape = shape
+            self._disp = np.empty(shape, np.float32)
+            self._w = np.empty(shape, np.float32)
+            self._w_zero_mask = np.empty(shape, np.bool_)
+            self._d_inf_mask = np.empty(shape, np.bool_)
+            self._invalid_mask = np.empty(shape, np.bool_)
 
-        print("Applying colormap to disparity...")
+    @staticmethod
+    def valid_range(values, mask):
+        # Calculate min max of values where mask is True
+        # Returns (0, 0) if there are no values in mask
+        if not mask.any():
+            return 0.0, 0.0
+        minV = np.min(values, where=mask, initial=np.inf)
+        maxV = np.max(values, where=mask, initial=-np.inf)
+        return minV, maxV
+
+    def _prepare(self, disp, disparity_range=None):
+        # Calculate invalid masks and replace invalid disparities
+        # Results are stored in scratch buffers
+        # Returns valid disparity range (min, max)
+        # (calculated from disp unless disparity_range is given)
+        self._allocate(disp.shape[:2])
+        disparity = self._disp
+        w = self._w
+        w_zero_mask = self._w_zero_mask
+        d_inf_mask = self._d_inf_mask
+        invalid_mask = self._invalid_mask
+
+        if compact.is_compact(disp):
+            # Compact disparity is positive and fixed-point
+            np.multiply(disp, np.float32(1.0 / compact.COMPACT_SCALE),
+                        out=disparity, casting='unsafe')
+            np.equal(disp, compact.COMPACT_INVALID, out=d_inf_mask)
+            np.copyto(disparity, self.INVALID_DISPARITY, where=d_inf_mask,
+                      casting='unsafe')
+        else:
+            # I3DRSGM returns negative disparity so invert
+            np.negative(disp, out=disparity, casting='unsafe')
 
-        # Apply color map to disparity
-        disp_colormap = cv2.applyColorMap(disp_scaled, cv2.COLORMAP_JET)
-        # Filter out invalid disparities from colormap
-        disp_colormap[w_zero_mask != 0] = [0, 0, 0]
-        disp_colormap[d_inf_mask != 0] = [0, 0, 0]
+        # Calculate W from key values in Q matrix
+        np.multiply(disparity, np.float32(self.Q[3, 2]), out=w)
+        np.add(w, np.float32(self.Q[3, 3]), out=w)
+        # Find elements in W less than 0 (invalid as would be behind camera)
+        np.less_equal(w, 0, out=w_zero_mask)
+        # Find elements eq to 99999 (invalid disparity signifier)
+        np.equal(disparity, self.INVALID_DISPARITY, out=d_inf_mask)
+        d_inf_mask &= ~w_zero_mask
+        np.logical_or(w_zero_mask, d_inf_mask, out=invalid_mask)
+
+        if disparity_range is None:
+            # Calculate min max disparity (ignoring zeros and invalid)
+            disparity_range = self.valid_range(
+                disparity, ~invalid_mask & (disparity != 0))
+        minDisp, maxDisp = disparity_range
+
+        # Replace invalid disparities with minimum / maximum disparity
+        np.copyto(disparity, minDisp, where=w_zero_mask, casting='unsafe')
+        np.copyto(disparity, maxDisp, where=d_inf_mask, casting='unsafe')
+        return minDisp, maxDisp
+
+    def _depth_rows(self, disp, grid, out, disparity_range):
+        # Calculate depth of rows of a frame into out
+        # (used by StereoSupport.depth_from_disp_batch)
+        # grid is the rows of the frame reprojection grid and
+        # disparity_range the valid range of the whole frame
+        self._prepare(disp, disparity_range)
+        StereoSupport._reproject(self._disp, self.Q, grid, out)
+        out[self._w_zero_mask] = 0
+        out[:, :, 2][self._d_inf_mask] = 0
+
+    def process(self, disp, depth=True, colormap=False,
+                valid_mask=False, points=False, roi_offset=None):
+        """
+        Process disparity image into the requested outputs
+        :param disp:
+            disparity image from I3DRSGM (or compact disparity)
+        :param depth: return x,y,z depth image as 'depth'
+        :param colormap: return colormap of disparity as 'colormap'
+        :param valid_mask: return boolean mask of valid pixels as 'valid_mask'
+        :param points: return (N, 3) list of valid x,y,z points as 'points'
+        :param roi_offset:
+            (x, y) position of region of interest disparity in the
+            full image (see StereoSupport.reprojectImageTo3D)
+        :type disp: numpy
+        :type depth: bool
+        :type colormap: bool
+        :type valid_mask: bool
+        :type points: bool
+        :type roi_offset: tuple
+        :return:
+            dictionary of requested outputs
+            and valid disparity range as 'disparity_range'
+        """
+        with metrics.timer("disparity_processor.masks"):
+            minDisp, maxDisp = self._prepare(disp)
+        disparity = self._disp
+        w_zero_mask = self._w_zero_mask
+        d_inf_mask = self._d_inf_mask
+        invalid_mask = self._invalid_mask
+
+        result = {"disparity_range": (minDisp, maxDisp)}
+        if depth or points:
+            with metrics.timer("disparity_processor.depth"):
+                # Generate depth from disparity
+                depth_img = StereoSupport.reprojectImageTo3D(
+                    disparity, self.Q, self.downsample_rate,
+                    roi_offset=roi_offset)
+                # Filter depth image to only allow valid disparities
+                depth_img[w_zero_mask] = 0
+                depth_img[:, :, 2][d_inf_mask] = 0
+                if depth:
+                    result["depth"] = depth_img
+                if points:
+                    result["points"] = depth_img[~invalid_mask]
+        if colormap:
+            with metrics.timer("disparity_processor.colormap"):
+                # Normalise disparity and apply color map
+                disp_scaled = StereoSupport.scale_disparity(disparity)
+                disp_colormap = cv2.applyColorMap(
+                    disp_scaled, self.colormap)
+                # Filter out invalid disparities from colormap
+                disp_colormap[invalid_mask] = 0
+                result["colormap"] = disp_colormap
+        if valid_mask:
+            result["valid_mask"] = ~invalid_mask
+        return result
+
+
+class MatcherProfile:
+    """
+    Set of I3DRSGM matcher parameters.
+    Parameters left as None are not changed when the profile is applied.
+    """
+    def __init__(self, min_disparity=None, disparity_range=None,
+                 window_size=None, pyramid_level=None, interpolation=None):
+        """
+        :param min_disparity: minimum disparity
+        :param disparity_range: disparity range
+        :param window_size: window size
+        :param pyramid_level: pyramid level
+        :param interpolation: enable interpolation
+        :type min_disparity: int
+        :type disparity_range: int
+        :type window_size: int
+        :type pyramid_level: int
+        :type interpolation: bool
+        """
+        self.min_disparity = min_disparity
+        self.disparity_range = disparity_range
+        self.window_size = window_size
+        self.pyramid_level = pyramid_level
+        self.interpolation = interpolation
 
-        return disp_colormap
+    def __repr__(self):
+        return "MatcherProfile({})".format(", ".join(
+            "{}={!r}".format(k, v) for k, v in vars(self).items()))
 
 
 class I3DRSGMAppAPI:
-    def __init__(self, license_file=None):
+    # API parameters
+    PARAM_MIN_DISPARITY = "SET_MIN_DISPARITY"
+    PARAM_DISPARITY_RANGE = "SET_DISPARITY_RANGE"
+    PARAM_INTERPOLATION = "SET_INTERPOLATION"
+    PARAM_WINDOW_SIZE = "SET_WINDOW_SIZE"
+    PARAM_PYRAMID_LEVEL = "SET_PYRAMID_LEVEL"
+    # MatcherProfile attribute names for each API parameter
+    PROFILE_PARAMS = {
+        "min_disparity": PARAM_MIN_DISPARITY,
+        "disparity_range": PARAM_DISPARITY_RANGE,
+        "window_size": PARAM_WINDOW_SIZE,
+        "pyramid_level": PARAM_PYRAMID_LEVEL,
+        "interpolation": PARAM_INTERPOLATION,
+    }
+    # Environment variable used to set the default folder
+    # session scratch folders are created in
+    TMP_ROOT_ENV = "I3DRSGM_TMP_ROOT"
+    # RAM backed folder used when tmp_root="ram" (if available)
+    RAM_TMP_ROOT = "/dev/shm"
+    # Time to wait for app process to exit before it is killed (seconds)
+    STOP_TIMEOUT = 5.0
+    # Minimum time allowed for app initalisation when using
+    # request_timeout as startup includes the license check (seconds)
+    STARTUP_TIMEOUT = 60.0
+    # Maximum number of app output lines kept (see 'stderr_lines')
+    OUTPUT_BUFFER_LINES = 1000
+    # Time to wait for pipe reader threads to finish (seconds)
+    READER_JOIN_TIMEOUT = 1.0
+
+    def __init__(self, license_file=None, app_cmd=None, tmp_folder=None,
+                 tmp_root=None, auto_restart=True, request_timeout=None,
+                 health_interval=1.0, max_retries=1, warmup_size=None):
         # Initialise I3DRSGM App API
-        # Get folder containing current script
-        script_folder = os.path.dirname(os.path.realpath(__file__))
+        # app_cmd can be used to start an alternative app that
+        # uses the same API (e.g. [python, 'standin_app.py', 'api'])
+        # Each instance creates a unique scratch folder for storing images
+        # while processing inside tmp_root (see 'session_tmp_root').
+        # This is removed on 'close' or when the interpreter exits.
+        # tmp_folder can be used to choose a specific folder instead
+        # (this is not removed)
+        # The app process is supervised (see 'restart'):
+        # auto_restart restarts the app if it exits or does not respond
+        # to a request within request_timeout seconds (None for no limit)
+        # and retries the failed request up to max_retries times.
+        # App stdout and stderr are read by background threads so the
+        # app can not block on a full pipe. Recent output is kept in
+        # bounded 'stdout_lines' and 'stderr_lines' buffers.
+        # While idle the app is checked every health_interval seconds
+        # (None to disable) and restarted in the background if it exited.
+        # warmup_size (width, height) runs a match on start up and after
+        # each restart so the first frame does not pay the startup cost
         # Init variables
         self.init_success = False
-        self.PARAM_MIN_DISPARITY = "SET_MIN_DISPARITY"
-        self.PARAM_DISPARITY_RANGE = "SET_DISPARITY_RANGE"
-        self.PARAM_INTERPOLATION = "SET_INTERPOLATION"
-        self.PARAM_WINDOW_SIZE = "SET_WINDOW_SIZE"
-        self.PARAM_PYRAMID_LEVEL = "SET_PYRAMID_LEVEL"
+        self.appProcess = None
+        self._tmp_cleanup = None
+        self.auto_restart = auto_restart
+        self.request_timeout = request_timeout
+        self.health_interval = health_interval
+        self.max_retries = max_retries
+        self.warmup_size = warmup_size
+        # Number of times app process has been restarted
+        self.restarts = 0
+        self._process_failed = False
+        self._closed = False
+        # Recent app output (API responses are not included)
+        self.stdout_lines = deque(maxlen=self.OUTPUT_BUFFER_LINES)
+        self.stderr_lines = deque(maxlen=self.OUTPUT_BUFFER_LINES)
+        # API responses from stdout reader thread
+        self._responses = None
+        self._readers = []
+        # Request latency in seconds (see 'latencyStats')
+        self.last_latency = None
+        self._latency = {}
+        # Held while a request is in progress
+        self._lock = threading.RLock()
+        self._monitor_stop = threading.Event()
+        self._monitor_thread = None
         self.param_list = [
             self.PARAM_MIN_DISPARITY, self.PARAM_DISPARITY_RANGE,
             self.PARAM_INTERPOLATION, self.PARAM_WINDOW_SIZE,
             self.PARAM_WINDOW_SIZE, self.PARAM_PYRAMID_LEVEL]
+        # Last value successfully sent for each parameter
+        # Used to skip sending parameters that have not changed
+        self.param_state = {}
+        # Named parameter profiles (see 'addProfile')
+        self.profiles = {}
 
         # Check for valid I3DRSGMApp install
         valid_i3drsgm_app = False
-        i3drsgm_app_folder = os.path.join(script_folder, "i3drsgm_app")
-        self.I3DRSGMApp = os.path.join(i3drsgm_app_folder, "I3DRSGMApp.exe")
+        i3drsgm_app_folder = download.app_folder()
+        self.I3DRSGMApp = self.app_path()
+        if app_cmd is not None:
+            # Alternative app does not need I3DRSGMApp install
+            self.app_cmd = list(app_cmd)
+            valid_i3drsgm_app = True
+        else:
+            self.app_cmd = [self.I3DRSGMApp, "api"]
         # Check if I3DRSGMApp folder exists
         if os.path.exists(i3drsgm_app_folder):
             if os.path.exists(i3drsgm_app_folder):
@@ -258,13 +963,20 @@ class I3DRSGMAppAPI:
         if not valid_i3drsgm_app:
             msg = "Failed to find I3DRSGMApp in python install. "
             msg += "You must be running the online wheel. "
-            msg += "Downloading the required files..."
+            msg += "Installing the required files (run "
+            msg += "'python -m i3drsgm provision' before starting "
+            msg += "workers to avoid this)..."
             print(msg)
             self.download_app()
 
         # Define output folder used for storing images while processing
-        script_folder = os.path.dirname(os.path.realpath(__file__))
-        tmp_folder = os.path.join(script_folder, 'tmp')
+        if tmp_folder is None:
+            tmp_folder = tempfile.mkdtemp(
+                prefix="i3drsgm_", dir=self.session_tmp_root(tmp_root))
+            # Remove session folder on close or interpreter exit
+            self._tmp_cleanup = functools.partial(
+                shutil.rmtree, tmp_folder, ignore_errors=True)
+            atexit.register(self._tmp_cleanup)
         if not os.path.exists(tmp_folder):
             os.makedirs(os.path.join(tmp_folder))
         self.tmp_folder = tmp_folder
@@ -285,72 +997,243 @@ class I3DRSGMAppAPI:
                 return
 
         # Start I3DRSGMApp with API argument
+        with self._lock:
+            valid, response = self._startProcess()
+            if valid and self.warmup_size is not None:
+                valid, response = self._warmup(self.warmup_size)
+        if not valid:  # Check init request was successful
+            print("Failed to initalise I3DRSGM: "+response)
+            self.close()
+        self.init_success = valid
+        if valid and self.health_interval is not None:
+            # Supervisor thread checks app health while idle
+            self._monitor_thread = threading.Thread(
+                target=self._monitor, name="i3drsgm-supervisor",
+                daemon=True)
+            self._monitor_thread.start()
+
+    def _startProcess(self):
+        # Start app process and send initalisation request
+        # (lock must be held)
+        import subprocess
         self.appProcess = subprocess.Popen(
-            [self.I3DRSGMApp, "api"],
+            self.app_cmd,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE)
+        self._process_failed = False
+        # Each process has it's own response queue so responses from
+        # a previous process are never read
+        self._responses = queue.Queue()
+        self._readers = [
+            threading.Thread(
+                target=self._readStdout,
+                args=(self.appProcess.stdout, self._responses),
+                name="i3drsgm-stdout", daemon=True),
+            threading.Thread(
+                target=self._readStderr, args=(self.appProcess.stderr,),
+                name="i3drsgm-stderr", daemon=True)]
+        for reader in self._readers:
+            reader.start()
         self.init_success = True
         # Send initalisation request to I3DRSGM API
-        valid, response = self.apiRequest("INIT")
-        if not valid:  # Check init request was successful
-            print("Failed to initalise I3DRSGM: "+response)
-            self.close()
-        self.init_success = valid
+        return self._request("INIT", self._startupTimeout())
+
+    def _startupTimeout(self):
+        # Get timeout used for initalisation and warm up requests
+        if self.request_timeout is None:
+            return None
+        return max(self.request_timeout, self.STARTUP_TIMEOUT)
+
+    def _stopProcess(self):
+        # Stop app process (killed if it does not exit in STOP_TIMEOUT)
+        import subprocess
+        process = self.appProcess
+        if process is None:
+            return
+        if process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(self.STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        # Readers finish when pipes reach end of stream
+        for reader in self._readers:
+            if reader is not threading.current_thread():
+                reader.join(self.READER_JOIN_TIMEOUT)
+        self._readers = []
+        for pipe in [process.stdin, process.stdout, process.stderr]:
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    def _readStdout(self, pipe, responses):
+        # Reader thread for app stdout
+        # API responses are added to responses queue and other
+        # output to 'stdout_lines'. None is added at end of stream.
+        try:
+            for line in iter(pipe.readline, b""):
+                line_str = line.decode("utf-8", "replace")
+                result = self.parseApiLine(line_str)
+                if result is None:
+                    self.stdout_lines.append(line_str.rstrip())
+                else:
+                    responses.put(result)
+        except (OSError, ValueError):
+            # Pipe closed
+            pass
+        responses.put(None)
+
+    def _readStderr(self, pipe):
+        # Reader thread for app stderr
+        # Output is kept in 'stderr_lines' so the pipe never fills
+        try:
+            for line in iter(pipe.readline, b""):
+                line_str = line.decode("utf-8", "replace").rstrip()
+                self.stderr_lines.append(line_str)
+                logger.debug("I3DRSGMApp: %s", line_str)
+        except (OSError, ValueError):
+            # Pipe closed
+            pass
+
+    def _killHung(self, process, timeout):
+        # Kill app process that did not respond within timeout
+        # Causes the request to fail so the app is restarted
+        logger.warning("I3DRSGMApp did not respond within %ss", timeout)
+        self._process_failed = True
+        if process.poll() is None:
+            process.kill()
+
+    def _warmup(self, image_size):
+        # Match a textured image pair of image_size (width, height)
+        # so the app allocates it's resources before the first frame
+        # (lock must be held)
+        width, height = image_size
+        warmup_folder = os.path.join(self.tmp_folder, "warmup")
+        if not os.path.exists(warmup_folder):
+            os.makedirs(warmup_folder)
+        rng = np.random.RandomState(0)
+        left = cv2.resize(
+            rng.randint(0, 256, (max(1, height // 8), max(1, width // 8)))
+            .astype(np.uint8), (width, height))
+        right = np.roll(left, -1, axis=1)
+        filepaths = []
+        for name, img in [("left", left), ("right", right)]:
+            filepath = os.path.join(warmup_folder, name+".png")
+            cv2.imwrite(filepath, img)
+            filepaths.append(filepath)
+        with metrics.timer("warmup"):
+            return self._request("FORWARD_MATCH,{},{},{}".format(
+                filepaths[0], filepaths[1], warmup_folder),
+                self._startupTimeout())
+
+    def warmup(self, image_size):
+        """
+        Run a match so the first frame does not pay the app startup cost.
+        Warm up is repeated when the app is restarted.
+        :param image_size: (width, height) of images that will be matched
+        :return: True if warm up match was successful
+        :rtype: bool
+        """
+        if not self.init_success:
+            return False
+        self.warmup_size = image_size
+        with self._lock:
+            valid, response = self._warmup(image_size)
+        if not valid:
+            logger.error("I3DRSGM warm up failed: %s", response)
+        return valid
+
+    def isAlive(self):
+        # Check if app process is running and responding
+        process = self.appProcess
+        return process is not None and not self._process_failed and \
+            process.poll() is None
+
+    def restart(self):
+        """
+        Restart app process.
+        Parameters previously set are sent to the new process and
+        warm up is repeated (see 'warmup').
+        :return: True if app was restarted successfully
+        :rtype: bool
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            self._stopProcess()
+            self.restarts += 1
+            with metrics.timer("restart"):
+                valid, response = self._startProcess()
+                # Replay parameter state
+                for param, value in list(self.param_state.items()):
+                    if not valid:
+                        break
+                    valid, response = self._request(
+                        param+","+str(value), self.request_timeout)
+                if valid and self.warmup_size is not None:
+                    valid, response = self._warmup(self.warmup_size)
+            if not valid:
+                logger.error("Failed to restart I3DRSGM: %s", response)
+                self._stopProcess()
+            self.init_success = valid
+            return valid
+
+    def _monitor(self):
+        # Supervisor thread
+        # Restarts app process in the background if it exits while idle
+        while not self._monitor_stop.wait(self.health_interval):
+            if not self.init_success or not self.auto_restart:
+                continue
+            if not self._lock.acquire(blocking=False):
+                # Request in progress (failures handled by 'apiRequest')
+                continue
+            try:
+                if self.init_success and not self._closed and \
+                        not self.isAlive():
+                    logger.warning("I3DRSGMApp exited, restarting")
+                    self.restart()
+            finally:
+                self._lock.release()
 
     @staticmethod
-    def download_app(i3drsgm_app_version="1.0.10", replace=False):
-        def bar_progress(current, total, *_):
-            """
-            Progress bar to display download progress in wget
-
-            Parameters:
-                current (int): current byte count
-                total (int): total number of bytes
-                *_: required by wget but is ignored in this function
-            """
-            base_progress_msg = "Downloading: %d%% [%d / %d] bytes"
-            progress_message = base_progress_msg % (
-                current / total * 100, current, total)
-            # Don't use print() as it will print in new line every time.
-            sys.stdout.write("\r" + progress_message)
-            sys.stdout.flush()
-
-        def download_from_release(i3drsgm_app_version):
-            script_folder = os.path.dirname(os.path.realpath(__file__))
-            zip_filepath = os.path.join(script_folder, "i3drsgm-app.zip")
-
-            base_url = "https://github.com/i3drobotics/i3drsgm"
-            base_url += "/releases/download/"
-            release_url = "v{}/i3drsgm-{}-app.zip".format(
-                i3drsgm_app_version, i3drsgm_app_version)
-            url = base_url+release_url
-
-            wget.download(url, zip_filepath, bar=bar_progress)
-            # unzip downloaded file
-            with zipfile.ZipFile(zip_filepath, "r") as zip_ref:
-                zip_ref.extractall(script_folder)
-            # removing zip file
-            os.remove(zip_filepath)
-
-        script_folder = os.path.dirname(os.path.realpath(__file__))
-
-        # Check for I3DRSGMApp already exists
-        i3drsgm_app_exists = False
-        i3drsgm_app_folder = os.path.join(script_folder, "i3drsgm_app")
-        i3drsgm_app = os.path.join(i3drsgm_app_folder, "I3DRSGMApp.exe")
-        # Check if I3DRSGMApp folder exists
-        if os.path.exists(i3drsgm_app_folder):
-            if os.path.exists(i3drsgm_app):
-                # TODO: check all dlls are present
-                i3drsgm_app_exists = True
+    def download_app(i3drsgm_app_version=download.DEFAULT_APP_VERSION,
+                     replace=False):
+        # Download I3DRSGMApp into python install
+        # using the artifact cache (see i3drsgm.download.provision)
+        download.download_app(i3drsgm_app_version, replace)
 
-        if not i3drsgm_app_exists:
-            download_from_release(i3drsgm_app_version)
-        else:
-            if replace:
-                shutil.rmtree(i3drsgm_app_folder)
-                download_from_release(i3drsgm_app_version)
+    @staticmethod
+    def app_path():
+        # Get path to I3DRSGMApp in python install
+        return download.app_path()
+
+    @staticmethod
+    def session_tmp_root(tmp_root=None):
+        """
+        Get folder to create session scratch folders in
+        :param tmp_root:
+            folder to use, "ram" to use a RAM backed folder
+            (e.g. /dev/shm) if available.
+            If None the environment variable I3DRSGM_TMP_ROOT is used
+            otherwise the system temporary folder is used.
+        :type tmp_root: str
+        :rtype: str
+        """
+        if tmp_root is None:
+            tmp_root = os.environ.get(I3DRSGMAppAPI.TMP_ROOT_ENV)
+        if tmp_root == "ram":
+            if os.path.isdir(I3DRSGMAppAPI.RAM_TMP_ROOT):
+                tmp_root = I3DRSGMAppAPI.RAM_TMP_ROOT
+            else:
+                tmp_root = None
+        if tmp_root is None:
+            tmp_root = tempfile.gettempdir()
+        if not os.path.exists(tmp_root):
+            os.makedirs(tmp_root)
+        return tmp_root
 
     def isInit(self):
         # Check if class was initalised successfully
@@ -362,71 +1245,169 @@ class I3DRSGMAppAPI:
             return text[len(prefix):]
         return text  # or whatever
 
-    def apiWaitResponse(self):
+    @staticmethod
+    def parseApiLine(line_str):
+        # Parse line from I3DRSGM app API stdout
+        # Returns (valid, response) for API lines and None for other output
+        if (line_str.rstrip("\r\n") == "API_READY"):
+            return True, line_str
+        elif (line_str.startswith("API_RESPONSE:")):
+            response = line_str[len("API_RESPONSE:"):]
+            if (response.startswith("ERROR,")):
+                error_msg = response[len("ERROR,"):]
+                return False, error_msg.rstrip()
+            else:
+                return True, response.rstrip()
+        elif (line_str == ""):
+            # End of stream (app has closed)
+            return False, "I3DRSGMApp closed unexpectedly"
+        else:
+            # print("stout:"+line_str)
+            return None
+
+    def apiWaitResponse(self, timeout=None):
         # Wait for reponse from I3DRSGM app API.
-        # This is important to keep the pipe buffer clean
+        # App is killed if there is no response within timeout seconds
+        # (None to wait forever)
         if self.init_success:
-            while True:
-                line = self.appProcess.stdout.readline()
-                line_str = line.decode("utf-8")
-                if (line_str == "API_READY\r\n"):
-                    return True, line_str
-                elif (line_str.startswith("API_RESPONSE:")):
-                    response = self.removePrefix(line_str, "API_RESPONSE:")
-                    if (response.startswith("ERROR,")):
-                        error_msg = self.removePrefix(response, "ERROR,")
-                        return False, error_msg.rstrip()
-                    else:
-                        return True, response.rstrip()
-                elif (line_str == ""):
-                    return False, line_str
-                else:
-                    pass
-                    # print("stout:"+line_str)
+            try:
+                result = self._responses.get(timeout=timeout)
+            except queue.Empty:
+                self._killHung(self.appProcess, timeout)
+                return False, "I3DRSGMApp did not respond within {}s".format(
+                    timeout)
+            if result is None:
+                # App process has exited (or was killed as hung)
+                # Keep end of stream marker for following requests
+                self._responses.put(None)
+                self._process_failed = True
+                msg = "I3DRSGMApp closed unexpectedly"
+                if len(self.stderr_lines) > 0:
+                    msg += ": "+self.stderr_lines[-1]
+                return False, msg
+            return result
         else:
             print("Failed to initalise the pyI3DRSGM class. Make sure to initalise the class 'i3rsgm = pyI3DRSGM(...'")
             print("Check valid initalisation with 'isInit' function. E.g. 'i3rsgm.isInit()'")
 
-    def apiRequest(self, cmd):
-        # Perform an API requst with the I3DRSGM app
-        if (self.init_success):
-            valid, response = self.apiWaitResponse()
-            if (valid):
-                # print("sending api request...")
+    def _request(self, cmd, timeout):
+        # Send request to app and wait for response (lock must be held)
+        # App is killed if it does not respond within timeout
+        # (None for no limit)
+        start = time.perf_counter()
+        valid, response = self.apiWaitResponse(timeout)
+        if (valid):
+            try:
                 self.appProcess.stdin.write((cmd+"\n").encode())
                 self.appProcess.stdin.flush()
-                # print("waiting for api response...")
-                valid, response = self.apiWaitResponse()
+            except (OSError, ValueError):
+                # Pipe closed as app process has exited
+                self._process_failed = True
+                return False, "I3DRSGMApp closed unexpectedly"
+            if timeout is not None:
+                timeout = max(0.0, timeout - (time.perf_counter() - start))
+            valid, response = self.apiWaitResponse(timeout)
+        return valid, response
+
+    def apiRequest(self, cmd, timeout=None):
+        # Perform an API requst with the I3DRSGM app
+        # App is killed if it does not respond within timeout seconds
+        # (default: request_timeout)
+        # If the app exits or hangs it is restarted and the request
+        # retried (see 'auto_restart')
+        # Time is recorded to metrics as 'api_request.<COMMAND>'
+        # and in 'last_latency' (see 'latencyStats')
+        if (self.init_success):
+            if timeout is None:
+                timeout = self.request_timeout
+            command = cmd.split(",", 1)[0]
+            start = time.perf_counter()
+            with self._lock, metrics.timer("api_request."+command):
+                valid, response = self._request(cmd, timeout)
+                retries = 0
+                while self._process_failed and self.auto_restart and \
+                        retries < self.max_retries and not self._closed:
+                    retries += 1
+                    logger.warning(
+                        "I3DRSGMApp failed (%s), restarting", response)
+                    if not self.restart():
+                        break
+                    valid, response = self._request(cmd, timeout)
+            self._recordLatency(command, time.perf_counter() - start)
             return valid, response
         else:
             print("Failed to initalise the pyI3DRSGM class. Make sure to initalise the class 'i3rsgm = pyI3DRSGM(...'")
             print("Check valid initalisation with 'isInit' function. E.g. 'i3rsgm.isInit()'")
             return False, ""
 
+    def _recordLatency(self, command, seconds):
+        # Add request latency to statistics of command
+        self.last_latency = seconds
+        stats = self._latency.get(command)
+        if stats is None:
+            stats = {"count": 0, "total": 0.0, "max": 0.0}
+            self._latency[command] = stats
+        stats["count"] += 1
+        stats["total"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+        logger.debug("%s request took %.1fms", command, seconds * 1000)
+
+    def latencyStats(self):
+        """
+        Get latency of API requests
+        :return: {command: {count, mean, max}} (seconds)
+        :rtype: dict
+        """
+        return {
+            command: {
+                "count": stats["count"],
+                "mean": stats["total"] / stats["count"],
+                "max": stats["max"],
+            } for command, stats in self._latency.items()}
+
     def forwardMatchFiles(self, left_filepath, right_filepath,
-                          left_cal_filepath=None, right_cal_filepath=None):
+                          left_cal_filepath=None, right_cal_filepath=None,
+                          output_folder=None, timeout=None):
         # Stereo match from left and right image filepaths
+        # Disparity is written to 'disparity.tif' in output_folder
+        # (default: tmp_folder)
+        # timeout sets time in seconds to wait for the match
+        # (default: request_timeout)
+        if output_folder is None:
+            output_folder = self.tmp_folder
         if self.init_success:
             if (left_cal_filepath is None or right_cal_filepath is None):
-                appOptions = "FORWARD_MATCH,"+left_filepath+","+right_filepath+","+self.tmp_folder
+                appOptions = "FORWARD_MATCH,"+left_filepath+","+right_filepath+","+output_folder
             else:
                 appOptions = "FORWARD_MATCH,"+left_filepath+","+right_filepath+","
-                appOptions += left_cal_filepath+","+right_cal_filepath+","+self.tmp_folder+",0"
-            valid, response = self.apiRequest(appOptions)
+                appOptions += left_cal_filepath+","+right_cal_filepath+","+output_folder+",0"
+            valid, response = self.apiRequest(appOptions, timeout)
             if (not valid):
-                print(response)
+                logger.error(response)
             return valid
         else:
             print("Failed to initalise the pyI3DRSGM class. Make sure to initalise the class 'i3rsgm = pyI3DRSGM(...'")
             print("Check valid initalisation with 'isInit' function. E.g. 'i3rsgm.isInit()'")
-            return valid
+            return False
 
-    def setParam(self, param, value):
+    def setParam(self, param, value, force=False):
         # Set algorithm parameter with api request
+        # Request is skipped if the parameter already has this value
+        # (unless force is True)
         if (self.init_success):
             if param in self.param_list:
+                if isinstance(value, bool):
+                    value = int(value)
+                if not force and param in self.param_state:
+                    if str(self.param_state[param]) == str(value):
+                        return True
                 appOptions = param+","+str(value)
                 valid, _ = self.apiRequest(appOptions)
+                if valid:
+                    self.param_state[param] = value
+                else:
+                    # State of parameter in app is now unknown
+                    self.param_state.pop(param, None)
                 return valid
             else:
                 print("Invalid param {}".format(param))
@@ -436,46 +1417,440 @@ class I3DRSGMAppAPI:
             print("Check valid initalisation with 'isInit' function. E.g. 'i3rsgm.isInit()'")
             return False
 
+    @staticmethod
+    def profileParams(profile):
+        """
+        Get API parameters from profile
+        :param profile:
+            MatcherProfile (or object with the same attributes) or
+            dictionary using API parameter names (e.g. 'SET_WINDOW_SIZE')
+            or MatcherProfile attribute names (e.g. 'window_size')
+        :return: dictionary of {API parameter: value} (None values removed)
+        :rtype: dict
+        """
+        if not isinstance(profile, dict):
+            profile = vars(profile)
+        params = {}
+        for name, value in profile.items():
+            param = I3DRSGMAppAPI.PROFILE_PARAMS.get(name, name)
+            if value is not None:
+                params[param] = value
+        return params
+
+    def setParams(self, profile, force=False):
+        """
+        Set several algorithm parameters in one call.
+        Only parameters that have changed are sent to the app.
+        :param profile: parameters (see 'profileParams')
+        :param force: send all parameters even if unchanged
+        :return: True if all parameters were set successfully
+        :rtype: bool
+        """
+        params = self.profileParams(profile)
+        for param in params:
+            if param not in self.param_list:
+                print("Invalid param {}".format(param))
+                return False
+        valid = True
+        for param, value in params.items():
+            if not self.setParam(param, value, force):
+                valid = False
+        return valid
+
+    def addProfile(self, name, profile):
+        # Add named parameter profile to use with 'useProfile'
+        params = self.profileParams(profile)
+        for param in params:
+            if param not in self.param_list:
+                raise ValueError("Invalid param {}".format(param))
+        self.profiles[name] = params
+
+    def useProfile(self, name):
+        # Set parameters from named profile
+        # Only parameters that differ from the current state are sent
+        if name not in self.profiles:
+            print("Invalid profile {}".format(name))
+            return False
+        return self.setParams(self.profiles[name])
+
     def close(self):
         # Close connection to app process
         # Required to clean up memory
-        self.appProcess.terminate()
+        self._closed = True
+        self.init_success = False
+        self._monitor_stop.set()
+        if self._monitor_thread is not None and \
+                self._monitor_thread is not threading.current_thread():
+            self._monitor_thread.join()
+        self._monitor_thread = None
+        self._stopProcess()
+        # Remove session scratch folder
+        if self._tmp_cleanup is not None:
+            self._tmp_cleanup()
+            atexit.unregister(self._tmp_cleanup)
+            self._tmp_cleanup = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
 
 
 class I3DRSGM:
-    def __init__(self, license_file=None, replace_api=False):
+    # Default rows added above and below each band in tiled matching
+    # (increased to the matching window size if it is larger)
+    TILE_OVERLAP = 32
+
+    def __init__(self, license_file=None, replace_api=False,
+                 app_cmd=None, tmp_folder=None, tmp_root=None,
+                 transport="png", cache=None, auto_restart=True,
+                 request_timeout=None, warmup_size=None, compact=False):
+        # transport sets file format used to pass images to I3DRSGMApp
+        # (see i3drsgm.transport.TRANSPORTS)
+        # cache can be a DisparityCache used to re-use results of
+        # image pairs already matched with the same parameters
+        # auto_restart, request_timeout and warmup_size control
+        # supervision of the app process (see I3DRSGMAppAPI)
+        # compact returns int16 compact disparity (see i3drsgm.compact)
+        # instead of float32 disparity
+        self.transport = get_transport(transport)
+        self.cache = cache
+        self.compact = compact
         if (replace_api):
             I3DRSGMAppAPI.download_app(replace=True)
         # Initalse I3DRSGM
         # Initalise connection to I3DRSGM app API
-        self.i3drsgmAppAPI = I3DRSGMAppAPI(license_file)
+        self.i3drsgmAppAPI = I3DRSGMAppAPI(
+            license_file, app_cmd, tmp_folder, tmp_root,
+            auto_restart=auto_restart, request_timeout=request_timeout,
+            warmup_size=warmup_size)
 
     def isInit(self):
         # Check I3DRSGM has been initalised
         return self.i3drsgmAppAPI.isInit()
 
-    def forwardMatch(self, left_img, right_img):
+    def forwardMatch(self, left_img, right_img, profile=None, timeout=None,
+                     roi=None):
         # Stereo matching using a left and right image
         # (expects images to already by rectified)
+        # profile can be the name of a profile added with 'addProfile'
+        # or parameters (see 'setParams') to use for this match
+        # timeout sets time in seconds to wait for the match
+        # (default: request_timeout)
+        # roi (x, y, width, height) only matches a region of interest
+        # and returns (valid, disparity, roi_info) (see 'roiRegion')
+        if roi is not None:
+            return self._forwardMatchROI(
+                left_img, right_img, roi, profile, timeout)
         if self.isInit():
-            left_filepath = os.path.join(
-                self.i3drsgmAppAPI.tmp_folder, "left_tmp.png")
-            right_filepath = os.path.join(
-                self.i3drsgmAppAPI.tmp_folder, "right_tmp.png")
-            disp_filepath = os.path.join(
-                self.i3drsgmAppAPI.tmp_folder, "disparity.tif")
-            cv2.imwrite(left_filepath, left_img)
-            cv2.imwrite(right_filepath, right_img)
+            if profile is not None:
+                if not self._applyProfile(profile):
+                    return False, None
+            valid, disp = self._forwardMatch(left_img, right_img, timeout)
+            return valid, self._outputDisparity(disp)
+        else:
+            print("Failed to initalise the pyI3DRSGM class. Make sure to initalise the class 'i3rsgm = pyI3DRSGM(...'")
+            print("Check valid initalisation with 'isInit' function. E.g. 'i3rsgm.isInit()'")
+            return False, None
+
+    def _outputDisparity(self, disp):
+        # Convert disparity to compact disparity if enabled
+        # (disparity outside the compact range is stored as invalid)
+        if disp is None or not self.compact:
+            return disp
+        with metrics.timer("forward_match.compact"):
+            try:
+                return to_compact(disp)
+            except ValueError:
+                logger.warning(
+                    "Disparity outside of compact disparity range "
+                    "(+/-2047.9375 pixels) stored as invalid")
+                return to_compact(disp, out_of_range="invalid")
+
+    def _forwardMatch(self, left_img, right_img, timeout):
+        # Stereo match with current parameters (see 'forwardMatch')
+        # Cache stores float disparity so it can be shared with
+        # instances that do not use compact disparity
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(
+                left_img, right_img, self.i3drsgmAppAPI.param_state)
+            disp = self.cache.get(cache_key)
+            if disp is not None:
+                return True, disp
+        tmp_folder = self.i3drsgmAppAPI.tmp_folder
+        disp_filepath = os.path.join(tmp_folder, "disparity.tif")
+        with metrics.timer("forward_match.imwrite"):
+            left_filepath = self.transport.write_image(
+                tmp_folder, "left_tmp", left_img)
+            right_filepath = self.transport.write_image(
+                tmp_folder, "right_tmp", right_img)
+        if left_filepath is None or right_filepath is None:
+            logger.error("Failed to write images for I3DRSGM")
+            return False, None
+        with metrics.timer("forward_match.ipc"):
             valid = self.i3drsgmAppAPI.forwardMatchFiles(
-                left_filepath, right_filepath)
-            disp = None
-            if (valid):
-                disp = cv2.imread(disp_filepath, -1)
-            return valid, disp
+                left_filepath, right_filepath, timeout=timeout)
+        disp = None
+        if (valid):
+            with metrics.timer("forward_match.imread"):
+                disp = self.transport.read_disparity(disp_filepath)
+            if cache_key is not None and disp is not None:
+                self.cache.put(cache_key, disp)
+        return valid, disp
+
+    def forwardMatchStream(self, pairs, queue_depth=2):
+        """
+        Pipelined stereo matching of a stream of rectified image pairs.
+        While I3DRSGMApp matches frame N, frame N+1 is written to disk
+        and the disparity of frame N-1 is read back.
+        Frames are returned in the same order as pairs.
+        No other matching should be done with this instance while
+        the stream is running.
+        :param pairs: iterable of (left_img, right_img)
+        :param queue_depth:
+            maximum number of frames waiting between each stage.
+            When the caller stops consuming results the pipeline
+            stops reading pairs once the queues are full.
+        :type pairs: iterable
+        :type queue_depth: int
+        :return: generator of (valid, disparity)
+        """
+        if queue_depth < 1:
+            raise ValueError("queue_depth must be at least 1")
+        if not self.isInit():
+            print("Failed to initalise the pyI3DRSGM class. Make sure to initalise the class 'i3rsgm = pyI3DRSGM(...'")
+            print("Check valid initalisation with 'isInit' function. E.g. 'i3rsgm.isInit()'")
+            return
+        # Each frame in flight uses it's own slot folder so writing the
+        # next frame does not overwrite files still in use
+        num_slots = queue_depth + 2
+        slot_folders = []
+        for i in range(num_slots):
+            slot_folder = os.path.join(
+                self.i3drsgmAppAPI.tmp_folder, "stream_{}".format(i))
+            if not os.path.exists(slot_folder):
+                os.makedirs(slot_folder)
+            slot_folders.append(slot_folder)
+        free_slots = queue.Queue()
+        for i in range(num_slots):
+            free_slots.put(i)
+        match_queue = queue.Queue(queue_depth)
+        read_queue = queue.Queue(queue_depth)
+        result_queue = queue.Queue(queue_depth)
+        stop = threading.Event()
+        end = object()
+
+        def put(q, item):
+            # Put item in queue unless the stream has been stopped
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            # Get item from queue unless the stream has been stopped
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return end
+
+        def write_stage():
+            # Write images of each pair to a free slot
+            try:
+                for left_img, right_img in pairs:
+                    slot = get(free_slots)
+                    if slot is end:
+                        return
+                    with metrics.timer("forward_match_stream.imwrite"):
+                        left_filepath = self.transport.write_image(
+                            slot_folders[slot], "left_tmp", left_img)
+                        right_filepath = self.transport.write_image(
+                            slot_folders[slot], "right_tmp", right_img)
+                    if not put(match_queue,
+                               (slot, left_filepath, right_filepath)):
+                        return
+                put(match_queue, end)
+            except Exception as e:
+                put(match_queue, e)
+
+        def match_stage():
+            # Match each slot with I3DRSGMApp
+            try:
+                while True:
+                    item = get(match_queue)
+                    if item is end or isinstance(item, Exception):
+                        put(read_queue, item)
+                        return
+                    slot, left_filepath, right_filepath = item
+                    if left_filepath is None or right_filepath is None:
+                        logger.error("Failed to write images for I3DRSGM")
+                        valid = False
+                    else:
+                        with metrics.timer("forward_match_stream.ipc"):
+                            valid = self.i3drsgmAppAPI.forwardMatchFiles(
+                                left_filepath, right_filepath,
+                                output_folder=slot_folders[slot])
+                    if not put(read_queue, (slot, valid)):
+                        return
+            except Exception as e:
+                put(read_queue, e)
+
+        def read_stage():
+            # Read disparity of each slot and free the slot
+            try:
+                while True:
+                    item = get(read_queue)
+                    if item is end or isinstance(item, Exception):
+                        put(result_queue, item)
+                        return
+                    slot, valid = item
+                    disp = None
+                    if valid:
+                        with metrics.timer("forward_match_stream.imread"):
+                            disp = self.transport.read_disparity(
+                                os.path.join(
+                                    slot_folders[slot], "disparity.tif"))
+                        disp = self._outputDisparity(disp)
+                    free_slots.put(slot)
+                    if not put(result_queue, (valid, disp)):
+                        return
+            except Exception as e:
+                put(result_queue, e)
+
+        threads = [
+            threading.Thread(target=stage, daemon=True)
+            for stage in [write_stage, match_stage, read_stage]]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = result_queue.get()
+                if item is end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def roiRegion(self, image_shape, roi):
+        """
+        Get region of the images matched for a region of interest.
+        The region is extended to the left by the disparity search range
+        (and to the right for negative minimum disparity) so every ROI
+        pixel can be matched, and above and below by the tile overlap
+        (see 'tileOverlap') so matching near the ROI edges is the same
+        as in a full frame match.
+        If the disparity range has not been set the region is extended
+        to the left edge of the image.
+        :param image_shape: shape of rectified images
+        :param roi: (x, y, width, height) in image pixels
+        :return:
+            dictionary with 'roi', 'offset' ((x, y) of ROI for
+            reprojection, see StereoSupport.reprojectImageTo3D) and
+            'match_region' ((x, y, width, height) of images matched)
+        :rtype: dict
+        """
+        x, y, width, height = [int(v) for v in roi]
+        num_rows, num_cols = image_shape[:2]
+        if width < 1 or height < 1 or x < 0 or y < 0 or \
+                x + width > num_cols or y + height > num_rows:
+            raise ValueError("Invalid roi {} for image size {}".format(
+                roi, (num_cols, num_rows)))
+        param_state = self.i3drsgmAppAPI.param_state
+        min_disparity = int(param_state.get(
+            I3DRSGMAppAPI.PARAM_MIN_DISPARITY, 0))
+        disparity_range = param_state.get(
+            I3DRSGMAppAPI.PARAM_DISPARITY_RANGE)
+        if disparity_range is None:
+            left_margin = x
         else:
+            left_margin = max(0, min_disparity + int(disparity_range))
+        right_margin = max(0, -min_disparity)
+        overlap = self.tileOverlap()
+        x0 = max(0, x - left_margin)
+        x1 = min(num_cols, x + width + right_margin)
+        y0 = max(0, y - overlap)
+        y1 = min(num_rows, y + height + overlap)
+        return {
+            "roi": (x, y, width, height),
+            "offset": (x, y),
+            "match_region": (x0, y0, x1 - x0, y1 - y0),
+        }
+
+    def _forwardMatchROI(self, left_img, right_img, roi, profile, timeout):
+        # Stereo match region of interest (see 'forwardMatch')
+        if not self.isInit():
+            print("Failed to initalise the pyI3DRSGM class. Make sure to initalise the class 'i3rsgm = pyI3DRSGM(...'")
+            print("Check valid initalisation with 'isInit' function. E.g. 'i3rsgm.isInit()'")
+            return False, None, None
+        if profile is not None:
+            # Apply profile first as disparity range sets the region
+            if not self._applyProfile(profile):
+                return False, None, None
+        roi_info = self.roiRegion(left_img.shape, roi)
+        x0, y0, match_width, match_height = roi_info["match_region"]
+        x, y, width, height = roi_info["roi"]
+        rows = slice(y0, y0 + match_height)
+        cols = slice(x0, x0 + match_width)
+        valid, disp = self.forwardMatch(
+            left_img[rows, cols], right_img[rows, cols], timeout=timeout)
+        if not valid or disp is None:
+            return False, None, roi_info
+        # Crop disparity to ROI
+        disp = disp[y - y0:y - y0 + height, x - x0:x - x0 + width]
+        return True, np.ascontiguousarray(disp), roi_info
+
+    def tileOverlap(self):
+        # Get default overlap used for tiled matching
+        window_size = self.i3drsgmAppAPI.param_state.get(
+            I3DRSGMAppAPI.PARAM_WINDOW_SIZE, 0)
+        return max(self.TILE_OVERLAP, int(window_size))
+
+    def forwardMatchTiled(self, left_img, right_img, band_rows=512,
+                          overlap=None, profile=None, measure_memory=False):
+        """
+        Stereo matching of a large image pair in horizontal bands.
+        Each band is matched separately to reduce matcher memory
+        and bands are stitched back into a single disparity image.
+        See I3DRSGMPool.forwardMatchTiled to match bands in parallel.
+        :param left_img: rectified left image
+        :param right_img: rectified right image
+        :param band_rows: number of rows used from each band
+        :param overlap:
+            rows added above and below each band
+            (default: see 'tileOverlap')
+        :param profile: profile to use for each band (see 'forwardMatch')
+        :param measure_memory:
+            report peak python memory used (see i3drsgm.tiling.match_tiled)
+        :type band_rows: int
+        :type overlap: int
+        :type measure_memory: bool
+        :return:
+            (valid, disparity, report) where report has timing of each
+            band and memory used (see i3drsgm.tiling.match_tiled)
+        """
+        if not self.isInit():
             print("Failed to initalise the pyI3DRSGM class. Make sure to initalise the class 'i3rsgm = pyI3DRSGM(...'")
             print("Check valid initalisation with 'isInit' function. E.g. 'i3rsgm.isInit()'")
-            return valid, None
+            return False, None, None
+        if profile is not None:
+            if not self._applyProfile(profile):
+                return False, None, None
+        if overlap is None:
+            overlap = self.tileOverlap()
+        return match_tiled(
+            self.forwardMatch, left_img, right_img, band_rows, overlap,
+            measure_memory=measure_memory)
 
     def setDisparityRange(self, value):
         # Set disparity range used I3DRSGM algorithm
@@ -536,7 +1911,63 @@ class I3DRSGM:
             print("Check valid initalisation with 'isInit' function. E.g. 'i3rsgm.isInit()'")
             return False
 
+    def _applyProfile(self, profile):
+        # Set parameters from profile name or parameters
+        if isinstance(profile, str):
+            return self.useProfile(profile)
+        return self.setParams(profile)
+
+    def setParams(self, profile):
+        # Set several I3DRSGM parameters in one call
+        # (see I3DRSGMAppAPI.profileParams for accepted formats)
+        # Only parameters that have changed are sent
+        if (self.isInit()):
+            return self.i3drsgmAppAPI.setParams(profile)
+        else:
+            print("Failed to initalise the pyI3DRSGM class. Make sure to initalise the class 'i3rsgm = pyI3DRSGM(...'")
+            print("Check valid initalisation with 'isInit' function. E.g. 'i3rsgm.isInit()'")
+            return False
+
+    def addProfile(self, name, profile):
+        # Add named parameter profile
+        # (e.g. i3drsgm.addProfile("fast", MatcherProfile(pyramid_level=4)))
+        self.i3drsgmAppAPI.addProfile(name, profile)
+
+    def useProfile(self, name):
+        # Switch to named parameter profile
+        if (self.isInit()):
+            return self.i3drsgmAppAPI.useProfile(name)
+        else:
+            print("Failed to initalise the pyI3DRSGM class. Make sure to initalise the class 'i3rsgm = pyI3DRSGM(...'")
+            print("Check valid initalisation with 'isInit' function. E.g. 'i3rsgm.isInit()'")
+            return False
+
+    def warmup(self, image_size):
+        # Run a match of image_size (width, height) so the first frame
+        # does not pay the app startup cost (see I3DRSGMAppAPI.warmup)
+        return self.i3drsgmAppAPI.warmup(image_size)
+
     def close(self):
         # Close connection to I3DRSGM app API
         # Required to clean up memory
         self.i3drsgmAppAPI.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+from .pool import I3DRSGMPool  # noqa: E402
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # Import asyncio client on first use (asyncio is slow to import)
+        if name == "AsyncI3DRSGM":
+            from .aio import AsyncI3DRSGM
+            return AsyncI3DRSGM
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(__name__, name))
+else:
+    from .aio import AsyncI3DRSGM  # noqa: E402,F401
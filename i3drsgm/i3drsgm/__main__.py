@@ -0,0 +1,184 @@
+"""
+I3DRSGM command line interface
+
+Usage:
+    python -m i3drsgm provision
+    python -m i3drsgm batch --left "left/*.png" --right "right/*.png" \
+        --left-cal left.yaml --right-cal right.yaml --output results
+(see 'python -m i3drsgm <command> --help' for options)
+"""
+import os
+import sys
+import shlex
+import argparse
+from . import download
+from .transport import TRANSPORTS
+
+
+def parse_range(range_str):
+    """Parse 'min,max' range argument"""
+    try:
+        min_value, max_value = [float(v) for v in range_str.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Range must be 'min,max'")
+    return min_value, max_value
+
+
+def split_command(cmd_str):
+    """Split command string into arguments (see 'subprocess.list2cmdline')"""
+    if os.name != "nt":
+        return shlex.split(cmd_str)
+    # Non-POSIX mode keeps quotes so paths with backslashes are not
+    # escaped, quotes around each argument are then removed
+    args = []
+    for arg in shlex.split(cmd_str, posix=False):
+        if len(arg) >= 2 and arg[0] == arg[-1] and arg[0] in "\"'":
+            arg = arg[1:-1]
+        args.append(arg)
+    return args
+
+
+def batch_command(args):
+    """Stereo match folder of image pairs"""
+    from .calibration import StereoCalibration
+    from .batch import OUTPUTS, find_pairs, read_manifest, load_profile
+    from .batch import run_batch, print_report
+    if args.manifest is not None:
+        pairs = read_manifest(args.manifest)
+    elif args.left is not None and args.right is not None:
+        pairs = find_pairs(args.left, args.right)
+    else:
+        print("Set --manifest or --left and --right")
+        return 2
+    if (args.left_cal is None) != (args.right_cal is None):
+        print("Set both --left-cal and --right-cal")
+        return 2
+    outputs = args.outputs.split(",")
+    for output in outputs:
+        if output not in OUTPUTS:
+            print("Unknown output '{}' (options: {})".format(
+                output, ",".join(sorted(OUTPUTS.keys()))))
+            return 2
+    calibration = None
+    if args.left_cal is not None:
+        calibration = StereoCalibration(args.left_cal, args.right_cal)
+    profile = None
+    if args.profile is not None:
+        profile = load_profile(args.profile)
+    app_cmd = None
+    if args.app_cmd is not None:
+        app_cmd = split_command(args.app_cmd)
+
+    print("Processing {} image pairs...".format(len(pairs)))
+    report = run_batch(
+        pairs, args.output, outputs, calibration=calibration,
+        profile=profile, prefetch=args.prefetch, workers=args.workers,
+        matchers=args.matchers, resume=args.resume,
+        colormap_range=args.colormap_range, license_file=args.license,
+        app_cmd=app_cmd, transport=args.transport)
+    print_report(report)
+    return 1 if report["failed"] > 0 else 0
+
+
+def provision_command(args):
+    """Install I3DRSGMApp from the artifact cache"""
+    try:
+        path = download.provision(
+            args.app_version, cache=args.cache, base_url=args.url,
+            sha256=args.sha256, install_folder=args.install_folder,
+            replace=args.replace,
+            allow_unverified=args.allow_unverified or None)
+    except (IOError, ValueError) as e:
+        print("Failed to provision I3DRSGMApp: {}".format(e))
+        return 1
+    print("I3DRSGMApp installed: {}".format(path))
+    return 0
+
+
+def main(argv=None):
+    """
+    Run command line interface
+    :param argv: command line arguments (default: sys.argv[1:])
+    :return: exit code
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m i3drsgm",
+        description="I3DR Semi-Global Matcher command line interface")
+    subparsers = parser.add_subparsers(dest="command")
+
+    batch = subparsers.add_parser(
+        "batch", help="stereo match a folder of image pairs",
+        description="Stereo match image pairs and write disparity, "
+                    "depth and point cloud outputs")
+    batch.add_argument('--left', help='glob pattern of left images')
+    batch.add_argument('--right', help='glob pattern of right images')
+    batch.add_argument('--manifest',
+                       help='csv file of image pairs (left,right[,name])')
+    batch.add_argument('--left-cal', help='left camera calibration yaml')
+    batch.add_argument('--right-cal', help='right camera calibration yaml')
+    batch.add_argument('--profile',
+                       help='json file of matcher parameters '
+                            '(e.g. {"disparity_range": 320})')
+    batch.add_argument('--output', required=True, help='output folder')
+    batch.add_argument('--outputs', default="disparity",
+                       help='comma separated outputs '
+                            '(disparity,compact,depth,colormap,ply)')
+    batch.add_argument('--colormap-range', type=parse_range, default=None,
+                       help='fixed disparity range of colormap (min,max)')
+    batch.add_argument('--prefetch', type=int, default=2,
+                       help='threads reading and rectifying images')
+    batch.add_argument('--workers', type=int, default=2,
+                       help='threads writing outputs')
+    batch.add_argument('--matchers', type=int, default=1,
+                       help='number of I3DRSGMApp processes')
+    batch.add_argument('--resume', action='store_true',
+                       help='skip pairs with all outputs already written')
+    batch.add_argument('--license', default=None,
+                       help='I3DRSGM license file')
+    batch.add_argument('--app-cmd', default=None,
+                       help='command to start alternative app')
+    batch.add_argument('--transport', default="png",
+                       choices=sorted(TRANSPORTS.keys()),
+                       help='file format used to pass images to the app')
+    batch.set_defaults(func=batch_command)
+
+    provision = subparsers.add_parser(
+        "provision", help="install I3DRSGMApp from the artifact cache",
+        description="Install I3DRSGMApp from a local artifact cache, "
+                    "downloading and verifying the release zip if it is "
+                    "not cached. Run before starting workers so the app "
+                    "is never downloaded on the first frame.")
+    provision.add_argument('--app-version',
+                           default=download.DEFAULT_APP_VERSION,
+                           help='I3DRSGMApp release version')
+    provision.add_argument('--cache', default=None,
+                           help='artifact cache folder '
+                                '(default: $I3DRSGM_APP_CACHE or '
+                                '~/.cache/i3drsgm)')
+    provision.add_argument('--url', default=None,
+                           help='release server url '
+                                '(default: $I3DRSGM_RELEASE_URL or github)')
+    provision.add_argument('--sha256', default=None,
+                           help='expected sha256 of release zip '
+                                '(default: $I3DRSGM_APP_SHA256)')
+    provision.add_argument('--install-folder', default=None,
+                           help='folder to install i3drsgm_app into '
+                                '(default: i3drsgm package folder)')
+    provision.add_argument('--replace', action='store_true',
+                           help='replace existing install')
+    provision.add_argument('--allow-unverified', action='store_true',
+                           help='allow release zips without a known '
+                                'checksum (default: '
+                                '$I3DRSGM_ALLOW_UNVERIFIED)')
+    provision.set_defaults(func=provision_command)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
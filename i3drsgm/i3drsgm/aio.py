@@ -0,0 +1,233 @@
+"""
+I3DRSGM asyncio client
+
+This module is for using I3DRSGMApp from an asyncio event loop.
+On Windows this requires the ProactorEventLoop
+(default event loop from python 3.8).
+"""
+import os
+import shutil
+import asyncio
+import tempfile
+import logging
+import functools
+import atexit
+from . import I3DRSGMAppAPI
+from .transport import get_transport
+
+logger = logging.getLogger(__name__)
+
+
+def _running_loop():
+    # Get event loop of the running coroutine
+    # (asyncio.get_running_loop was added in python 3.7)
+    if hasattr(asyncio, "get_running_loop"):
+        return asyncio.get_running_loop()
+    return asyncio.get_event_loop()
+
+
+class AsyncI3DRSGM:
+    """
+    asyncio client for the I3DRSGMApp stdin/stdout API.
+    Image encoding/decoding runs in an executor so the event loop
+    is free while images are written and matched.
+    Requests to the app are processed one at a time.
+
+    Example:
+        async with AsyncI3DRSGM() as i3drsgm:
+            await i3drsgm.set_param(
+                I3DRSGMAppAPI.PARAM_DISPARITY_RANGE, 3264)
+            valid, disp = await i3drsgm.forward_match(left, right)
+    """
+    def __init__(self, license_file=None, app_cmd=None, tmp_folder=None,
+                 tmp_root=None, transport="png", executor=None):
+        """
+        :param license_file: path to I3DRSGM license file
+        :param app_cmd:
+            command to start alternative app using the same API
+            (default: I3DRSGMApp)
+        :param tmp_folder:
+            folder for storing images while processing
+            (default: unique folder created in tmp_root)
+        :param tmp_root:
+            folder to create scratch folder in
+            (see I3DRSGMAppAPI.session_tmp_root)
+        :param transport:
+            file format used to pass images to I3DRSGMApp
+            (see i3drsgm.transport.TRANSPORTS)
+        :param executor:
+            executor used for image encoding
+            (default: event loop default executor)
+        :type license_file: str
+        :type app_cmd: list
+        :type tmp_folder: str
+        :type tmp_root: str
+        :type transport: str
+        :type executor: concurrent.futures.Executor
+        """
+        self.license_file = license_file
+        self.app_cmd = None if app_cmd is None else list(app_cmd)
+        self.tmp_folder = tmp_folder
+        self.tmp_root = tmp_root
+        self.transport = get_transport(transport)
+        self.executor = executor
+        self.init_success = False
+        self.appProcess = None
+        self._tmp_cleanup = None
+        self._lock = None
+
+    def isInit(self):
+        # Check if client was started successfully
+        return self.init_success
+
+    async def _run(self, func, *args):
+        # Run blocking function in executor
+        loop = _running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _prepare(self):
+        # Prepare app install, license and scratch folder
+        # (blocking so is run in executor)
+        app_cmd = self.app_cmd
+        if app_cmd is None:
+            app_path = I3DRSGMAppAPI.app_path()
+            if not os.path.exists(app_path):
+                I3DRSGMAppAPI.download_app()
+            app_cmd = [app_path, "api"]
+            if self.license_file is not None:
+                if not os.path.isfile(self.license_file):
+                    raise FileNotFoundError(
+                        "license file does not exist")
+                shutil.copy2(self.license_file, os.path.dirname(app_path))
+        if self.tmp_folder is None:
+            self.tmp_folder = tempfile.mkdtemp(
+                prefix="i3drsgm_",
+                dir=I3DRSGMAppAPI.session_tmp_root(self.tmp_root))
+            # Remove session folder on close or interpreter exit
+            self._tmp_cleanup = functools.partial(
+                shutil.rmtree, self.tmp_folder, ignore_errors=True)
+            atexit.register(self._tmp_cleanup)
+        elif not os.path.exists(self.tmp_folder):
+            os.makedirs(self.tmp_folder)
+        return app_cmd
+
+    async def start(self):
+        """
+        Start I3DRSGMApp and initalise API
+        :return: True if initalised successfully
+        :rtype: bool
+        """
+        self._lock = asyncio.Lock()
+        app_cmd = await self._run(self._prepare)
+        self.appProcess = await asyncio.create_subprocess_exec(
+            *app_cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL)
+        self.init_success = True
+        # Send initalisation request to I3DRSGM API
+        valid, response = await self.api_request("INIT")
+        if not valid:
+            print("Failed to initalise I3DRSGM: "+response)
+            await self.close()
+        self.init_success = valid
+        return valid
+
+    async def _wait_response(self):
+        # Wait for reponse from I3DRSGM app API
+        while True:
+            line = await self.appProcess.stdout.readline()
+            result = I3DRSGMAppAPI.parseApiLine(line.decode("utf-8"))
+            if result is not None:
+                return result
+
+    async def _api_request(self, cmd):
+        # Perform an API request (lock must already be held)
+        valid, response = await self._wait_response()
+        if valid:
+            self.appProcess.stdin.write((cmd+"\n").encode())
+            await self.appProcess.stdin.drain()
+            valid, response = await self._wait_response()
+        return valid, response
+
+    async def api_request(self, cmd):
+        """
+        Perform an API request with the I3DRSGM app
+        :return: (valid, response)
+        """
+        if not self.init_success:
+            return False, ""
+        async with self._lock:
+            return await self._api_request(cmd)
+
+    async def set_param(self, param, value):
+        """
+        Set algorithm parameter (see I3DRSGMAppAPI.PARAM_*)
+        :return: True if parameter was set successfully
+        :rtype: bool
+        """
+        params = [
+            I3DRSGMAppAPI.PARAM_MIN_DISPARITY,
+            I3DRSGMAppAPI.PARAM_DISPARITY_RANGE,
+            I3DRSGMAppAPI.PARAM_INTERPOLATION,
+            I3DRSGMAppAPI.PARAM_WINDOW_SIZE,
+            I3DRSGMAppAPI.PARAM_PYRAMID_LEVEL]
+        if param not in params:
+            print("Invalid param {}".format(param))
+            return False
+        if isinstance(value, bool):
+            value = int(value)
+        valid, _ = await self.api_request(param+","+str(value))
+        return valid
+
+    async def forward_match(self, left_img, right_img):
+        """
+        Stereo matching using a left and right image
+        (expects images to already by rectified)
+        :return: (valid, disparity)
+        """
+        if not self.init_success:
+            return False, None
+        async with self._lock:
+            tmp_folder = self.tmp_folder
+            # Encode left and right images in parallel
+            left_filepath, right_filepath = await asyncio.gather(
+                self._run(self.transport.write_image,
+                          tmp_folder, "left_tmp", left_img),
+                self._run(self.transport.write_image,
+                          tmp_folder, "right_tmp", right_img))
+            if left_filepath is None or right_filepath is None:
+                logger.error("Failed to write images for I3DRSGM")
+                return False, None
+            cmd = "FORWARD_MATCH,"+left_filepath+","+right_filepath
+            cmd += ","+tmp_folder
+            valid, response = await self._api_request(cmd)
+            if not valid:
+                logger.error("I3DRSGM forward match failed: %s", response)
+                return False, None
+            disp = await self._run(
+                self.transport.read_disparity,
+                os.path.join(tmp_folder, "disparity.tif"))
+            return True, disp
+
+    async def close(self):
+        # Close connection to app process
+        # Required to clean up memory
+        self.init_success = False
+        if self.appProcess is not None:
+            if self.appProcess.returncode is None:
+                self.appProcess.terminate()
+            await self.appProcess.wait()
+            self.appProcess = None
+        # Remove session scratch folder
+        if self._tmp_cleanup is not None:
+            self._tmp_cleanup()
+            atexit.unregister(self._tmp_cleanup)
+            self._tmp_cleanup = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
@@ -0,0 +1,370 @@
+"""
+I3DRSGM batch processing
+
+This module is for stereo matching folders of image pairs
+(see 'python -m i3drsgm batch --help').
+Image pairs are read and rectified by prefetch threads and outputs are
+written by post-processing threads while the next pairs are matched.
+Outputs are written to a temporary file and renamed when complete so
+an interrupted batch can be resumed.
+"""
+import os
+import csv
+import glob
+import json
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .lazy import LazyModule
+from . import I3DRSGM, I3DRSGMAppAPI, I3DRSGMPool
+from . import StereoSupport, DisparityProcessor, ColormapRenderer
+from . import compact
+from .metrics import metrics, HistogramSink
+
+# OpenCV is imported on first use to keep package import fast
+cv2 = LazyModule("cv2")
+
+# Output filename of each output type
+# ('{}' is replaced by the name of the pair)
+OUTPUTS = {
+    "disparity": "{}_disp.tif",
+    "compact": "{}_disp.png",
+    "depth": "{}_depth.npy",
+    "colormap": "{}_colormap.png",
+    "ply": "{}.ply",
+}
+# Outputs that require a calibration
+CALIBRATED_OUTPUTS = ("depth", "ply")
+
+
+def find_pairs(left_pattern, right_pattern):
+    """
+    Find image pairs from left and right glob patterns.
+    Files are paired in sorted order.
+    :param left_pattern: glob pattern of left images
+    :param right_pattern: glob pattern of right images
+    :return: list of (name, left filepath, right filepath)
+    :rtype: list
+    """
+    left_files = sorted(glob.glob(left_pattern))
+    right_files = sorted(glob.glob(right_pattern))
+    if len(left_files) != len(right_files):
+        raise ValueError(
+            "Found {} left images and {} right images".format(
+                len(left_files), len(right_files)))
+    pairs = []
+    for left_file, right_file in zip(left_files, right_files):
+        name = os.path.splitext(os.path.basename(left_file))[0]
+        pairs.append((name, left_file, right_file))
+    _check_names(pairs)
+    return pairs
+
+
+def read_manifest(filepath):
+    """
+    Read image pairs from manifest file.
+    Each line is 'left,right' or 'left,right,name'
+    (empty lines and lines starting with '#' are ignored).
+    Relative paths are relative to the manifest folder.
+    :param filepath: manifest filepath
+    :return: list of (name, left filepath, right filepath)
+    :rtype: list
+    """
+    folder = os.path.dirname(os.path.abspath(filepath))
+    pairs = []
+    with open(filepath, "r", newline="") as f:
+        for row in csv.reader(f):
+            row = [value.strip() for value in row]
+            if len(row) == 0 or row[0] == "" or row[0].startswith("#"):
+                continue
+            if len(row) not in [2, 3]:
+                raise ValueError("Invalid manifest line: {}".format(row))
+            left_file, right_file = [
+                os.path.join(folder, path) for path in row[:2]]
+            if len(row) == 3:
+                name = row[2]
+            else:
+                name = os.path.splitext(os.path.basename(left_file))[0]
+            pairs.append((name, left_file, right_file))
+    _check_names(pairs)
+    return pairs
+
+
+def _check_names(pairs):
+    # Check pair names are unique as they are used for output filenames
+    names = set()
+    for name, _, _ in pairs:
+        if name in names:
+            raise ValueError("Duplicate pair name: {}".format(name))
+        names.add(name)
+
+
+def load_profile(filepath):
+    """
+    Load matcher profile from JSON file using MatcherProfile attribute
+    names or API parameter names, e.g.
+        {"disparity_range": 320, "window_size": 11}
+    :rtype: dict
+    """
+    with open(filepath, "r") as f:
+        profile = json.load(f)
+    if not isinstance(profile, dict):
+        raise ValueError("Profile must be a JSON object")
+    names = set(I3DRSGMAppAPI.PROFILE_PARAMS.keys())
+    names |= set(I3DRSGMAppAPI.PROFILE_PARAMS.values())
+    for name in profile:
+        if name not in names:
+            raise ValueError("Unknown profile parameter: {}".format(name))
+    return profile
+
+
+def output_path(output_folder, name, output):
+    # Get filepath of output of a pair
+    return os.path.join(output_folder, OUTPUTS[output].format(name))
+
+
+def _write_atomic(filepath, write):
+    # Write output to temporary file and rename when complete
+    # so partial outputs are never mistaken for complete ones
+    root, ext = os.path.splitext(filepath)
+    tmp_filepath = root + ".partial" + ext
+    if write(tmp_filepath) is False:
+        raise IOError("Failed to write {}".format(filepath))
+    os.replace(tmp_filepath, filepath)
+
+
+def _prefetch(executor, func, items, depth):
+    # Map func over items in executor with at most depth items pending
+    # Results are returned in the same order as items
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def run_batch(pairs, output_folder, outputs=("disparity",),
+              calibration=None, profile=None, prefetch=2, workers=2,
+              matchers=1, resume=False, colormap_range=None,
+              license_file=None, app_cmd=None, transport="png", log=print):
+    """
+    Stereo match image pairs and write outputs
+    :param pairs: list of (name, left filepath, right filepath)
+    :param output_folder: folder to write outputs to
+    :param outputs: outputs to write for each pair (see OUTPUTS)
+    :param calibration:
+        StereoCalibration used to rectify images
+        (default: images are already rectified).
+        Required for depth and ply outputs.
+    :param profile:
+        matcher parameters (see I3DRSGMAppAPI.profileParams)
+    :param prefetch: number of threads reading and rectifying images
+    :param workers: number of threads post-processing and writing outputs
+    :param matchers:
+        number of I3DRSGMApp processes (uses I3DRSGMPool if more than 1)
+    :param resume: skip pairs where all outputs have been written
+    :param colormap_range:
+        (min, max) disparity of colormap output
+        (default: range of each frame)
+    :param license_file: path to I3DRSGM license file
+    :param app_cmd: command to start alternative app (see I3DRSGMAppAPI)
+    :param transport: file format used to pass images to I3DRSGMApp
+    :param log: function used to print progress
+    :return:
+        report dictionary with pair counts, 'seconds', 'startup_seconds',
+        'pairs_per_second', 'megapixels_per_second' and 'stages'
+        (timing of each stage, see HistogramSink.stats)
+    :rtype: dict
+    """
+    for output in outputs:
+        if output not in OUTPUTS:
+            raise ValueError("Unknown output: {}".format(output))
+        if output in CALIBRATED_OUTPUTS and calibration is None:
+            raise ValueError(
+                "Calibration is required for {} output".format(output))
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    todo = []
+    skipped = 0
+    for pair in pairs:
+        if resume and all(
+                os.path.exists(output_path(output_folder, pair[0], output))
+                for output in outputs):
+            skipped += 1
+        else:
+            todo.append(pair)
+    if skipped > 0:
+        log("Skipping {} completed pairs".format(skipped))
+
+    counts = {"processed": 0, "failed": 0, "pixels": 0}
+    counts_lock = threading.Lock()
+    local = threading.local()
+
+    def load(pair):
+        # Read and rectify image pair
+        name, left_file, right_file = pair
+        with metrics.timer("batch.read"):
+            left_img = cv2.imread(left_file, cv2.IMREAD_GRAYSCALE)
+            right_img = cv2.imread(right_file, cv2.IMREAD_GRAYSCALE)
+            if left_img is None or right_img is None:
+                return name, None, None
+            if calibration is not None:
+                left_img, right_img = calibration.rectify_pair(
+                    left_img, right_img)
+        return name, left_img, right_img
+
+    def processor(shape):
+        # DisparityProcessor for image size (one per thread)
+        if not hasattr(local, "processors"):
+            local.processors = {}
+        processor = local.processors.get(shape)
+        if processor is None:
+            if calibration is None:
+                # Without a calibration no pixels are behind the camera
+                Q = np.eye(4)
+            else:
+                Q = calibration.q_for_size((shape[1], shape[0]))
+            processor = DisparityProcessor(Q)
+            local.processors[shape] = processor
+        return processor
+
+    def renderer():
+        # ColormapRenderer for fixed colormap range (one per thread)
+        if not hasattr(local, "renderer"):
+            local.renderer = ColormapRenderer(disparity_range=colormap_range)
+        return local.renderer
+
+    def post(name, left_img, disp):
+        # Write outputs of pair
+        try:
+            with metrics.timer("batch.post"):
+                disp_processor = processor(disp.shape[:2])
+                depth = "depth" in outputs
+                colormap = "colormap" in outputs and colormap_range is None
+                result = {}
+                if depth or colormap:
+                    result = disp_processor.process(
+                        disp, depth=depth, colormap=colormap)
+                for output in outputs:
+                    filepath = output_path(output_folder, name, output)
+                    if output == "disparity":
+                        _write_atomic(filepath, lambda path: cv2.imwrite(
+                            path, disp.astype(np.float32)))
+                    elif output == "compact":
+                        _write_atomic(filepath, lambda path: (
+                            compact.write_compact(path, disp)))
+                    elif output == "depth":
+                        _write_atomic(filepath, lambda path: np.save(
+                            path, result["depth"]))
+                    elif output == "colormap":
+                        if colormap:
+                            image = result["colormap"]
+                        else:
+                            image = renderer().render(disp)
+                        _write_atomic(filepath, lambda path: cv2.imwrite(
+                            path, image))
+                    elif output == "ply":
+                        _write_atomic(filepath, lambda path: (
+                            StereoSupport.write_ply(
+                                path, disp, disp_processor.Q,
+                                image=left_img)))
+            with counts_lock:
+                counts["processed"] += 1
+                counts["pixels"] += disp.shape[0] * disp.shape[1]
+        except Exception as e:
+            log("Failed to write outputs of {}: {}".format(name, e))
+            with counts_lock:
+                counts["failed"] += 1
+
+    histogram = HistogramSink()
+    metrics.add_sink(histogram)
+    start = time.perf_counter()
+    try:
+        if matchers > 1:
+            matcher = I3DRSGMPool(
+                matchers, license_file, app_cmd=app_cmd, transport=transport)
+        else:
+            matcher = I3DRSGM(
+                license_file, app_cmd=app_cmd, transport=transport)
+        try:
+            if not matcher.isInit():
+                raise RuntimeError("Failed to initalise I3DRSGM")
+            if profile is not None and not matcher.setParams(profile):
+                raise RuntimeError("Failed to set matcher profile")
+            startup_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            # Name and left image of each pair being matched
+            # (results are returned in the same order)
+            in_flight = deque()
+
+            def loaded_pairs():
+                for name, left_img, right_img in _prefetch(
+                        read_executor, load, todo, max(1, prefetch)):
+                    if left_img is None:
+                        log("Failed to read images of {}".format(name))
+                        with counts_lock:
+                            counts["failed"] += 1
+                        continue
+                    in_flight.append((name, left_img))
+                    yield left_img, right_img
+
+            with ThreadPoolExecutor(max(1, prefetch)) as read_executor, \
+                    ThreadPoolExecutor(max(1, workers)) as post_executor:
+                if matchers > 1:
+                    results = matcher.map(loaded_pairs())
+                else:
+                    results = matcher.forwardMatchStream(loaded_pairs())
+                pending = deque()
+                for valid, disp in results:
+                    name, left_img = in_flight.popleft()
+                    if not valid or disp is None:
+                        log("Failed to match {}".format(name))
+                        with counts_lock:
+                            counts["failed"] += 1
+                        continue
+                    pending.append(post_executor.submit(
+                        post, name, left_img, disp))
+                    while len(pending) > 2 * max(1, workers):
+                        pending.popleft().result()
+                while pending:
+                    pending.popleft().result()
+        finally:
+            matcher.close()
+    finally:
+        metrics.remove_sink(histogram)
+
+    seconds = time.perf_counter() - start
+    return {
+        "pairs": len(pairs),
+        "skipped": skipped,
+        "processed": counts["processed"],
+        "failed": counts["failed"],
+        "startup_seconds": startup_seconds,
+        "seconds": seconds,
+        "pairs_per_second": counts["processed"] / seconds if seconds else 0.0,
+        "megapixels_per_second":
+            counts["pixels"] / 1e6 / seconds if seconds else 0.0,
+        "stages": histogram.stats(),
+    }
+
+
+def print_report(report, log=print):
+    # Print throughput report returned by 'run_batch'
+    log("pairs: {} processed, {} skipped, {} failed ({} total)".format(
+        report["processed"], report["skipped"], report["failed"],
+        report["pairs"]))
+    log("startup: {:.2f}s, processing: {:.2f}s".format(
+        report["startup_seconds"], report["seconds"]))
+    log("throughput: {:.2f} pairs/s, {:.2f} megapixels/s".format(
+        report["pairs_per_second"], report["megapixels_per_second"]))
+    log("  {:32s} {:>8s} {:>10s} {:>10s} {:>10s}".format(
+        "stage", "count", "mean (ms)", "max (ms)", "total (s)"))
+    for stage, stats in sorted(report["stages"].items()):
+        log("  {:32s} {:8d} {:10.2f} {:10.2f} {:10.2f}".format(
+            stage, stats["count"], stats["mean"] * 1000,
+            stats["max"] * 1000, stats["sum"]))
@@ -0,0 +1,254 @@
+"""
+I3DRSGM disparity cache
+
+This module is for re-using disparity results of previously matched
+image pairs.
+"""
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from . import compact
+
+# File extensions of disk tier entries
+COMPACT_EXTENSION = ".png"
+FLOAT_EXTENSION = ".npz"
+
+
+class DisparityCache:
+    """
+    Content-addressed disparity cache.
+    Results are keyed by a hash of both input images and the
+    matcher parameters used.
+    A memory tier keeps the most recently used disparities up to a
+    byte budget. An optional disk tier stores compressed disparity
+    files so results can be re-used between runs.
+    Disk entries are written as compact disparity PNGs
+    (see i3drsgm.compact) when the conversion is lossless, otherwise
+    (e.g. disparity outside the compact range) as compressed float .npz.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024, cache_folder=None,
+                 max_disk_bytes=None):
+        """
+        :param max_bytes: byte budget of memory tier (0 to disable)
+        :param cache_folder: folder for disk tier (None to disable)
+        :param max_disk_bytes: byte budget of disk tier (None for no limit)
+        :type max_bytes: int
+        :type cache_folder: str
+        :type max_disk_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.cache_folder = cache_folder
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if cache_folder is not None:
+            if not os.path.exists(cache_folder):
+                os.makedirs(cache_folder)
+            # Index existing files, oldest first
+            # (temporary files start with '.')
+            files = []
+            for name in os.listdir(cache_folder):
+                key, extension = os.path.splitext(name)
+                if name.startswith(".") or extension not in [
+                        COMPACT_EXTENSION, FLOAT_EXTENSION]:
+                    continue
+                filepath = os.path.join(cache_folder, name)
+                stat = os.stat(filepath)
+                files.append((stat.st_mtime, key, name, stat.st_size))
+            for _, key, name, size in sorted(files):
+                self._disk[key] = (name, size)
+                self._disk_bytes += size
+
+    @staticmethod
+    def key(left_img, right_img, params=None):
+        """
+        Get cache key for image pair and matcher parameters
+        :param left_img: left image
+        :param right_img: right image
+        :param params: dictionary of matcher parameters
+        :rtype: str
+        """
+        h = hashlib.blake2b(digest_size=20)
+        for img in [left_img, right_img]:
+            img = np.ascontiguousarray(img)
+            h.update("{}{}".format(img.shape, img.dtype.str).encode())
+            h.update(memoryview(img).cast("B"))
+        if params:
+            h.update(repr(sorted(
+                (str(k), str(v)) for k, v in params.items())).encode())
+        return h.hexdigest()
+
+    def _disk_filepath(self, name):
+        return os.path.join(self.cache_folder, name)
+
+    def _read_disk(self, name):
+        # Read disparity from disk tier file
+        # Returns None if file is missing or corrupt
+        import zipfile
+        filepath = self._disk_filepath(name)
+        if name.endswith(COMPACT_EXTENSION):
+            disp = compact.read_compact(filepath)
+            return None if disp is None else compact.from_compact(disp)
+        try:
+            with np.load(filepath) as data:
+                return data["disparity"]
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            return None
+
+    def _write_disk(self, key, disp):
+        # Write disparity to disk tier file
+        # (as compact disparity if conversion is lossless)
+        # Returns filename (or None if write failed)
+        lossless = False
+        if disp.dtype == np.float32 and disp.ndim == 2:
+            try:
+                compact_disp = compact.to_compact(disp)
+                lossless = np.array_equal(
+                    compact.from_compact(compact_disp), disp)
+            except ValueError:
+                pass
+        extension = COMPACT_EXTENSION if lossless else FLOAT_EXTENSION
+        # Write to temporary file then rename so
+        # partially written files are never read
+        fd, tmp_filepath = tempfile.mkstemp(
+            prefix=".", suffix=extension, dir=self.cache_folder)
+        try:
+            if lossless:
+                os.close(fd)
+                if not compact.write_compact(tmp_filepath, compact_disp):
+                    raise OSError("Failed to write compact disparity")
+            else:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez_compressed(f, disparity=disp)
+            os.replace(tmp_filepath, self._disk_filepath(key+extension))
+        except OSError:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            return None
+        return key+extension
+
+    def _put_memory(self, key, disp):
+        # Add disparity to memory tier (lock must be held)
+        if disp.nbytes > self.max_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key).nbytes
+        self._memory[key] = disp
+        self._memory_bytes += disp.nbytes
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def get(self, key):
+        """
+        Get cached disparity
+        :return: copy of disparity (or None if not in cache)
+        :rtype: numpy
+        """
+        with self._lock:
+            disp = self._memory.get(key)
+            if disp is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return disp.copy()
+            entry = self._disk.get(key)
+        if entry is not None:
+            disp = self._read_disk(entry[0])
+            if disp is not None:
+                with self._lock:
+                    if key in self._disk:
+                        self._disk.move_to_end(key)
+                    self._put_memory(key, disp)
+                    self.hits += 1
+                    self.disk_hits += 1
+                return disp.copy()
+            # Missing or corrupt file is removed from disk tier
+            with self._lock:
+                if self._disk.get(key) == entry:
+                    del self._disk[key]
+                    self._disk_bytes -= entry[1]
+            try:
+                os.remove(self._disk_filepath(entry[0]))
+            except OSError:
+                pass
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, disp):
+        """
+        Add disparity to cache
+        :param key: cache key (see 'key')
+        :param disp: disparity image
+        """
+        disp = np.array(disp, copy=True)
+        with self._lock:
+            self._put_memory(key, disp)
+            if self.cache_folder is None or key in self._disk:
+                return
+        name = self._write_disk(key, disp)
+        if name is None:
+            return
+        size = os.path.getsize(self._disk_filepath(name))
+        with self._lock:
+            self._disk[key] = (name, size)
+            self._disk_bytes += size
+            evict = []
+            if self.max_disk_bytes is not None:
+                while self._disk_bytes > self.max_disk_bytes and \
+                        len(self._disk) > 1:
+                    _, (evicted, evicted_size) = self._disk.popitem(
+                        last=False)
+                    self._disk_bytes -= evicted_size
+                    self.disk_evictions += 1
+                    evict.append(evicted)
+        for evicted in evict:
+            try:
+                os.remove(self._disk_filepath(evicted))
+            except OSError:
+                pass
+
+    def clear(self):
+        # Remove all entries from memory tier
+        # (disk tier files are kept)
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+    def stats(self):
+        """
+        Get cache metrics
+        :return:
+            dictionary of hits, misses, hit_rate, evictions and
+            number of entries/bytes in memory and disk tiers
+        :rtype: dict
+        """
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
@@ -0,0 +1,183 @@
+"""
+I3DRSGM stereo calibration
+
+This module is for loading stereo calibrations and rectifying images
+before stereo matching.
+"""
+import threading
+import numpy as np
+from .lazy import LazyModule
+
+# OpenCV is imported on first use to keep package import fast
+cv2 = LazyModule("cv2")
+
+
+class StereoCalibration:
+    """
+    Stereo calibration loaded from left and right OpenCV YAML files
+    (e.g. sample_data/sim_left.yaml, sample_data/sim_right.yaml).
+    Rectification maps are calculated once for each image size
+    as fixed-point maps so each pair is rectified with a single remap.
+    """
+    def __init__(self, left_cal_file=None, right_cal_file=None,
+                 interpolation=None):
+        """
+        :param left_cal_file: left camera calibration yaml
+        :param right_cal_file: right camera calibration yaml
+        :param interpolation:
+            opencv interpolation used when rectifying
+            (default: cv2.INTER_CUBIC)
+        :type left_cal_file: str
+        :type right_cal_file: str
+        :type interpolation: int
+        """
+        if interpolation is None:
+            interpolation = cv2.INTER_CUBIC
+        self.interpolation = interpolation
+        self.left = None
+        self.right = None
+        self.image_size = None
+        self.Q = None
+        self._maps = {}
+        self._maps_lock = threading.Lock()
+        if left_cal_file is not None and right_cal_file is not None:
+            if not self.load_yaml(left_cal_file, right_cal_file):
+                raise IOError("Failed to open calibration files")
+
+    @staticmethod
+    def _read_camera_yaml(cal_file):
+        # Read camera calibration from OpenCV yaml
+        # Returns None if file could not be read
+        fs = cv2.FileStorage(cal_file, cv2.FILE_STORAGE_READ)
+        if not fs.isOpened():
+            return None
+        try:
+            cal = {}
+            for key, node in [
+                    ("m", "camera_matrix"),
+                    ("d", "distortion_coefficients"),
+                    ("r", "rectification_matrix"),
+                    ("p", "projection_matrix")]:
+                mat = fs.getNode(node).mat()
+                if mat is None:
+                    return None
+                cal[key] = mat.astype(np.float64)
+            width = fs.getNode("image_width").real()
+            height = fs.getNode("image_height").real()
+            cal["image_size"] = (int(width), int(height))
+            return cal
+        finally:
+            fs.release()
+
+    def load_yaml(self, left_cal_file, right_cal_file):
+        """
+        Load calibration from left and right OpenCV yaml files
+        :return: True if calibration was loaded successfully
+        :rtype: bool
+        """
+        left = self._read_camera_yaml(left_cal_file)
+        right = self._read_camera_yaml(right_cal_file)
+        if left is None or right is None:
+            print("Failed to open calibration files")
+            return False
+        self.left = left
+        self.right = right
+        self.image_size = left["image_size"]
+        self.Q = self.calc_q(left["m"], right["p"], left["p"])
+        with self._maps_lock:
+            self._maps.clear()
+        return True
+
+    @staticmethod
+    def calc_q(m_l, p_r, p_l):
+        """
+        Calculate Q matrix from camera and projection matrices
+        :param m_l: left camera matrix
+        :param p_r: right projection matrix
+        :param p_l: left projection matrix
+        :rtype: numpy
+        """
+        cx = p_l[0, 2]
+        cxr = p_r[0, 2]
+        cy = p_l[1, 2]
+        fx = m_l[0, 0]
+        # Baseline
+        T = -p_r[0, 3] / fx
+
+        q = np.zeros((4, 4))
+        q[0, 0] = 1.0
+        q[0, 3] = -cx
+        q[1, 1] = 1.0
+        q[1, 3] = -cy
+        q[2, 3] = fx
+        q[3, 2] = 1.0 / T
+        q[3, 3] = -(cx - cxr) / T
+        return q
+
+    def _scaled(self, cal, image_size):
+        # Scale camera and projection matrices to image size
+        sx = image_size[0] / float(self.image_size[0])
+        sy = image_size[1] / float(self.image_size[1])
+        scale = np.array([[sx], [sy], [1.0]])
+        return cal["m"] * scale, cal["p"] * scale
+
+    def rectification_maps(self, image_size):
+        """
+        Get fixed-point rectification maps for image size.
+        Maps are calculated the first time an image size is used
+        and cached for following calls.
+        :param image_size: (width, height) of images to rectify
+        :return: ((left map1, left map2), (right map1, right map2))
+        """
+        if self.left is None:
+            raise ValueError("Calibration has not been loaded")
+        image_size = (int(image_size[0]), int(image_size[1]))
+        with self._maps_lock:
+            maps = self._maps.get(image_size)
+            if maps is None:
+                maps = []
+                for cal in [self.left, self.right]:
+                    m, p = self._scaled(cal, image_size)
+                    maps.append(cv2.initUndistortRectifyMap(
+                        m, cal["d"], cal["r"], p, image_size, cv2.CV_16SC2))
+                maps = tuple(maps)
+                self._maps[image_size] = maps
+        return maps
+
+    def q_for_size(self, image_size):
+        """
+        Get Q matrix for images of a different size to the calibration
+        :param image_size: (width, height) of rectified images
+        :rtype: numpy
+        """
+        if self.left is None:
+            raise ValueError("Calibration has not been loaded")
+        m_l, p_l = self._scaled(self.left, image_size)
+        _, p_r = self._scaled(self.right, image_size)
+        return self.calc_q(m_l, p_r, p_l)
+
+    def prepare(self, image_size=None):
+        # Calculate rectification maps before the first frame
+        # (default: calibration image size)
+        if image_size is None:
+            image_size = self.image_size
+        self.rectification_maps(image_size)
+
+    def rectify(self, image, maps, out=None):
+        # Rectify image using rectification maps
+        map1, map2 = maps
+        return cv2.remap(
+            image, map1, map2, self.interpolation, dst=out,
+            borderMode=cv2.BORDER_CONSTANT)
+
+    def rectify_pair(self, left_img, right_img):
+        """
+        Rectify stereo image pair
+        :param left_img: left image
+        :param right_img: right image
+        :return: (left rectified image, right rectified image)
+        """
+        image_size = (left_img.shape[1], left_img.shape[0])
+        left_maps, right_maps = self.rectification_maps(image_size)
+        return (self.rectify(left_img, left_maps),
+                self.rectify(right_img, right_maps))
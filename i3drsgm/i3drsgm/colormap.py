@@ -0,0 +1,145 @@
+"""
+I3DRSGM colormap rendering
+
+This module is for rendering streams of disparity images with a
+colormap over a fixed disparity (or depth) range so colors are stable
+between frames.
+"""
+import numpy as np
+from .lazy import LazyModule
+from . import compact
+from .metrics import metrics
+
+# OpenCV is imported on first use to keep package import fast
+cv2 = LazyModule("cv2")
+
+
+class ColormapRenderer:
+    """
+    Colormap renderer configured once with a fixed range.
+    Disparity is quantised to 1/16 pixel (see i3drsgm.compact) and
+    every possible quantised value is mapped to a color in a lookup
+    table when the renderer is created. Rendering a frame is then a
+    single lookup per pixel that also sets invalid pixels to black.
+    Scratch and output buffers are re-used between frames of the same
+    size so an instance should not be shared between threads.
+
+    Example:
+        renderer = ColormapRenderer(disparity_range=(10, 200))
+        for valid, disp in i3drsgm.forwardMatchStream(pairs):
+            cv2.imshow("disparity", renderer.render(disp))
+    """
+    def __init__(self, disparity_range=None, depth_range=None, Q=None,
+                 colormap=None):
+        """
+        :param disparity_range:
+            (min, max) positive disparity mapped to the colormap
+        :param depth_range:
+            (min, max) depth mapped to the colormap
+            (use instead of disparity_range, requires Q)
+        :param Q:
+            Q matrix from stereo calibration. When given, pixels behind
+            the camera are invalid (see StereoSupport.valid_disparity_mask)
+        :param colormap: opencv colormap (default: cv2.COLORMAP_JET)
+        :type disparity_range: tuple
+        :type depth_range: tuple
+        :type Q: numpy
+        :type colormap: int
+        """
+        if (disparity_range is None) == (depth_range is None):
+            raise ValueError(
+                "Set one of disparity_range or depth_range")
+        if depth_range is not None and Q is None:
+            raise ValueError("Q is required for depth_range")
+        if colormap is None:
+            colormap = cv2.COLORMAP_JET
+        self.disparity_range = disparity_range
+        self.depth_range = depth_range
+        self.Q = None if Q is None else np.asarray(Q, np.float64)
+        self.colormap = colormap
+        self.lut = self._lookup_table()
+        self._shape = None
+        self._scaled = None
+        self._index = None
+        self._valid = None
+        self._invalid = None
+        self._out = None
+
+    def _lookup_table(self):
+        # Color of every compact disparity value
+        # indexed by the value viewed as uint16
+        values = np.arange(65536, dtype=np.uint32).astype(np.uint16)
+        values = values.view(compact.COMPACT_DTYPE)
+        disparity = values.astype(np.float64) / compact.COMPACT_SCALE
+        invalid = values == compact.COMPACT_INVALID
+        if self.Q is not None:
+            w = disparity * self.Q[3, 2] + self.Q[3, 3]
+            invalid |= w <= 0
+        if self.depth_range is None:
+            value = disparity
+            min_value, max_value = self.disparity_range
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                value = self.Q[2, 3] / w
+            min_value, max_value = self.depth_range
+        if max_value == min_value:
+            raise ValueError("Range must not be empty")
+        scaled = (value - min_value) / (max_value - min_value)
+        scaled = np.nan_to_num(np.clip(scaled, 0.0, 1.0))
+        gray = np.rint(scaled * 255).astype(np.uint8).reshape(-1, 1)
+        lut = cv2.applyColorMap(gray, self.colormap).reshape(-1, 3)
+        lut[invalid] = 0
+        return lut
+
+    def _allocate(self, shape):
+        # Allocate scratch and output buffers (only when size changes)
+        if self._shape != shape:
+            self._shape = shape
+            self._scaled = np.empty(shape, np.float32)
+            self._index = np.empty(shape, compact.COMPACT_DTYPE)
+            self._valid = np.empty(shape, np.bool_)
+            self._invalid = np.empty(shape, np.bool_)
+            self._out = np.empty(shape + (3,), np.uint8)
+
+    def render(self, disp, out=None):
+        """
+        Render disparity image with colormap
+        :param disp: disparity image from I3DRSGM (or compact disparity)
+        :param out:
+            optional uint8 array of shape (rows, cols, 3) to write the
+            result into (default: buffer re-used between frames)
+        :type disp: numpy
+        :type out: numpy
+        :return: BGR image of shape (rows, cols, 3)
+        """
+        shape = disp.shape[:2]
+        self._allocate(shape)
+        if out is None:
+            out = self._out
+        elif out.shape != shape + (3,) or out.dtype != np.uint8:
+            raise ValueError(
+                "out must be uint8 with shape {}".format(shape + (3,)))
+        with metrics.timer("colormap_renderer"):
+            if compact.is_compact(disp):
+                index = disp
+            else:
+                # Quantise float disparity to compact disparity
+                scaled = self._scaled
+                np.multiply(disp, np.float32(-compact.COMPACT_SCALE),
+                            out=scaled, casting='unsafe')
+                np.rint(scaled, out=scaled)
+                # Invalid (-99999), non-finite and out of compact range
+                # disparities are rendered as invalid
+                # (comparisons with NaN are False)
+                valid, invalid = self._valid, self._invalid
+                np.greater_equal(scaled, compact.COMPACT_MIN, out=valid)
+                np.less_equal(scaled, compact.COMPACT_MAX, out=invalid)
+                valid &= invalid
+                np.not_equal(disp, compact.INVALID_DISPARITY, out=invalid)
+                valid &= invalid
+                np.logical_not(valid, out=invalid)
+                np.copyto(scaled, compact.COMPACT_INVALID, where=invalid)
+                index = self._index
+                np.copyto(index, scaled, casting='unsafe')
+            np.take(self.lut, index.view(np.uint16), axis=0, out=out)
+        return out
@@ -0,0 +1,134 @@
+"""
+I3DRSGM compact disparity
+
+This module is for storing I3DRSGM disparity as int16 fixed-point
+values (half the size of float32 disparity).
+Compact disparity uses the same layout as OpenCV StereoSGBM output:
+positive disparity multiplied by 16 (1/16 pixel precision).
+Invalid disparities are stored as COMPACT_INVALID.
+Compact disparity can be used directly in StereoSupport functions
+and DisparityProcessor.
+"""
+import numpy as np
+from .lazy import LazyModule
+
+# OpenCV is imported on first use to keep package import fast
+cv2 = LazyModule("cv2")
+
+# Data type of compact disparity
+COMPACT_DTYPE = np.dtype(np.int16)
+# Compact disparity is disparity multiplied by COMPACT_SCALE
+COMPACT_SCALE = 16
+# Value reserved for invalid disparities
+COMPACT_INVALID = np.iinfo(np.int16).min
+# Range of valid compact disparity values
+COMPACT_MIN = COMPACT_INVALID + 1
+COMPACT_MAX = np.iinfo(np.int16).max
+# Disparity value used by I3DRSGM to signify an invalid disparity
+INVALID_DISPARITY = -99999
+
+
+def is_compact(disp):
+    # Check if disparity image is compact disparity
+    return disp.dtype == COMPACT_DTYPE
+
+
+def to_compact(disp, out_of_range="raise"):
+    """
+    Convert I3DRSGM disparity to compact disparity.
+    Disparities are rounded to the nearest 1/16 pixel so conversion is
+    lossless for disparity with 1/16 pixel (or coarser) precision.
+    Non-finite disparities (NaN, inf) are stored as invalid.
+    :param disp: disparity image from I3DRSGM (negative, -99999 invalid)
+    :param out_of_range:
+        'raise' to raise ValueError for disparity outside the compact
+        range (+/-2047.9375 pixels) or 'invalid' to store it as invalid
+    :type disp: numpy
+    :type out_of_range: str
+    :return: int16 compact disparity
+    :rtype: numpy
+    :raises ValueError:
+        if disparity is outside the compact range
+        (and out_of_range is 'raise')
+    """
+    if out_of_range not in ["raise", "invalid"]:
+        raise ValueError(
+            "Invalid out_of_range: {}".format(out_of_range))
+    if is_compact(disp):
+        return disp
+    invalid = disp == INVALID_DISPARITY
+    invalid |= ~np.isfinite(disp)
+    scaled = np.multiply(disp, np.float32(-COMPACT_SCALE), dtype=np.float32)
+    np.rint(scaled, out=scaled)
+    scaled[invalid] = 0
+    outside = (scaled < COMPACT_MIN) | (scaled > COMPACT_MAX)
+    if outside.any():
+        if out_of_range == "raise":
+            raise ValueError(
+                "Disparity outside of compact disparity range")
+        invalid |= outside
+        scaled[outside] = 0
+    compact = scaled.astype(COMPACT_DTYPE)
+    compact[invalid] = COMPACT_INVALID
+    return compact
+
+
+def from_compact(compact, out=None):
+    """
+    Convert compact disparity back to I3DRSGM disparity
+    :param compact: int16 compact disparity
+    :param out: optional float32 array to write the result into
+    :type compact: numpy
+    :type out: numpy
+    :return: float32 disparity (negative, -99999 invalid)
+    :rtype: numpy
+    """
+    disp = np.multiply(
+        compact, np.float32(-1.0 / COMPACT_SCALE), out=out,
+        dtype=np.float32)
+    disp[compact == COMPACT_INVALID] = INVALID_DISPARITY
+    return disp
+
+
+def positive_disparity(disp):
+    """
+    Get positive float32 disparity from I3DRSGM or compact disparity
+    (invalid values are not converted)
+    :rtype: numpy
+    """
+    if is_compact(disp):
+        return np.multiply(
+            disp, np.float32(1.0 / COMPACT_SCALE), dtype=np.float32)
+    return np.negative(disp, dtype=np.float32)
+
+
+def invalid_mask(disp):
+    # Get mask of disparities marked as invalid by I3DRSGM
+    if is_compact(disp):
+        return disp == COMPACT_INVALID
+    return disp == INVALID_DISPARITY
+
+
+def write_compact(filepath, disp):
+    """
+    Write disparity to 16-bit PNG as compact disparity.
+    Compressed and lossless so is suited to archiving sequences.
+    :param filepath: output PNG filepath
+    :param disp: I3DRSGM or compact disparity
+    :return: True if image was written successfully
+    :rtype: bool
+    """
+    compact = np.ascontiguousarray(to_compact(disp))
+    return cv2.imwrite(filepath, compact.view(np.uint16))
+
+
+def read_compact(filepath):
+    """
+    Read compact disparity written with 'write_compact'
+    :return: int16 compact disparity (or None if read failed)
+    :rtype: numpy
+    """
+    img = cv2.imread(filepath, cv2.IMREAD_UNCHANGED)
+    if img is None or img.dtype != np.uint16:
+        return None
+    return img.view(COMPACT_DTYPE)
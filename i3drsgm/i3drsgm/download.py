@@ -0,0 +1,343 @@
+"""
+I3DRSGM app download
+
+This module is for installing I3DRSGMApp from the i3drsgm github releases.
+Release zips are downloaded into a local artifact cache
+(see 'cache_folder') and verified with a sha256 checksum before being
+extracted, so machines sharing a populated cache never download.
+Release zips without a known checksum are refused unless unverified
+downloads are allowed (see 'fetch_release').
+It only depends on the standard library so it can be used
+by setup.py without importing the i3drsgm package.
+"""
+import os
+import sys
+import shutil
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_APP_VERSION = "1.0.10"
+DEFAULT_RELEASE_URL = "https://github.com/i3drobotics/i3drsgm/releases/download"
+# Environment variable used to set the artifact cache folder
+CACHE_ENV = "I3DRSGM_APP_CACHE"
+# Environment variable used to set the release server url
+# (e.g. a file:// url of a local mirror)
+RELEASE_URL_ENV = "I3DRSGM_RELEASE_URL"
+# Environment variable used to set the expected sha256 of the release zip
+SHA256_ENV = "I3DRSGM_APP_SHA256"
+# Environment variable used to allow release zips without a known
+# checksum (set to 1)
+ALLOW_UNVERIFIED_ENV = "I3DRSGM_ALLOW_UNVERIFIED"
+# Pinned sha256 of each I3DRSGMApp release zip
+# (github releases do not publish checksum files).
+# Add an entry when a release is verified, e.g. with:
+#   python -c "from i3drsgm import download; print(download.file_sha256(
+#       download.fetch_release('<version>')))"
+APP_SHA256 = {
+}
+# Size of blocks read when downloading and hashing files (bytes)
+BLOCK_SIZE = 1 << 20
+# Timeout of release server requests (seconds)
+TIMEOUT = 60
+
+
+def package_folder():
+    # Get folder of i3drsgm package in python install
+    return os.path.dirname(os.path.realpath(__file__))
+
+
+def app_folder(install_folder=None):
+    # Get folder I3DRSGMApp is installed to
+    # (default install folder: i3drsgm package folder)
+    if install_folder is None:
+        install_folder = package_folder()
+    return os.path.join(install_folder, "i3drsgm_app")
+
+
+def app_path(install_folder=None):
+    # Get path to I3DRSGMApp in python install
+    return os.path.join(app_folder(install_folder), "I3DRSGMApp.exe")
+
+
+def cache_folder():
+    # Get artifact cache folder
+    # (set with I3DRSGM_APP_CACHE, default: ~/.cache/i3drsgm)
+    folder = os.environ.get(CACHE_ENV)
+    if folder:
+        return folder
+    return os.path.join(os.path.expanduser("~"), ".cache", "i3drsgm")
+
+
+def release_filename(app_version):
+    # Get filename of I3DRSGMApp release zip
+    return "i3drsgm-{}-app.zip".format(app_version)
+
+
+def release_url(app_version, base_url=None):
+    # Get release url of I3DRSGMApp zip
+    # (default base url: I3DRSGM_RELEASE_URL or github releases)
+    if base_url is None:
+        base_url = os.environ.get(RELEASE_URL_ENV, DEFAULT_RELEASE_URL)
+    return "{}/v{}/{}".format(
+        base_url.rstrip("/"), app_version, release_filename(app_version))
+
+
+def bar_progress(current, total, *_):
+    """
+    Progress bar to display download progress
+
+    Parameters:
+        current (int): current byte count
+        total (int): total number of bytes
+        *_: ignored (for compatibility with wget progress bars)
+    """
+    base_progress_msg = "Downloading: %d%% [%d / %d] bytes"
+    progress_message = base_progress_msg % (
+        current / total * 100, current, total)
+    # Don't use print() as it will print in new line every time.
+    sys.stdout.write("\r" + progress_message)
+    sys.stdout.flush()
+
+
+def file_sha256(filepath):
+    # Calculate sha256 hex digest of file
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _read_checksum(filepath):
+    # Read sha256 from checksum file ('<sha256>  <filename>' format)
+    # Returns None if file does not exist
+    if not os.path.isfile(filepath):
+        return None
+    with open(filepath, "r") as f:
+        fields = f.read().split()
+    return fields[0].lower() if fields else None
+
+
+def _write_checksum(filepath, sha256, filename):
+    # Write sha256 checksum file (via a temporary file)
+    tmp_filepath = filepath + ".partial"
+    with open(tmp_filepath, "w") as f:
+        f.write("{}  {}\n".format(sha256, filename))
+    os.replace(tmp_filepath, filepath)
+
+
+def _fetch_checksum(url):
+    # Get sha256 published next to release url ('<url>.sha256')
+    # Returns None if there is no checksum file
+    import urllib.request
+    import urllib.error
+    try:
+        with urllib.request.urlopen(
+                url + ".sha256", timeout=TIMEOUT) as response:
+            fields = response.read().decode("ascii").split()
+    except (urllib.error.URLError, IOError, ValueError):
+        return None
+    return fields[0].lower() if fields else None
+
+
+def _download(url, filepath, progress=bar_progress):
+    # Download url to filepath, resuming a previous partial download
+    # if the server supports range requests
+    import urllib.request
+    start = 0
+    if os.path.isfile(filepath):
+        start = os.path.getsize(filepath)
+    request = urllib.request.Request(url)
+    if start > 0:
+        request.add_header("Range", "bytes={}-".format(start))
+    with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+        if start > 0 and getattr(response, "status", None) != 206:
+            # Server sent the whole file
+            start = 0
+        length = response.headers.get("Content-Length")
+        total = start + int(length) if length else None
+        current = start
+        with open(filepath, "ab" if start > 0 else "wb") as f:
+            for block in iter(lambda: response.read(BLOCK_SIZE), b""):
+                f.write(block)
+                current += len(block)
+                if progress is not None and total:
+                    progress(current, total)
+    if progress is not None and total:
+        sys.stdout.write("\n")
+
+
+def _unverified(description, allow_unverified):
+    # Handle release zip without a known checksum
+    msg = "No checksum known for {} so it can not be verified".format(
+        description)
+    if not allow_unverified:
+        raise IOError(
+            "{} (set a checksum with {} or allow unverified releases "
+            "with {}=1)".format(msg, SHA256_ENV, ALLOW_UNVERIFIED_ENV))
+    logger.warning("%s (unverified releases are allowed)", msg)
+
+
+def fetch_release(app_version=DEFAULT_APP_VERSION, cache=None,
+                  base_url=None, sha256=None, progress=bar_progress,
+                  allow_unverified=None):
+    """
+    Get verified I3DRSGMApp release zip from the artifact cache,
+    downloading it into the cache if it is not already there.
+    The expected checksum is sha256 (or I3DRSGM_APP_SHA256), then the
+    pinned checksum of the version (APP_SHA256), then
+    '<release url>.sha256' if published, then the checksum recorded
+    when the zip was first added to the cache.
+    Without any of these the release can not be verified and IOError is
+    raised, unless allow_unverified is set (the zip is then used with a
+    warning and it's checksum is not recorded).
+    :param app_version: version of I3DRSGMApp release
+    :param cache: artifact cache folder (default: see 'cache_folder')
+    :param base_url: release server url (default: see 'release_url')
+    :param sha256: expected sha256 hex digest of release zip
+    :param progress: function(current, total) to show download progress
+    :param allow_unverified:
+        allow release zips without a known checksum
+        (default: I3DRSGM_ALLOW_UNVERIFIED)
+    :type app_version: str
+    :type cache: str
+    :type base_url: str
+    :type sha256: str
+    :type allow_unverified: bool
+    :return: filepath of release zip in cache
+    :rtype: str
+    :raises IOError:
+        if the release zip does not match the checksum
+        (or has no known checksum and allow_unverified is not set)
+    """
+    if cache is None:
+        cache = cache_folder()
+    if sha256 is None:
+        sha256 = os.environ.get(SHA256_ENV)
+    if sha256 is None:
+        sha256 = APP_SHA256.get(app_version)
+    if sha256 is not None:
+        sha256 = sha256.lower()
+    if allow_unverified is None:
+        allow_unverified = os.environ.get(ALLOW_UNVERIFIED_ENV, "") in [
+            "1", "true", "yes"]
+    if not os.path.exists(cache):
+        os.makedirs(cache)
+    filename = release_filename(app_version)
+    zip_filepath = os.path.join(cache, filename)
+    checksum_filepath = zip_filepath + ".sha256"
+
+    if os.path.isfile(zip_filepath):
+        expected = sha256 or _read_checksum(checksum_filepath)
+        actual = file_sha256(zip_filepath)
+        if expected is None:
+            # Zip was added to the cache by hand (or without verification)
+            _unverified(zip_filepath, allow_unverified)
+            return zip_filepath
+        if actual == expected:
+            return zip_filepath
+        # Corrupt (or outdated) cached zip is downloaded again
+        os.remove(zip_filepath)
+
+    url = release_url(app_version, base_url)
+    expected = sha256 or _fetch_checksum(url)
+    if expected is None:
+        _unverified(url, allow_unverified)
+    partial_filepath = zip_filepath + ".partial"
+    _download(url, partial_filepath, progress)
+    actual = file_sha256(partial_filepath)
+    if expected is not None and actual != expected:
+        os.remove(partial_filepath)
+        raise IOError(
+            "Checksum of {} does not match (expected {}, got {})".format(
+                url, expected, actual))
+    if expected is not None:
+        _write_checksum(checksum_filepath, actual, filename)
+    os.replace(partial_filepath, zip_filepath)
+    return zip_filepath
+
+
+def extract_app(zip_filepath, install_folder=None, replace=False):
+    """
+    Extract I3DRSGMApp release zip.
+    Files are extracted into a temporary folder that is renamed to the
+    install folder when complete, so an install is never left partly
+    extracted and other processes never see a partial install.
+    :param zip_filepath: I3DRSGMApp release zip
+    :param install_folder:
+        folder to install 'i3drsgm_app' into
+        (default: i3drsgm package folder)
+    :param replace: replace existing install
+    :type zip_filepath: str
+    :type install_folder: str
+    :type replace: bool
+    :return: path to I3DRSGMApp
+    :rtype: str
+    """
+    import zipfile
+    if install_folder is None:
+        install_folder = package_folder()
+    target_folder = app_folder(install_folder)
+    tmp_folder = tempfile.mkdtemp(prefix=".i3drsgm_app_", dir=install_folder)
+    try:
+        with zipfile.ZipFile(zip_filepath, "r") as zip_ref:
+            root = os.path.realpath(tmp_folder)
+            for name in zip_ref.namelist():
+                path = os.path.realpath(os.path.join(tmp_folder, name))
+                if os.path.commonpath([root, path]) != root:
+                    raise IOError(
+                        "Invalid path in release zip: {}".format(name))
+            zip_ref.extractall(tmp_folder)
+        extracted_folder = app_folder(tmp_folder)
+        if not os.path.isfile(app_path(tmp_folder)):
+            raise IOError("Release zip does not contain I3DRSGMApp")
+        old_folder = None
+        if os.path.exists(target_folder):
+            if not replace:
+                # Already installed (e.g. by another process)
+                return app_path(install_folder)
+            old_folder = os.path.join(tmp_folder, "old")
+            os.replace(target_folder, old_folder)
+        try:
+            os.replace(extracted_folder, target_folder)
+        except OSError:
+            if not os.path.exists(target_folder):
+                raise
+            # Another process finished installing first
+    finally:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+    return app_path(install_folder)
+
+
+def provision(app_version=DEFAULT_APP_VERSION, cache=None, base_url=None,
+              sha256=None, install_folder=None, replace=False,
+              progress=bar_progress, allow_unverified=None):
+    """
+    Install I3DRSGMApp from the artifact cache (see 'fetch_release')
+    if it is not already installed.
+    Run before starting workers (e.g. 'python -m i3drsgm provision')
+    so the app is never downloaded when the first frame is matched.
+    (see 'fetch_release' and 'extract_app' for parameters)
+    :return: path to I3DRSGMApp
+    :rtype: str
+    """
+    if os.path.exists(app_folder(install_folder)) and not replace:
+        return app_path(install_folder)
+    zip_filepath = fetch_release(
+        app_version, cache, base_url, sha256, progress, allow_unverified)
+    return extract_app(zip_filepath, install_folder, replace)
+
+
+def download_app(app_version=DEFAULT_APP_VERSION, replace=False):
+    """
+    Download I3DRSGMApp if it is not already installed
+    (see 'provision')
+    :param app_version: version of I3DRSGMApp release
+    :param replace: replace existing install
+    :type app_version: str
+    :type replace: bool
+    """
+    provision(app_version, replace=replace)
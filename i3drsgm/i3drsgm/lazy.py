@@ -0,0 +1,41 @@
+"""
+I3DRSGM lazy imports
+
+This module is for deferring imports of heavy dependencies (e.g. OpenCV)
+until they are first used so 'import i3drsgm' stays fast.
+"""
+import types
+import importlib
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module placeholder that imports the real module on first
+    attribute access, e.g.
+        cv2 = LazyModule("cv2")
+        cv2.imread(...)  # OpenCV is imported here
+    After the first access attributes are read directly from
+    the placeholder so there is no overhead per call.
+    """
+    def __init__(self, name):
+        """
+        :param name: name of module to import
+        :type name: str
+        """
+        super().__init__(name)
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self):
+        # Import module and copy it's attributes to this placeholder
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update(module.__dict__)
+            self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
@@ -0,0 +1,196 @@
+"""
+I3DRSGM metrics
+
+This module is for recording time spent in each stage of processing.
+Timings are only recorded while at least one sink is added, e.g.
+    from i3drsgm import metrics, HistogramSink
+    histogram = HistogramSink()
+    metrics.add_sink(histogram)
+    ...
+    print(histogram.prometheus_text())
+"""
+import time
+import threading
+
+
+class _NullTimer:
+    """Timer used when there are no sinks (does nothing)"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    """Timer that records elapsed time of a stage to metrics sinks"""
+    __slots__ = ("_metrics", "_stage", "_start")
+
+    def __init__(self, metrics, stage):
+        self._metrics = metrics
+        self._stage = stage
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._metrics.record(self._stage, time.perf_counter() - self._start)
+        return False
+
+
+class Metrics:
+    """Registry of sinks that stage timings are sent to"""
+    def __init__(self):
+        self._sinks = ()
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        """
+        Add sink to receive stage timings
+        :param sink:
+            object with 'record(stage, seconds)' method
+            (e.g. HistogramSink) or function(stage, seconds)
+        """
+        if not hasattr(sink, "record"):
+            sink = CallbackSink(sink)
+        with self._lock:
+            self._sinks = self._sinks + (sink,)
+        return sink
+
+    def remove_sink(self, sink):
+        # Remove sink added with 'add_sink'
+        with self._lock:
+            self._sinks = tuple(
+                s for s in self._sinks
+                if s is not sink and getattr(s, "callback", None) is not sink)
+
+    def clear_sinks(self):
+        # Remove all sinks
+        with self._lock:
+            self._sinks = ()
+
+    @property
+    def enabled(self):
+        # Check if any sinks are added
+        return len(self._sinks) > 0
+
+    def timer(self, stage):
+        """
+        Context manager that records time spent in stage
+        :param stage: name of stage (e.g. 'forward_match.ipc')
+        """
+        if not self._sinks:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def record(self, stage, seconds):
+        # Send stage timing to all sinks
+        for sink in self._sinks:
+            sink.record(stage, seconds)
+
+
+class CallbackSink:
+    """Sink that calls a function for each stage timing"""
+    def __init__(self, callback):
+        """
+        :param callback: function(stage, seconds)
+        """
+        self.callback = callback
+
+    def record(self, stage, seconds):
+        self.callback(stage, seconds)
+
+
+class HistogramSink:
+    """In-memory histogram of stage timings"""
+    # Default histogram bucket upper bounds in seconds
+    DEFAULT_BUCKETS = (
+        0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: histogram bucket upper bounds in seconds
+        :type buckets: list
+        """
+        self.buckets = tuple(sorted(buckets))
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = {
+                    "count": 0, "sum": 0.0,
+                    "min": float("inf"), "max": 0.0,
+                    "buckets": [0] * len(self.buckets)}
+                self._stages[stage] = stats
+            stats["count"] += 1
+            stats["sum"] += seconds
+            stats["min"] = min(stats["min"], seconds)
+            stats["max"] = max(stats["max"], seconds)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    stats["buckets"][i] += 1
+                    break
+
+    def reset(self):
+        # Remove all recorded timings
+        with self._lock:
+            self._stages.clear()
+
+    def stats(self):
+        """
+        Get summary of recorded timings
+        :return: {stage: {count, sum, mean, min, max}} (seconds)
+        :rtype: dict
+        """
+        with self._lock:
+            summary = {}
+            for stage, stats in self._stages.items():
+                summary[stage] = {
+                    "count": stats["count"],
+                    "sum": stats["sum"],
+                    "mean": stats["sum"] / stats["count"],
+                    "min": stats["min"],
+                    "max": stats["max"],
+                }
+            return summary
+
+    def prometheus_text(self, name="i3drsgm_stage_seconds"):
+        """
+        Get recorded timings in Prometheus text exposition format
+        :param name: metric name
+        :rtype: str
+        """
+        lines = [
+            "# HELP {} Time spent in i3drsgm processing stages".format(name),
+            "# TYPE {} histogram".format(name)]
+        with self._lock:
+            for stage in sorted(self._stages.keys()):
+                stats = self._stages[stage]
+                label = 'stage="{}"'.format(stage)
+                cumulative = 0
+                for bound, count in zip(self.buckets, stats["buckets"]):
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        name, label, repr(float(bound)), cumulative))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                    name, label, stats["count"]))
+                lines.append("{}_sum{{{}}} {}".format(
+                    name, label, repr(stats["sum"])))
+                lines.append("{}_count{{{}}} {}".format(
+                    name, label, stats["count"]))
+        return "\n".join(lines) + "\n"
+
+
+# Default metrics registry used by i3drsgm module
+metrics = Metrics()
@@ -0,0 +1,199 @@
+"""
+I3DRSGM worker pool
+
+This module is for running several I3DRSGMApp processes in parallel.
+"""
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from . import I3DRSGM
+from .tiling import match_tiled
+
+
+class I3DRSGMPool:
+    """
+    Pool of I3DRSGM instances each with it's own I3DRSGMApp process.
+    Matches are dispatched to whichever instance is idle.
+    Parameter changes are sent to all instances.
+    """
+    def __init__(self, num_workers=2, license_file=None,
+                 app_cmd=None, tmp_root=None, transport="png", cache=None,
+                 request_timeout=None, warmup_size=None, compact=False):
+        """
+        :param num_workers: number of I3DRSGMApp processes to start
+        :param license_file: path to I3DRSGM license file
+        :param app_cmd:
+            command to start alternative app using the same API
+            (default: I3DRSGMApp)
+        :param tmp_root:
+            folder to create worker scratch folders in
+            (see I3DRSGMAppAPI.session_tmp_root)
+        :param transport:
+            file format used to pass images to I3DRSGMApp
+            (see i3drsgm.transport.TRANSPORTS)
+        :param cache: DisparityCache shared by all instances
+        :param request_timeout:
+            time in seconds before a worker app that is not responding
+            is restarted (see I3DRSGMAppAPI)
+        :param warmup_size:
+            (width, height) of match run by each worker on startup
+            so the first frames do not pay the startup cost
+        :param compact:
+            return int16 compact disparity (see i3drsgm.compact)
+        :type num_workers: int
+        :type license_file: str
+        :type app_cmd: list
+        :type tmp_root: str
+        :type transport: str
+        :type cache: DisparityCache
+        :type request_timeout: float
+        :type warmup_size: tuple
+        :type compact: bool
+        """
+        if num_workers < 1:
+            raise ValueError("num_workers must be at least 1")
+        self.num_workers = num_workers
+        self._idle = queue.Queue()
+        self._broadcast_lock = threading.Lock()
+
+        def start_worker(_):
+            # Each worker has it's own session scratch folder
+            return I3DRSGM(license_file, app_cmd=app_cmd, tmp_root=tmp_root,
+                           transport=transport, cache=cache,
+                           request_timeout=request_timeout,
+                           warmup_size=warmup_size, compact=compact)
+
+        # Start (and warm up) app processes in parallel
+        # to reduce startup time
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            self.workers = list(executor.map(
+                start_worker, range(num_workers)))
+        for worker in self.workers:
+            self._idle.put(worker)
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def isInit(self):
+        # Check all I3DRSGM instances have been initalised
+        return all(worker.isInit() for worker in self.workers)
+
+    def _forwardMatch(self, left_img, right_img, profile=None):
+        # Stereo match using the next idle I3DRSGM instance
+        worker = self._idle.get()
+        try:
+            return worker.forwardMatch(left_img, right_img, profile)
+        finally:
+            self._idle.put(worker)
+
+    def submit(self, left_img, right_img, profile=None):
+        """
+        Submit stereo match of a rectified image pair
+        :param profile:
+            profile name or parameters to use for this match
+            (see I3DRSGM.forwardMatch)
+        :return: future with result (valid, disparity)
+        :rtype: concurrent.futures.Future
+        """
+        return self._executor.submit(
+            self._forwardMatch, left_img, right_img, profile)
+
+    def forwardMatch(self, left_img, right_img, profile=None):
+        # Stereo matching using a left and right image
+        # (expects images to already by rectified)
+        return self.submit(left_img, right_img, profile).result()
+
+    def map(self, pairs, max_pending=None):
+        """
+        Stereo match an iterable of rectified image pairs
+        :param pairs: iterable of (left_img, right_img)
+        :param max_pending:
+            maximum number of pairs submitted at once
+            (default: twice the number of workers)
+        :return: generator of (valid, disparity) in the same order as pairs
+        """
+        if max_pending is None:
+            max_pending = 2 * self.num_workers
+        pending = deque()
+        for left_img, right_img in pairs:
+            pending.append(self.submit(left_img, right_img))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def tileOverlap(self):
+        # Get default overlap used for tiled matching
+        # (see I3DRSGM.tileOverlap)
+        return self.workers[0].tileOverlap()
+
+    def forwardMatchTiled(self, left_img, right_img, band_rows=512,
+                          overlap=None, profile=None, measure_memory=False):
+        """
+        Stereo matching of a large image pair in horizontal bands.
+        Bands are matched in parallel by the idle I3DRSGM instances
+        (see I3DRSGM.forwardMatchTiled).
+        :return: (valid, disparity, report)
+        """
+        if overlap is None:
+            overlap = self.tileOverlap()
+        return match_tiled(
+            lambda left, right: self._forwardMatch(left, right, profile),
+            left_img, right_img, band_rows, overlap,
+            executor=self._executor, measure_memory=measure_memory)
+
+    def _broadcast(self, func):
+        # Run function on every I3DRSGM instance
+        # Waits for running matches to finish before running
+        with self._broadcast_lock:
+            workers = [self._idle.get() for _ in range(self.num_workers)]
+            try:
+                return all([func(worker) for worker in workers])
+            finally:
+                for worker in workers:
+                    self._idle.put(worker)
+
+    def setDisparityRange(self, value):
+        # Set disparity range used I3DRSGM algorithm
+        return self._broadcast(lambda w: w.setDisparityRange(value))
+
+    def setWindowSize(self, value):
+        # Set window size used I3DRSGM algorithm
+        return self._broadcast(lambda w: w.setWindowSize(value))
+
+    def setPyamidLevel(self, value):
+        # Set pyramid level used I3DRSGM algorithm
+        return self._broadcast(lambda w: w.setPyamidLevel(value))
+
+    def setMinDisparity(self, value):
+        # Set minimum disparity used I3DRSGM algorithm
+        return self._broadcast(lambda w: w.setMinDisparity(value))
+
+    def enableInterpolation(self, enable):
+        # Enable interpolation in I3DRSGM algorithm
+        return self._broadcast(lambda w: w.enableInterpolation(enable))
+
+    def setParams(self, profile):
+        # Set several I3DRSGM parameters in one call
+        return self._broadcast(lambda w: w.setParams(profile))
+
+    def addProfile(self, name, profile):
+        # Add named parameter profile to all instances
+        for worker in self.workers:
+            worker.addProfile(name, profile)
+
+    def useProfile(self, name):
+        # Switch all instances to named parameter profile
+        return self._broadcast(lambda w: w.useProfile(name))
+
+    def close(self):
+        # Close all I3DRSGM instances
+        # Required to clean up memory
+        self._executor.shutdown(wait=True)
+        for worker in self.workers:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
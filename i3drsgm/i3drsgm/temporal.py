@@ -0,0 +1,224 @@
+"""
+I3DRSGM temporal matching
+
+This module is for matching video streams from fixed cameras where
+consecutive frames are often nearly identical. Disparity of frames
+(or bands of rows) that have not changed is re-used instead of
+matching again.
+"""
+import numpy as np
+from .lazy import LazyModule
+from .tiling import split_bands, stitch_bands
+
+# OpenCV is imported on first use to keep package import fast
+cv2 = LazyModule("cv2")
+
+
+class TemporalMatcher:
+    """
+    Incremental stereo matching of a stream of rectified image pairs.
+    Each frame is compared with the frame it's disparity was last
+    matched from using the mean absolute difference of downsampled
+    images. If the change is below threshold the previous disparity
+    is re-used.
+    With band_rows set the image is split into horizontal bands
+    (see i3drsgm.tiling) and only bands that have changed are matched.
+    Disparity is never re-used for more than max_staleness frames.
+
+    Example:
+        temporal = TemporalMatcher(i3drsgm, threshold=2.0, band_rows=256)
+        for left, right in frames:
+            valid, disp = temporal.forwardMatch(left, right)
+        print(temporal.stats())
+    """
+    def __init__(self, matcher, threshold=2.0, max_staleness=30,
+                 downsample=8, band_rows=None, overlap=None,
+                 full_match_ratio=0.5):
+        """
+        :param matcher:
+            I3DRSGM or I3DRSGMPool used to match frames
+            (bands are matched in parallel with I3DRSGMPool)
+        :param threshold:
+            mean absolute difference in grey levels above which a frame
+            (or band) is considered changed
+        :param max_staleness:
+            maximum number of frames disparity is re-used for
+            before it is matched again
+        :param downsample: factor images are downsampled by for comparison
+        :param band_rows:
+            rows in each band when only matching changed bands
+            (default: compare and match whole frames)
+        :param overlap:
+            rows added above and below each matched band
+            (default: matcher.tileOverlap())
+        :param full_match_ratio:
+            fraction of changed bands at which the full frame is matched
+            instead of the changed bands
+        :type threshold: float
+        :type max_staleness: int
+        :type downsample: int
+        :type band_rows: int
+        :type overlap: int
+        :type full_match_ratio: float
+        """
+        if downsample < 1:
+            raise ValueError("downsample must be at least 1")
+        self.matcher = matcher
+        self.threshold = threshold
+        self.max_staleness = max_staleness
+        self.downsample = int(downsample)
+        self.band_rows = band_rows
+        self.overlap = overlap
+        self.full_match_ratio = full_match_ratio
+        self.reset()
+
+    def reset(self):
+        # Forget previous frame so the next frame is fully matched
+        # (statistics are also reset)
+        self._shape = None
+        self._bands = None
+        self._reference = None
+        self._disp = None
+        self._ages = None
+        self.frames = 0
+        self.full_matches = 0
+        self.partial_matches = 0
+        self.skipped = 0
+        self.bands_matched = 0
+
+    def _thumbnail(self, left_img, right_img):
+        # Downsampled left and right images used to measure change
+        thumbs = []
+        for img in [left_img, right_img]:
+            if self.downsample > 1:
+                size = (max(1, img.shape[1] // self.downsample),
+                        max(1, img.shape[0] // self.downsample))
+                img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+            # float32 holds 16-bit images exactly
+            thumbs.append(img.astype(np.float32))
+        return thumbs
+
+    def _thumb_rows(self, band, num_rows):
+        # Rows of thumbnail covered by rows kept from band
+        _, _, keep_start, keep_end = band
+        start = min(keep_start // self.downsample, num_rows - 1)
+        end = max(start + 1, -(-keep_end // self.downsample))
+        return slice(start, min(end, num_rows))
+
+    def change(self, left_img, right_img):
+        """
+        Measure change of each band since it was last matched
+        :return:
+            mean absolute difference of each band
+            (None if there is no previous frame of the same size)
+        :rtype: list
+        """
+        if self._reference is None or \
+                left_img.shape != self._shape:
+            return None
+        return self._change(self._thumbnail(left_img, right_img))
+
+    def _change(self, thumbs):
+        # Mean absolute difference of each band with reference thumbnails
+        changes = []
+        num_rows = thumbs[0].shape[0]
+        for band in self._bands:
+            rows = self._thumb_rows(band, num_rows)
+            diff = 0.0
+            for thumb, reference in zip(thumbs, self._reference):
+                diff = max(diff, float(
+                    np.mean(np.abs(thumb[rows] - reference[rows]))))
+            changes.append(diff)
+        return changes
+
+    def _match(self, left_img, right_img):
+        # Match full frame
+        return self.matcher.forwardMatch(left_img, right_img)
+
+    def _match_bands(self, left_img, right_img, bands):
+        # Match bands (in parallel if matcher supports 'submit')
+        pairs = [(left_img[start:end], right_img[start:end])
+                 for start, end, _, _ in bands]
+        if hasattr(self.matcher, "submit"):
+            futures = [self.matcher.submit(left, right)
+                       for left, right in pairs]
+            return [future.result() for future in futures]
+        return [self.matcher.forwardMatch(left, right)
+                for left, right in pairs]
+
+    def forwardMatch(self, left_img, right_img):
+        """
+        Stereo match frame re-using disparity of unchanged bands
+        :param left_img: rectified left image
+        :param right_img: rectified right image
+        :return: (valid, disparity)
+        """
+        self.frames += 1
+        thumbs = self._thumbnail(left_img, right_img)
+        changed = None
+        if self._reference is not None and left_img.shape == self._shape:
+            changes = self._change(thumbs)
+            changed = [
+                change > self.threshold or age >= self.max_staleness
+                for change, age in zip(changes, self._ages)]
+
+        if changed is not None and not any(changed):
+            # Re-use previous disparity
+            self.skipped += 1
+            self._ages += 1
+            return True, self._disp.copy()
+
+        if changed is None or \
+                sum(changed) >= self.full_match_ratio * len(changed):
+            valid, disp = self._match(left_img, right_img)
+            if not valid or disp is None:
+                return False, None
+            self.full_matches += 1
+            height = left_img.shape[0]
+            overlap = self.overlap
+            if overlap is None:
+                overlap = self.matcher.tileOverlap()
+            band_rows = self.band_rows
+            if band_rows is None:
+                band_rows = height
+            self._shape = left_img.shape
+            self._bands = split_bands(height, band_rows, overlap)
+            self._reference = thumbs
+            self._disp = disp
+            self._ages = np.zeros(len(self._bands), np.int64)
+            self.bands_matched += len(self._bands)
+            return True, disp.copy()
+
+        # Match changed bands only
+        bands = [band for band, c in zip(self._bands, changed) if c]
+        results = self._match_bands(left_img, right_img, bands)
+        if not all(valid and disp is not None for valid, disp in results):
+            return False, None
+        stitch_bands(bands, [disp for _, disp in results], out=self._disp)
+        num_rows = thumbs[0].shape[0]
+        for band in bands:
+            rows = self._thumb_rows(band, num_rows)
+            for thumb, reference in zip(thumbs, self._reference):
+                reference[rows] = thumb[rows]
+        self._ages += 1
+        self._ages[np.array(changed)] = 0
+        self.partial_matches += 1
+        self.bands_matched += len(bands)
+        return True, self._disp.copy()
+
+    def stats(self):
+        """
+        Get frame skipping statistics
+        :return:
+            dictionary of frames, full_matches, partial_matches,
+            skipped, skip_rate and bands_matched
+        :rtype: dict
+        """
+        return {
+            "frames": self.frames,
+            "full_matches": self.full_matches,
+            "partial_matches": self.partial_matches,
+            "skipped": self.skipped,
+            "skip_rate": self.skipped / self.frames if self.frames else 0.0,
+            "bands_matched": self.bands_matched,
+        }
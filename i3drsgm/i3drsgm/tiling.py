@@ -0,0 +1,137 @@
+"""
+I3DRSGM tiled matching
+
+This module is for matching large image pairs in horizontal bands
+to reduce the memory and latency of each match.
+Bands span the full image width so the whole disparity search range
+is available in every band. Bands overlap by a number of rows
+so matching windows and cost aggregation near band edges see the
+same image content as a full frame match.
+"""
+import time
+import tracemalloc
+import numpy as np
+from .metrics import metrics
+
+
+def split_bands(height, band_rows, overlap):
+    """
+    Split image rows into overlapping horizontal bands
+    :param height: number of image rows
+    :param band_rows: number of rows used from each band
+    :param overlap: rows added above and below each band
+    :type height: int
+    :type band_rows: int
+    :type overlap: int
+    :return:
+        list of (start, end, keep_start, keep_end).
+        Rows start:end are matched and keep_start:keep_end
+        are used in the stitched disparity.
+    :rtype: list
+    """
+    if band_rows < 1:
+        raise ValueError("band_rows must be at least 1")
+    if overlap < 0:
+        raise ValueError("overlap must not be negative")
+    bands = []
+    for keep_start in range(0, height, band_rows):
+        keep_end = min(keep_start + band_rows, height)
+        start = max(0, keep_start - overlap)
+        end = min(height, keep_end + overlap)
+        bands.append((start, end, keep_start, keep_end))
+    return bands
+
+
+def stitch_bands(bands, disparities, out=None):
+    """
+    Stitch disparity of each band into a single disparity image
+    :param bands: bands from 'split_bands'
+    :param disparities: disparity of each band
+    :param out: optional pre-allocated output disparity image
+    :rtype: numpy
+    """
+    for (start, _, keep_start, keep_end), disp in zip(bands, disparities):
+        if out is None:
+            height = bands[-1][3]
+            out = np.empty((height,) + disp.shape[1:], disp.dtype)
+        out[keep_start:keep_end] = disp[keep_start - start:keep_end - start]
+    return out
+
+
+def match_tiled(match, left_img, right_img, band_rows, overlap,
+                executor=None, measure_memory=False):
+    """
+    Stereo match image pair in overlapping horizontal bands
+    :param match: function(left_img, right_img) returning (valid, disparity)
+    :param left_img: rectified left image
+    :param right_img: rectified right image
+    :param band_rows: number of rows used from each band
+    :param overlap: rows added above and below each band
+    :param executor:
+        executor used to match bands in parallel
+        (default: bands are matched one at a time)
+    :param measure_memory:
+        measure peak python memory allocated while matching
+        (uses tracemalloc which slows down allocations)
+    :type band_rows: int
+    :type overlap: int
+    :type executor: concurrent.futures.Executor
+    :type measure_memory: bool
+    :return:
+        (valid, disparity, report) where report is a dictionary with
+        'bands' (rows, seconds of each band), 'seconds' (total time),
+        'band_bytes' (largest band image and disparity size) and
+        'peak_memory' (bytes, None unless measure_memory is True)
+    """
+    if left_img.shape[:2] != right_img.shape[:2]:
+        raise ValueError("Image sizes must be equal")
+    height = left_img.shape[0]
+    bands = split_bands(height, band_rows, overlap)
+    band_seconds = [None] * len(bands)
+
+    def match_band(i):
+        start, end, _, _ = bands[i]
+        band_start = time.perf_counter()
+        with metrics.timer("forward_match_tiled.band"):
+            result = match(left_img[start:end], right_img[start:end])
+        band_seconds[i] = time.perf_counter() - band_start
+        return result
+
+    started_tracing = False
+    if measure_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        started_tracing = True
+    total_start = time.perf_counter()
+    try:
+        if executor is None:
+            results = [match_band(i) for i in range(len(bands))]
+        else:
+            futures = [executor.submit(match_band, i)
+                       for i in range(len(bands))]
+            results = [future.result() for future in futures]
+        valid = all(v and disp is not None for v, disp in results)
+        disp = None
+        band_bytes = 0
+        if valid:
+            disparities = [disp for _, disp in results]
+            with metrics.timer("forward_match_tiled.stitch"):
+                disp = stitch_bands(bands, disparities)
+            band_bytes = max(
+                left_img[start:end].nbytes + right_img[start:end].nbytes +
+                band_disp.nbytes
+                for (start, end, _, _), band_disp in zip(bands, disparities))
+        peak_memory = None
+        if measure_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+    report = {
+        "bands": [
+            {"rows": (start, end), "seconds": seconds}
+            for (start, end, _, _), seconds in zip(bands, band_seconds)],
+        "seconds": time.perf_counter() - total_start,
+        "band_bytes": band_bytes,
+        "peak_memory": peak_memory,
+    }
+    return valid, disp, report
@@ -0,0 +1,200 @@
+"""
+I3DRSGM image transport
+
+This module is for passing images to and from I3DRSGMApp using files.
+"""
+import os
+import struct
+import numpy as np
+from .lazy import LazyModule
+
+# OpenCV is imported on first use to keep package import fast
+cv2 = LazyModule("cv2")
+# OpenCV imwrite flags (values of cv2.IMWRITE_*)
+# Defined here so transports can be created without importing OpenCV
+IMWRITE_PNG_COMPRESSION = 16
+IMWRITE_TIFF_COMPRESSION = 259
+
+
+class ImageTransport:
+    """
+    File format used to pass images to I3DRSGMApp and
+    read the disparity image it writes.
+    """
+    def __init__(self, name, extension, params=None):
+        """
+        :param name: name of transport
+        :param extension:
+            file extension for images (including '.').
+            Use '.pnm' to write PGM for grayscale and PPM for color images.
+        :param params: opencv imwrite parameters
+        :type name: str
+        :type extension: str
+        :type params: list
+        """
+        self.name = name
+        self.extension = extension
+        self.params = [] if params is None else list(params)
+
+    def image_filepath(self, folder, name, img):
+        # Get filepath used to write image
+        extension = self.extension
+        if extension == ".pnm":
+            if img.ndim == 3 and img.shape[2] == 3:
+                extension = ".ppm"
+            else:
+                extension = ".pgm"
+        return os.path.join(folder, name+extension)
+
+    def write_image(self, folder, name, img):
+        """
+        Write image to folder for I3DRSGMApp
+        :return: filepath of image (or None if write failed)
+        :rtype: str
+        """
+        filepath = self.image_filepath(folder, name, img)
+        if not cv2.imwrite(filepath, img, self.params):
+            return None
+        return filepath
+
+    @staticmethod
+    def read_disparity(filepath):
+        """
+        Read disparity image written by I3DRSGMApp.
+        Uncompressed TIFFs are read directly from file with np.memmap,
+        other formats are decoded with OpenCV.
+        :return: disparity image (or None if read failed)
+        :rtype: numpy
+        """
+        disp = read_uncompressed_tiff(filepath)
+        if disp is None:
+            disp = cv2.imread(filepath, -1)
+        return disp
+
+
+# Available transports (see I3DRSGM 'transport' parameter)
+TRANSPORTS = {
+    # OpenCV default PNG compression (original behaviour)
+    "png": ImageTransport("png", ".png"),
+    # PNG without deflate compression
+    "png0": ImageTransport(
+        "png0", ".png", [IMWRITE_PNG_COMPRESSION, 0]),
+    # Uncompressed TIFF
+    "tiff": ImageTransport(
+        "tiff", ".tif", [IMWRITE_TIFF_COMPRESSION, 1]),
+    # Binary PGM/PPM (raw pixel data after a short text header)
+    "pnm": ImageTransport("pnm", ".pnm"),
+}
+# Raw pixel data is passed using binary PNM as I3DRSGMApp reads files
+TRANSPORTS["raw"] = TRANSPORTS["pnm"]
+
+
+def get_transport(transport):
+    """
+    Get image transport from name
+    :param transport: name of transport (see TRANSPORTS) or ImageTransport
+    :rtype: ImageTransport
+    """
+    if isinstance(transport, ImageTransport):
+        return transport
+    if transport not in TRANSPORTS:
+        raise ValueError("Invalid transport {}. Expected one of {}".format(
+            transport, list(TRANSPORTS.keys())))
+    return TRANSPORTS[transport]
+
+
+# TIFF tags needed to read an uncompressed image
+_TIFF_WIDTH = 256
+_TIFF_HEIGHT = 257
+_TIFF_BITS_PER_SAMPLE = 258
+_TIFF_COMPRESSION = 259
+_TIFF_STRIP_OFFSETS = 273
+_TIFF_SAMPLES_PER_PIXEL = 277
+_TIFF_STRIP_BYTE_COUNTS = 279
+_TIFF_PLANAR_CONFIG = 284
+_TIFF_SAMPLE_FORMAT = 339
+# TIFF field type: (struct format, size)
+_TIFF_TYPES = {1: ("B", 1), 3: ("H", 2), 4: ("I", 4), 16: ("Q", 8)}
+# TIFF (sample format, bits per sample): numpy dtype
+_TIFF_DTYPES = {
+    (1, 8): np.uint8, (1, 16): np.uint16, (1, 32): np.uint32,
+    (2, 8): np.int8, (2, 16): np.int16, (2, 32): np.int32,
+    (3, 32): np.float32, (3, 64): np.float64,
+}
+
+
+def _read_tiff_tags(f):
+    # Read tags from first IFD of TIFF file
+    # Returns (byte order, {tag: [values]}) or None if not a TIFF
+    header = f.read(8)
+    if len(header) < 8:
+        return None
+    if header[:4] == b"II*\x00":
+        order = "<"
+    elif header[:4] == b"MM\x00*":
+        order = ">"
+    else:
+        return None
+    ifd_offset, = struct.unpack(order+"I", header[4:8])
+    f.seek(ifd_offset)
+    num_entries, = struct.unpack(order+"H", f.read(2))
+    entries = f.read(12 * num_entries)
+    tags = {}
+    for i in range(num_entries):
+        entry = entries[i*12:(i+1)*12]
+        tag, field_type, count = struct.unpack(order+"HHI", entry[:8])
+        if field_type not in _TIFF_TYPES:
+            continue
+        fmt, size = _TIFF_TYPES[field_type]
+        if size * count <= 4:
+            data = entry[8:8 + size * count]
+        else:
+            offset, = struct.unpack(order+"I", entry[8:12])
+            position = f.tell()
+            f.seek(offset)
+            data = f.read(size * count)
+            f.seek(position)
+        tags[tag] = list(struct.unpack(order+fmt*count, data))
+    return order, tags
+
+
+def read_uncompressed_tiff(filepath):
+    """
+    Read single channel uncompressed TIFF using np.memmap
+    :return: image (or None if TIFF is compressed or not supported)
+    :rtype: numpy
+    """
+    try:
+        with open(filepath, "rb") as f:
+            tiff = _read_tiff_tags(f)
+    except (OSError, struct.error):
+        return None
+    if tiff is None:
+        return None
+    order, tags = tiff
+    try:
+        width = tags[_TIFF_WIDTH][0]
+        height = tags[_TIFF_HEIGHT][0]
+        bits = tags[_TIFF_BITS_PER_SAMPLE][0]
+        offsets = tags[_TIFF_STRIP_OFFSETS]
+        byte_counts = tags[_TIFF_STRIP_BYTE_COUNTS]
+    except KeyError:
+        return None
+    compression = tags.get(_TIFF_COMPRESSION, [1])[0]
+    samples = tags.get(_TIFF_SAMPLES_PER_PIXEL, [1])[0]
+    planar = tags.get(_TIFF_PLANAR_CONFIG, [1])[0]
+    sample_format = tags.get(_TIFF_SAMPLE_FORMAT, [1])[0]
+    dtype = _TIFF_DTYPES.get((sample_format, bits))
+    if compression != 1 or samples != 1 or planar != 1 or dtype is None:
+        return None
+    # Strips must be contiguous to map as a single array
+    for i in range(1, len(offsets)):
+        if offsets[i] != offsets[i-1] + byte_counts[i-1]:
+            return None
+    dtype = np.dtype(dtype).newbyteorder(order)
+    if sum(byte_counts) < width * height * dtype.itemsize:
+        return None
+    disp = np.memmap(filepath, dtype=dtype, mode="r",
+                     offset=offsets[0], shape=(height, width))
+    # Copy out of file as it is overwritten by the next match
+    return np.array(disp, dtype=dtype.newbyteorder("="))
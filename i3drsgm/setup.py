@@ -4,8 +4,8 @@ from shutil import rmtree
 import glob
 import sys
 import argparse
+import importlib.util
 from setuptools import Command, setup, find_packages
-from i3drsgm import I3DRSGMAppAPI
 
 
 class CleanCommand(Command):
@@ -82,7 +82,14 @@ OFFLINE_INSTALLER = args.offline_installer
 
 if OFFLINE_INSTALLER:
     INCLUDE_PACKAGE_DATA = True
-    I3DRSGMAppAPI.download_app()
+    # Load download module directly from file so the i3drsgm package
+    # (and it's dependencies) are not imported at build time
+    spec = importlib.util.spec_from_file_location(
+        "i3drsgm_download",
+        join(dirname(abspath(__file__)), "i3drsgm", "download.py"))
+    i3drsgm_download = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(i3drsgm_download)
+    i3drsgm_download.download_app()
 else:
     INCLUDE_PACKAGE_DATA = False
 
@@ -101,7 +108,7 @@ setup(
     install_requires=[
         'numpy; python_version == "3.5"',
         'numpy==1.19.3; python_version > "3.5"',
-        'opencv-python', 'stereo3d >= 0.0.3', "wget"
+        'opencv-python'
     ],
     classifiers=[
         "Programming Language :: Python :: 3",
@@ -0,0 +1,137 @@
+"""
+This module is a stand-in for I3DRSGMApp used for testing and
+benchmarking i3drsgm module without the licensed I3DRSGM application.
+It uses the same stdin/stdout API as I3DRSGMApp:
+    python standin_app.py api
+Disparity is calculated using OpenCV StereoSGBM and written in the
+same format as I3DRSGM (negative disparity, -99999 for invalid).
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import cv2
+
+
+class StandInApp:
+    # Disparity value used by I3DRSGM to signify an invalid disparity
+    INVALID_DISPARITY = -99999
+
+    def __init__(self, delay=0.0):
+        # Initialise stand-in app
+        # delay adds time to each match to simulate matcher compute
+        self.delay = delay
+        self.params = {
+            "SET_MIN_DISPARITY": 0,
+            "SET_DISPARITY_RANGE": 64,
+            "SET_INTERPOLATION": 0,
+            "SET_WINDOW_SIZE": 11,
+            "SET_PYRAMID_LEVEL": 6,
+        }
+
+    @staticmethod
+    def write(line):
+        # Write line to stdout using I3DRSGMApp line endings
+        sys.stdout.buffer.write((line+"\r\n").encode("utf-8"))
+        sys.stdout.buffer.flush()
+
+    def compute_disparity(self, left, right):
+        # Generate disparity image from left and right grayscale images
+        # Disparity is negative to match I3DRSGM output
+        if left.shape != right.shape:
+            raise ValueError("Image sizes must be equal")
+        min_disparity = self.params["SET_MIN_DISPARITY"]
+        # StereoSGBM requires disparity range to be a multiple of 16
+        num_disparities = max(16, self.params["SET_DISPARITY_RANGE"])
+        num_disparities = ((num_disparities + 15) // 16) * 16
+        # StereoSGBM requires odd window size
+        block_size = max(1, self.params["SET_WINDOW_SIZE"]) | 1
+        matcher = cv2.StereoSGBM_create(
+            minDisparity=min_disparity, numDisparities=num_disparities,
+            blockSize=block_size, P1=8 * block_size ** 2,
+            P2=32 * block_size ** 2, mode=cv2.STEREO_SGBM_MODE_SGBM_3WAY)
+        # Pad images on the left by the disparity range so left columns
+        # are matched and small images are wide enough for StereoSGBM
+        pad = max(0, min_disparity + num_disparities) + block_size // 2 + 1
+        left = cv2.copyMakeBorder(left, 0, 0, pad, 0, cv2.BORDER_REPLICATE)
+        right = cv2.copyMakeBorder(right, 0, 0, pad, 0, cv2.BORDER_REPLICATE)
+        disp16 = matcher.compute(left, right)[:, pad:]
+        disp = disp16.astype(np.float32) / -16.0
+        disp[disp16 < min_disparity * 16] = self.INVALID_DISPARITY
+        return disp
+
+    def match(self, left_filepath, right_filepath):
+        # Generate disparity image from left and right image files
+        left = cv2.imread(left_filepath, cv2.IMREAD_GRAYSCALE)
+        right = cv2.imread(right_filepath, cv2.IMREAD_GRAYSCALE)
+        if left is None or right is None:
+            raise ValueError("Failed to read images")
+        if self.delay > 0:
+            time.sleep(self.delay)
+        return self.compute_disparity(left, right)
+
+    def forward_match(self, args):
+        # Handle FORWARD_MATCH request
+        # left,right,output or left,right,left_cal,right_cal,output,rectify
+        if len(args) == 3:
+            left_filepath, right_filepath, output_folder = args
+        elif len(args) == 6:
+            left_filepath, right_filepath, _, _, output_folder, _ = args
+        else:
+            raise ValueError("Invalid FORWARD_MATCH arguments")
+        disp = self.match(left_filepath, right_filepath)
+        disp_filepath = os.path.join(output_folder, "disparity.tif")
+        if not cv2.imwrite(disp_filepath, disp,
+                           [cv2.IMWRITE_TIFF_COMPRESSION, 1]):
+            raise ValueError("Failed to write disparity")
+        return disp_filepath
+
+    def handle(self, line):
+        # Handle API request and return response
+        cmd, *args = line.split(",")
+        if cmd == "INIT":
+            return "INIT"
+        elif cmd == "FORWARD_MATCH":
+            return self.forward_match(args)
+        elif cmd == "SLEEP":
+            # Not part of I3DRSGMApp API
+            # Used to test handling of an app that stops responding
+            time.sleep(float(args[0]))
+            return cmd
+        elif cmd == "LOG":
+            # Not part of I3DRSGMApp API
+            # Used to test handling of an app that writes lots of output
+            for i in range(int(args[0])):
+                sys.stderr.write("log line {}\n".format(i))
+            sys.stderr.flush()
+            return cmd
+        elif cmd in self.params:
+            self.params[cmd] = int(args[0])
+            return cmd+","+args[0]
+        else:
+            raise ValueError("Unknown command "+cmd)
+
+    def run(self):
+        # Run API loop until stdin is closed
+        while True:
+            self.write("API_READY")
+            line = sys.stdin.readline()
+            if line == "":
+                break
+            line = line.strip()
+            if line == "":
+                continue
+            try:
+                response = self.handle(line)
+            except Exception as e:
+                response = "ERROR,"+str(e)
+            self.write("API_RESPONSE:"+response)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('mode', choices=['api'])
+    parser.add_argument('--delay', type=float, default=0.0)
+    args = parser.parse_args()
+    StandInApp(args.delay).run()
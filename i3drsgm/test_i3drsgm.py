@@ -1,7 +1,1024 @@
 """This module tests core functionality in i3drsgm module"""
-from i3drsgm import I3DRSGM
+import os
+import sys
+import time
+import shutil
+import shlex
+import subprocess
+import asyncio
+import logging
+import numpy as np
+import pytest
+import cv2
+from i3drsgm import I3DRSGM, StereoSupport, DisparityProcessor, I3DRSGMPool
+from i3drsgm import I3DRSGMAppAPI, AsyncI3DRSGM, MatcherProfile
+from i3drsgm import StereoCalibration, DisparityCache, HistogramSink, metrics
+from i3drsgm import TemporalMatcher, to_compact, from_compact
+from i3drsgm import ColormapRenderer
+from i3drsgm.compact import write_compact, read_compact, COMPACT_MAX
+from i3drsgm.tiling import match_tiled
+from i3drsgm.transport import TRANSPORTS, ImageTransport
+from i3drsgm.transport import read_uncompressed_tiff
+from i3drsgm.transport import IMWRITE_PNG_COMPRESSION, IMWRITE_TIFF_COMPRESSION
+from standin_app import StandInApp
+from benchmark import import_time
+from i3drsgm.__main__ import main, split_command
+from i3drsgm import download
+
+SAMPLE_DATA_FOLDER = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    os.path.normpath("../sample_data"))
+STANDIN_APP_CMD = [
+    sys.executable,
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "standin_app.py"),
+    "api"]
 
 
 def test_init_dataset():
     """Test initalising I3DRSGM class"""
     I3DRSGM()
+
+
+def _reference_reproject(disp, Q, downsample_rate=1.0):
+    """Per-pixel reprojection used to check vectorised results"""
+    downsample_factor = 1/downsample_rate
+    w = (disp * Q[3, 2]) + Q[3, 3]
+    z = Q[2, 3] / w
+    x = np.zeros_like(z)
+    y = np.zeros_like(z)
+    for i in range(disp.shape[0]):
+        for j in range(disp.shape[1]):
+            x[i, j] = ((j * downsample_factor) + Q[0, 3]) / w[i, j]
+            y[i, j] = ((i * downsample_factor) + Q[1, 3]) / w[i, j]
+    return np.dstack((x, y, z))
+
+
+def _sample_Q():
+    """Q matrix matching the sample data calibration"""
+    return np.array([
+        [1.0, 0.0, 0.0, -1224.0],
+        [0.0, 1.0, 0.0, -1024.0],
+        [0.0, 0.0, 0.0, 3478.26],
+        [0.0, 0.0, 8.33, 0.0]])
+
+
+def test_reproject_matches_reference():
+    """Test vectorised reprojection matches per-pixel calculation"""
+    Q = _sample_Q()
+    rng = np.random.RandomState(0)
+    disp = rng.uniform(1, 200, (24, 32)).astype(np.float32)
+    for downsample_rate in [1.0, 0.5]:
+        expected = _reference_reproject(disp, Q, downsample_rate)
+        depth = StereoSupport.reprojectImageTo3D(disp, Q, downsample_rate)
+        assert depth.dtype == np.float32
+        np.testing.assert_allclose(depth, expected, rtol=1e-5)
+
+
+def test_reproject_out_buffer():
+    """Test reprojection writes into caller supplied buffer"""
+    Q = _sample_Q()
+    disp = np.full((8, 10), 50, np.float32)
+    out = np.empty((8, 10, 3), np.float32)
+    depth = StereoSupport.reprojectImageTo3D(disp, Q, out=out)
+    assert depth is out
+    with pytest.raises(ValueError):
+        StereoSupport.reprojectImageTo3D(
+            disp, Q, out=np.empty((8, 10, 3), np.float64))
+
+
+def _sample_disparity():
+    """Negative disparity with invalid and behind camera pixels"""
+    rng = np.random.RandomState(1)
+    disp = -rng.uniform(1, 200, (24, 32)).astype(np.float32)
+    disp[2, 3] = -99999
+    disp[5, :4] = 10
+    return disp
+
+
+def _reference_invalid(disp, Q):
+    """Masked array based min/max used to check DisparityProcessor"""
+    disparity = -disp.astype(np.float32)
+    w_zero_mask = (disparity * Q[3, 2]) + Q[3, 3] <= 0
+    disparity[w_zero_mask] = 0.0
+    d_inf_mask = disparity == 99999
+    disparity[d_inf_mask] = 0.0
+    masked_a = np.ma.masked_equal(disparity, 0.0, copy=False)
+    disparity[w_zero_mask] = masked_a.min()
+    disparity[d_inf_mask] = masked_a.max()
+    return disparity, w_zero_mask, d_inf_mask
+
+
+def test_depth_from_disp_matches_reference():
+    """Test depth from disparity filters invalid disparities"""
+    Q = _sample_Q()
+    disp = _sample_disparity()
+    disparity, w_zero_mask, d_inf_mask = _reference_invalid(disp, Q)
+    expected = _reference_reproject(disparity, Q)
+    expected[w_zero_mask] = 0
+    expected[:, :, 2][d_inf_mask] = 0
+
+    depth = StereoSupport.depth_from_disp(disp, Q)
+    np.testing.assert_allclose(depth, expected, rtol=1e-5)
+
+
+def test_disparity_processor_outputs():
+    """Test DisparityProcessor returns all requested outputs"""
+    Q = _sample_Q()
+    disp = _sample_disparity()
+    disparity, w_zero_mask, d_inf_mask = _reference_invalid(disp, Q)
+    invalid = w_zero_mask | d_inf_mask
+
+    processor = DisparityProcessor(Q)
+    result = processor.process(
+        disp, depth=True, colormap=True, valid_mask=True, points=True)
+    np.testing.assert_array_equal(result["valid_mask"], ~invalid)
+    assert result["points"].shape == ((~invalid).sum(), 3)
+    np.testing.assert_array_equal(
+        result["points"], result["depth"][~invalid])
+    assert result["colormap"].shape == disp.shape + (3,)
+    assert not result["colormap"][invalid].any()
+    np.testing.assert_array_equal(
+        result["colormap"], StereoSupport.colormap_from_disparity(disp, Q))
+
+    # Scratch buffers are re-used for following frames
+    result = processor.process(disp, depth=False, valid_mask=True)
+    assert "depth" not in result
+    np.testing.assert_array_equal(result["valid_mask"], ~invalid)
+
+
+def _sample_pairs(num_pairs, shape=(16, 20)):
+    """Random image pairs with known stand-in app disparity"""
+    rng = np.random.RandomState(2)
+    pairs = []
+    for _ in range(num_pairs):
+        left = rng.randint(0, 256, shape).astype(np.uint8)
+        right = rng.randint(0, 256, shape).astype(np.uint8)
+        pairs.append((left, right))
+    return pairs
+
+
+def _standin_disparity(left, right):
+    """Disparity expected from stand-in app (default parameters)"""
+    return StandInApp().compute_disparity(left, right)
+
+
+def test_standin_app_disparity():
+    """Test stand-in app disparity of a shifted image"""
+    rng = np.random.RandomState(3)
+    left = cv2.resize(
+        rng.randint(0, 256, (16, 24)).astype(np.uint8), (96, 64))
+    right = np.roll(left, -4, axis=1)
+    disp = StandInApp().compute_disparity(left, right)
+    valid = disp != StandInApp.INVALID_DISPARITY
+    assert valid.mean() > 0.5
+    np.testing.assert_allclose(np.median(disp[valid]), -4)
+
+
+def test_forward_match_standin(tmp_path):
+    """Test forward match using stand-in app"""
+    i3drsgm = I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path))
+    try:
+        assert i3drsgm.isInit()
+        assert i3drsgm.setDisparityRange(64)
+        left, right = _sample_pairs(1)[0]
+        valid, disp = i3drsgm.forwardMatch(left, right)
+        assert valid
+        np.testing.assert_array_equal(disp, _standin_disparity(left, right))
+    finally:
+        i3drsgm.close()
+
+
+def test_pool_map_in_order(tmp_path):
+    """Test pool returns matches in the same order as input pairs"""
+    pairs = _sample_pairs(6)
+    with I3DRSGMPool(
+            2, app_cmd=STANDIN_APP_CMD, tmp_root=str(tmp_path)) as pool:
+        assert pool.isInit()
+        assert pool.setDisparityRange(64)
+        assert pool.enableInterpolation(False)
+        results = list(pool.map(pairs, max_pending=3))
+        future = pool.submit(*pairs[0])
+        assert future.result()[0]
+    assert len(results) == len(pairs)
+    for (valid, disp), (left, right) in zip(results, pairs):
+        assert valid
+        np.testing.assert_array_equal(disp, _standin_disparity(left, right))
+
+
+def test_session_tmp_folders(tmp_path):
+    """Test each instance uses it's own scratch folder that is removed"""
+    first = I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_root=str(tmp_path))
+    second = I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_root=str(tmp_path))
+    first_folder = first.i3drsgmAppAPI.tmp_folder
+    second_folder = second.i3drsgmAppAPI.tmp_folder
+    assert first_folder != second_folder
+    assert os.path.dirname(first_folder) == str(tmp_path)
+    first.close()
+    second.close()
+    assert not os.path.exists(first_folder)
+    assert not os.path.exists(second_folder)
+
+
+@pytest.mark.parametrize("compression", [1, 5])
+def test_read_disparity_tiff(tmp_path, compression):
+    """Test reading uncompressed and compressed disparity TIFF"""
+    disp = _sample_disparity()
+    filepath = str(tmp_path / "disparity.tif")
+    cv2.imwrite(filepath, disp, [cv2.IMWRITE_TIFF_COMPRESSION, compression])
+    if compression == 1:
+        np.testing.assert_array_equal(read_uncompressed_tiff(filepath), disp)
+    else:
+        assert read_uncompressed_tiff(filepath) is None
+    disp_read = TRANSPORTS["png"].read_disparity(filepath)
+    np.testing.assert_array_equal(disp_read, disp)
+
+
+@pytest.mark.parametrize("transport", sorted(TRANSPORTS.keys()))
+def test_forward_match_transport(tmp_path, transport):
+    """Test forward match with each image transport"""
+    i3drsgm = I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path),
+                      transport=transport)
+    try:
+        left, right = _sample_pairs(1)[0]
+        valid, disp = i3drsgm.forwardMatch(left, right)
+        assert valid
+        np.testing.assert_array_equal(disp, _standin_disparity(left, right))
+    finally:
+        i3drsgm.close()
+
+
+def test_async_forward_match(tmp_path):
+    """Test asyncio client using stand-in app"""
+    pairs = _sample_pairs(3)
+
+    async def run():
+        async with AsyncI3DRSGM(
+                app_cmd=STANDIN_APP_CMD, tmp_root=str(tmp_path)) as i3drsgm:
+            assert i3drsgm.isInit()
+            assert await i3drsgm.set_param(
+                I3DRSGMAppAPI.PARAM_DISPARITY_RANGE, 64)
+            assert not await i3drsgm.set_param("SET_INVALID", 1)
+            # Requests made concurrently are processed one at a time
+            return await asyncio.gather(
+                *[i3drsgm.forward_match(left, right)
+                  for left, right in pairs])
+
+    if sys.platform == "win32":
+        # Subprocesses require the ProactorEventLoop on Windows
+        # (not the default event loop before python 3.8)
+        loop = asyncio.ProactorEventLoop()
+    else:
+        loop = asyncio.new_event_loop()
+    # Setting the loop attaches the child watcher before python 3.8
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(run())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    for (valid, disp), (left, right) in zip(results, pairs):
+        assert valid
+        np.testing.assert_array_equal(disp, _standin_disparity(left, right))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_forward_match_stream(tmp_path):
+    """Test pipelined stream matching returns frames in order"""
+    pairs = _sample_pairs(7)
+    i3drsgm = I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path))
+    try:
+        results = list(i3drsgm.forwardMatchStream(iter(pairs), queue_depth=2))
+        assert len(results) == len(pairs)
+        for (valid, disp), (left, right) in zip(results, pairs):
+            assert valid
+            np.testing.assert_array_equal(
+                disp, _standin_disparity(left, right))
+
+        # Stopping early leaves the instance usable
+        stream = i3drsgm.forwardMatchStream(iter(pairs), queue_depth=1)
+        assert next(stream)[0]
+        stream.close()
+        valid, _ = i3drsgm.forwardMatch(*pairs[0])
+        assert valid
+    finally:
+        i3drsgm.close()
+
+
+def test_param_state_cache(tmp_path):
+    """Test unchanged parameters and profiles are not re-sent"""
+    i3drsgm = I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path))
+    api = i3drsgm.i3drsgmAppAPI
+    requests = []
+    api_request = api.apiRequest
+
+    def counted_request(cmd, *args):
+        requests.append(cmd)
+        return api_request(cmd, *args)
+
+    api.apiRequest = counted_request
+    try:
+        assert i3drsgm.setDisparityRange(3264)
+        assert i3drsgm.setDisparityRange(3264)
+        assert i3drsgm.enableInterpolation(False)
+        assert i3drsgm.enableInterpolation(False)
+        assert requests == ["SET_DISPARITY_RANGE,3264", "SET_INTERPOLATION,0"]
+
+        del requests[:]
+        assert i3drsgm.setParams(
+            MatcherProfile(disparity_range=3264, window_size=11))
+        assert requests == ["SET_WINDOW_SIZE,11"]
+        assert not i3drsgm.setParams({"SET_INVALID": 1})
+
+        del requests[:]
+        i3drsgm.addProfile("fast", {"pyramid_level": 4, "window_size": 11})
+        i3drsgm.addProfile("slow", {"pyramid_level": 6, "window_size": 11})
+        left, right = _sample_pairs(1)[0]
+        for profile in ["fast", "fast", "slow", "slow"]:
+            valid, _ = i3drsgm.forwardMatch(left, right, profile=profile)
+            assert valid
+        params = [cmd for cmd in requests if cmd.startswith("SET_")]
+        assert params == ["SET_PYRAMID_LEVEL,4", "SET_PYRAMID_LEVEL,6"]
+        with pytest.raises(ValueError):
+            i3drsgm.addProfile("invalid", {"invalid": 1})
+    finally:
+        i3drsgm.close()
+
+
+def test_calibration_from_yaml():
+    """Test loading calibration and Q from sample yamls"""
+    stcal = StereoCalibration(
+        os.path.join(SAMPLE_DATA_FOLDER, "sim_left.yaml"),
+        os.path.join(SAMPLE_DATA_FOLDER, "sim_right.yaml"))
+    assert stcal.image_size == (2448, 2048)
+    fx = 3.4782608695652175e+03
+    np.testing.assert_allclose(stcal.Q, [
+        [1, 0, 0, -1224],
+        [0, 1, 0, -1024],
+        [0, 0, 0, fx],
+        [0, 0, fx / 347.82608695652175, 0]])
+    np.testing.assert_allclose(
+        stcal.q_for_size((1224, 1024))[:3], [
+            [1, 0, 0, -612],
+            [0, 1, 0, -512],
+            [0, 0, 0, fx / 2]])
+    assert not StereoCalibration().load_yaml("missing.yaml", "missing.yaml")
+
+
+def test_calibration_rectify_pair():
+    """Test rectification maps are cached and used to rectify pairs"""
+    stcal = StereoCalibration(
+        os.path.join(SAMPLE_DATA_FOLDER, "st_left.yaml"),
+        os.path.join(SAMPLE_DATA_FOLDER, "st_right.yaml"),
+        interpolation=cv2.INTER_LINEAR)
+    left = cv2.imread(
+        os.path.join(SAMPLE_DATA_FOLDER, "sim_left.png"),
+        cv2.IMREAD_GRAYSCALE)
+    right = cv2.imread(
+        os.path.join(SAMPLE_DATA_FOLDER, "sim_right.png"),
+        cv2.IMREAD_GRAYSCALE)
+    small = (left.shape[1] // 4, left.shape[0] // 4)
+    left = cv2.resize(left, small)
+    right = cv2.resize(right, small)
+    maps = stcal.rectification_maps(small)
+    assert maps[0][0].dtype == np.int16
+    left_rect, right_rect = stcal.rectify_pair(left, right)
+    assert stcal.rectification_maps(small) is maps
+    assert left_rect.shape == left.shape
+    assert right_rect.shape == right.shape
+    expected = cv2.remap(
+        left, maps[0][0], maps[0][1], cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_CONSTANT)
+    np.testing.assert_array_equal(left_rect, expected)
+
+
+def _read_ply(filepath):
+    """Read binary PLY written by StereoSupport.write_ply"""
+    with open(filepath, "rb") as f:
+        header = b""
+        while not header.endswith(b"end_header\n"):
+            header += f.readline()
+        points = np.frombuffer(f.read(), StereoSupport.POINT_DTYPE)
+    return header.decode("ascii"), points
+
+
+def test_write_ply(tmp_path):
+    """Test PLY export only contains valid points"""
+    Q = _sample_Q()
+    disp = _sample_disparity()
+    result = DisparityProcessor(Q, 0.5).process(disp, points=True)
+    image = np.zeros(disp.shape + (3,), np.uint8)
+    image[:, :, 2] = 200
+
+    filepath = str(tmp_path / "points.ply")
+    num_points = StereoSupport.write_ply(
+        filepath, disp, Q, 0.5, image=image, chunk_rows=5)
+    header, points = _read_ply(filepath)
+    assert num_points == len(result["points"])
+    assert "element vertex {}\n".format(num_points) in header
+    assert len(points) == num_points
+    xyz = np.stack([points["x"], points["y"], points["z"]], axis=1)
+    np.testing.assert_allclose(xyz, result["points"], rtol=1e-5)
+    assert (points["red"] == 200).all()
+    assert (points["blue"] == 0).all()
+
+    points = StereoSupport.points_from_disp(disp, Q, 0.5)
+    assert points.dtype == StereoSupport.POINT_DTYPE
+    assert len(points) == num_points
+
+
+def test_disparity_cache_lru(tmp_path):
+    """Test disparity cache memory budget and disk tier"""
+    disps = [np.full((10, 10), -i, np.float32) for i in range(3)]
+    keys = ["key{}".format(i) for i in range(3)]
+    cache = DisparityCache(
+        max_bytes=2 * disps[0].nbytes, cache_folder=str(tmp_path))
+    for key, disp in zip(keys, disps):
+        cache.put(key, disp)
+    stats = cache.stats()
+    assert stats["memory_entries"] == 2
+    assert stats["evictions"] == 1
+    assert stats["disk_entries"] == 3
+
+    # Evicted entry is read from disk
+    np.testing.assert_array_equal(cache.get(keys[0]), disps[0])
+    np.testing.assert_array_equal(cache.get(keys[2]), disps[2])
+    assert cache.get("missing") is None
+    stats = cache.stats()
+    assert (stats["disk_hits"], stats["memory_hits"]) == (1, 1)
+    assert stats["misses"] == 1
+
+    # Disk tier is re-used by new cache
+    cache = DisparityCache(max_bytes=0, cache_folder=str(tmp_path))
+    np.testing.assert_array_equal(cache.get(keys[1]), disps[1])
+    assert cache.stats()["disk_hits"] == 1
+
+    # Disparity is stored as compact disparity when lossless
+    assert sorted(os.listdir(str(tmp_path))) == [k + ".png" for k in keys]
+    large = np.full((10, 10), -3000.5, np.float32)
+    cache.put("large", large)
+    assert os.path.isfile(str(tmp_path / "large.npz"))
+    cache = DisparityCache(max_bytes=0, cache_folder=str(tmp_path))
+    np.testing.assert_array_equal(cache.get("large"), large)
+    disp = cache.get(keys[2])
+    assert disp.dtype == np.float32
+    np.testing.assert_array_equal(disp, disps[2])
+
+    # Corrupt file is removed from disk tier
+    with open(str(tmp_path / "key0.png"), "wb") as f:
+        f.write(b"corrupt")
+    assert cache.get(keys[0]) is None
+    stats = cache.stats()
+    assert stats["disk_entries"] == 3
+    assert stats["misses"] == 1
+    assert not os.path.exists(str(tmp_path / "key0.png"))
+
+
+def test_forward_match_cache(tmp_path):
+    """Test forward match re-uses cached results for same parameters"""
+    cache = DisparityCache()
+    i3drsgm = I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path),
+                      cache=cache)
+    try:
+        left, right = _sample_pairs(1)[0]
+        for _ in range(2):
+            valid, disp = i3drsgm.forwardMatch(left, right)
+            assert valid
+            np.testing.assert_array_equal(
+                disp, _standin_disparity(left, right))
+        assert (cache.hits, cache.misses) == (1, 1)
+        # Changing parameters does not use cached result
+        assert i3drsgm.setWindowSize(9)
+        valid, _ = i3drsgm.forwardMatch(left, right)
+        assert valid
+        assert (cache.hits, cache.misses) == (1, 2)
+    finally:
+        i3drsgm.close()
+
+
+def test_stage_metrics(tmp_path):
+    """Test stage timings are recorded to metrics sinks"""
+    histogram = HistogramSink()
+    callback_stages = []
+    metrics.add_sink(histogram)
+    metrics.add_sink(lambda stage, seconds: callback_stages.append(stage))
+    i3drsgm = I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path))
+    try:
+        left, right = _sample_pairs(1)[0]
+        valid, disp = i3drsgm.forwardMatch(left, right)
+        assert valid
+        StereoSupport.depth_from_disp(disp, _sample_Q())
+    finally:
+        i3drsgm.close()
+        metrics.clear_sinks()
+    assert not metrics.enabled
+    stats = histogram.stats()
+    for stage in ["forward_match.imwrite", "forward_match.ipc",
+                  "forward_match.imread", "api_request.FORWARD_MATCH",
+                  "depth_from_disp", "disparity_processor.depth"]:
+        assert stats[stage]["count"] == 1
+        assert stage in callback_stages
+    text = histogram.prometheus_text()
+    assert '# TYPE i3drsgm_stage_seconds histogram' in text
+    assert 'i3drsgm_stage_seconds_count{stage="forward_match.ipc"} 1' in text
+    assert 'i3drsgm_stage_seconds_bucket{stage="depth_from_disp",le="+Inf"} 1' \
+        in text
+
+
+def test_import_time():
+    """Test importing i3drsgm is fast and does not import heavy modules"""
+    # Budget can be changed for slow machines
+    budget_ms = float(os.environ.get("I3DRSGM_IMPORT_BUDGET_MS", 100))
+    elapsed, loaded = import_time("i3drsgm", repeat=3)
+    assert loaded == []
+    assert elapsed * 1000 < budget_ms
+    # imwrite flags defined without OpenCV must match OpenCV values
+    assert IMWRITE_PNG_COMPRESSION == cv2.IMWRITE_PNG_COMPRESSION
+    assert IMWRITE_TIFF_COMPRESSION == cv2.IMWRITE_TIFF_COMPRESSION
+
+
+def test_app_restart(tmp_path):
+    """Test app is restarted with the same parameters if it exits"""
+    with I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path),
+                 warmup_size=(32, 16)) as i3drsgm:
+        api = i3drsgm.i3drsgmAppAPI
+        assert i3drsgm.isInit()
+        assert i3drsgm.setWindowSize(7)
+        left, right = _sample_pairs(1)[0]
+        expected = StandInApp()
+        expected.params[I3DRSGMAppAPI.PARAM_WINDOW_SIZE] = 7
+        # Failed frame is retried after restart
+        api.appProcess.kill()
+        api.appProcess.wait()
+        valid, disp = i3drsgm.forwardMatch(left, right)
+        assert valid
+        assert api.restarts == 1
+        np.testing.assert_array_equal(
+            disp, expected.compute_disparity(left, right))
+        assert api.param_state == {I3DRSGMAppAPI.PARAM_WINDOW_SIZE: 7}
+
+
+def test_app_restart_hung(tmp_path):
+    """Test app that stops responding is restarted"""
+    api = I3DRSGMAppAPI(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path),
+                        request_timeout=0.5, health_interval=0.05)
+    try:
+        # Request is retried once after restart then fails
+        valid, _ = api.apiRequest("SLEEP,30")
+        assert not valid
+        assert api.restarts >= 1
+        # Failed app is restarted in the background
+        for _ in range(200):
+            if api.restarts == 2 and api.isAlive():
+                break
+            time.sleep(0.05)
+        assert api.restarts == 2
+        valid, _ = api.apiRequest(I3DRSGMAppAPI.PARAM_WINDOW_SIZE+",9")
+        assert valid
+    finally:
+        api.close()
+    assert not api.isAlive()
+
+
+def test_app_output_drained(tmp_path):
+    """Test app output is drained and requests time out"""
+    with I3DRSGMAppAPI(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path),
+                       auto_restart=False) as api:
+        # Output larger than pipe buffer does not block the app
+        valid, _ = api.apiRequest("LOG,20000", timeout=30)
+        assert valid
+        # stderr is read by a separate thread so may finish after response
+        for _ in range(100):
+            if api.stderr_lines[-1] == "log line 19999":
+                break
+            time.sleep(0.05)
+        assert api.stderr_lines[-1] == "log line 19999"
+        assert len(api.stderr_lines) == I3DRSGMAppAPI.OUTPUT_BUFFER_LINES
+        valid, response = api.apiRequest("SLEEP,30", timeout=0.2)
+        assert not valid
+        assert "did not respond" in response
+        assert api.last_latency < 5
+        assert not api.isAlive()
+        stats = api.latencyStats()
+        assert stats["LOG"]["count"] == 1
+        assert stats["SLEEP"]["max"] < 5
+
+
+def test_match_tiled_stitching():
+    """Test bands are stitched back into the original rows"""
+    img = np.arange(50 * 8, dtype=np.float32).reshape(50, 8)
+    valid, disp, report = match_tiled(
+        lambda left, right: (True, left.copy()), img, img, 16, 5,
+        measure_memory=True)
+    assert valid
+    np.testing.assert_array_equal(disp, img)
+    assert [band["rows"] for band in report["bands"]] == [
+        (0, 21), (11, 37), (27, 50), (43, 50)]
+    assert all(band["seconds"] >= 0 for band in report["bands"])
+    assert report["peak_memory"] > 0
+    valid, disp, _ = match_tiled(
+        lambda left, right: (left[0, 0] < 100, left), img, img, 16, 5)
+    assert not valid and disp is None
+
+
+def test_forward_match_tiled(tmp_path):
+    """Test tiled matching across pool matches full frame matching"""
+    rng = np.random.RandomState(5)
+    left = cv2.resize(
+        rng.randint(0, 256, (32, 24)).astype(np.uint8), (96, 128))
+    right = np.roll(left, -4, axis=1)
+    expected = _standin_disparity(left, right)
+    with I3DRSGMPool(
+            2, app_cmd=STANDIN_APP_CMD, tmp_root=str(tmp_path)) as pool:
+        assert pool.setDisparityRange(64)
+        valid, disp, report = pool.forwardMatchTiled(
+            left, right, band_rows=32)
+        assert valid
+        assert len(report["bands"]) == 4
+        assert report["band_bytes"] > 0
+    assert disp.shape == expected.shape
+    assert (disp == expected).mean() > 0.95
+
+
+def test_reproject_roi_offset():
+    """Test reprojection of ROI disparity matches full image reprojection"""
+    Q = _sample_Q()
+    disp = _sample_disparity()
+    x, y, width, height = 5, 3, 12, 7
+    roi_disp = disp[y:y + height, x:x + width]
+    expected = StereoSupport.depth_from_disp(disp, Q)[
+        y:y + height, x:x + width]
+    np.testing.assert_allclose(
+        StereoSupport.depth_from_disp(roi_disp, Q, roi_offset=(x, y)),
+        expected, rtol=1e-6)
+    points = StereoSupport.points_from_disp(roi_disp, Q, roi_offset=(x, y))
+    np.testing.assert_allclose(
+        points["x"], expected[:, :, 0][
+            StereoSupport.valid_disparity_mask(roi_disp, Q)], rtol=1e-6)
+
+
+def test_forward_match_roi(tmp_path):
+    """Test ROI matching matches the same region of a full frame match"""
+    rng = np.random.RandomState(6)
+    left = cv2.resize(
+        rng.randint(0, 256, (40, 40)).astype(np.uint8), (160, 160))
+    right = np.roll(left, -4, axis=1)
+    with I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path)) as i3drsgm:
+        assert i3drsgm.setDisparityRange(32)
+        valid, full = i3drsgm.forwardMatch(left, right)
+        assert valid
+        roi = (100, 60, 40, 30)
+        valid, disp, roi_info = i3drsgm.forwardMatch(left, right, roi=roi)
+        assert valid
+        assert roi_info["offset"] == (100, 60)
+        assert roi_info["match_region"] == (68, 28, 72, 94)
+        with pytest.raises(ValueError):
+            i3drsgm.forwardMatch(left, right, roi=(150, 0, 20, 10))
+    assert disp.shape == (30, 40)
+    # Cost aggregation paths are shorter in the ROI match so allow
+    # small sub-pixel differences
+    assert (np.abs(disp - full[60:90, 100:140]) <= 0.5).mean() > 0.9
+
+
+def test_temporal_matcher(tmp_path):
+    """Test unchanged frames and bands are not matched again"""
+    rng = np.random.RandomState(7)
+    left = cv2.resize(
+        rng.randint(0, 256, (32, 24)).astype(np.uint8), (96, 128))
+    right = np.roll(left, -4, axis=1)
+    with I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path)) as i3drsgm:
+        assert i3drsgm.setDisparityRange(32)
+        temporal = TemporalMatcher(
+            i3drsgm, threshold=2.0, max_staleness=2, downsample=4,
+            band_rows=32, overlap=8, full_match_ratio=1.0)
+        valid, first = temporal.forwardMatch(left, right)
+        assert valid
+        # Small noise is below threshold so disparity is re-used
+        noisy = np.clip(left.astype(np.int16) + rng.randint(
+            -1, 2, left.shape), 0, 255).astype(np.uint8)
+        valid, disp = temporal.forwardMatch(noisy, right)
+        assert valid
+        np.testing.assert_array_equal(disp, first)
+        # Only changed band is matched
+        changed_left = left.copy()
+        changed_left[100:] = 255 - changed_left[100:]
+        changed_right = np.roll(changed_left, -4, axis=1)
+        valid, disp = temporal.forwardMatch(changed_left, changed_right)
+        assert valid
+        np.testing.assert_array_equal(disp[:64], first[:64])
+        assert not np.array_equal(disp[96:], first[96:])
+        # Unchanged bands are matched after max_staleness frames
+        valid, _ = temporal.forwardMatch(changed_left, changed_right)
+        assert valid
+    stats = temporal.stats()
+    assert stats["frames"] == 4
+    assert stats["skipped"] == 1
+    assert stats["full_matches"] == 1
+    assert stats["partial_matches"] == 2
+    assert stats["bands_matched"] == 4 + 1 + 3
+
+
+def test_temporal_matcher_uint16(tmp_path):
+    """Test change of 16-bit images above 32767 is measured correctly"""
+    dark = np.zeros((64, 96), np.uint16)
+    bright = np.full((64, 96), 40000, np.uint16)
+    with I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path)) as i3drsgm:
+        assert i3drsgm.setDisparityRange(32)
+        temporal = TemporalMatcher(i3drsgm, threshold=2.0, downsample=4)
+        valid, _ = temporal.forwardMatch(bright, bright)
+        assert valid
+        assert temporal.change(bright + 1, bright + 1) == [1.0]
+        assert temporal.change(dark, dark) == [40000.0]
+        valid, _ = temporal.forwardMatch(bright + 1, bright + 1)
+        assert valid
+        valid, _ = temporal.forwardMatch(dark, dark)
+        assert valid
+    stats = temporal.stats()
+    assert stats["skipped"] == 1
+    assert stats["full_matches"] == 2
+
+
+def test_compact_disparity(tmp_path):
+    """Test compact disparity round trip and use in StereoSupport"""
+    Q = _sample_Q()
+    # Quantise to 1/16 pixel so conversion is lossless
+    disp = np.round(_sample_disparity() * 16) / 16
+    compact = to_compact(disp)
+    assert compact.dtype == np.int16
+    assert compact.nbytes * 2 == disp.nbytes
+    np.testing.assert_array_equal(from_compact(compact), disp)
+    np.testing.assert_allclose(
+        StereoSupport.reprojectImageTo3D(compact, Q),
+        StereoSupport.reprojectImageTo3D(from_compact(compact), Q),
+        rtol=1e-6)
+    np.testing.assert_allclose(
+        StereoSupport.reprojectImageTo3DBatch(compact[np.newaxis], Q)[0],
+        StereoSupport.reprojectImageTo3D(disp, Q), rtol=1e-6)
+    nan_disp = disp.copy()
+    nan_disp[0, 0] = np.nan
+    assert from_compact(to_compact(nan_disp))[0, 0] == -99999
+
+    np.testing.assert_allclose(
+        StereoSupport.depth_from_disp(compact, Q),
+        StereoSupport.depth_from_disp(disp, Q), rtol=1e-6)
+    np.testing.assert_array_equal(
+        StereoSupport.valid_disparity_mask(compact, Q),
+        StereoSupport.valid_disparity_mask(disp, Q))
+    np.testing.assert_allclose(
+        StereoSupport.points_from_disp(compact, Q)["z"],
+        StereoSupport.points_from_disp(disp, Q)["z"], rtol=1e-6)
+
+    filepath = str(tmp_path / "disparity.png")
+    assert write_compact(filepath, disp)
+    np.testing.assert_array_equal(read_compact(filepath), compact)
+    with pytest.raises(ValueError):
+        to_compact(np.full((2, 2), -4096, np.float32))
+    assert (to_compact(np.full((2, 2), -4096, np.float32),
+                       out_of_range="invalid") == -32768).all()
+
+
+def test_forward_match_compact(tmp_path, caplog):
+    """Test forward match returns compact disparity"""
+    left, right = _sample_pairs(1)[0]
+    with I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path),
+                 compact=True) as i3drsgm:
+        assert i3drsgm.setDisparityRange(64)
+        valid, disp = i3drsgm.forwardMatch(left, right)
+    assert valid
+    assert disp.dtype == np.int16
+    np.testing.assert_array_equal(
+        from_compact(disp), _standin_disparity(left, right))
+
+    # Disparity outside the compact range is stored as invalid
+    class LargeDisparityTransport(ImageTransport):
+        @staticmethod
+        def read_disparity(filepath):
+            disp = ImageTransport.read_disparity(filepath)
+            disp[:, :disp.shape[1] // 2] = -3000
+            return disp
+    transport = LargeDisparityTransport("large", ".png")
+    with I3DRSGM(app_cmd=STANDIN_APP_CMD, tmp_folder=str(tmp_path),
+                 compact=True, transport=transport) as i3drsgm:
+        assert i3drsgm.setDisparityRange(64)
+        with caplog.at_level(logging.WARNING, logger="i3drsgm"):
+            valid, disp = i3drsgm.forwardMatch(left, right)
+    assert valid
+    expected = _standin_disparity(left, right)
+    expected[:, :expected.shape[1] // 2] = -99999
+    np.testing.assert_array_equal(from_compact(disp), expected)
+    assert "compact disparity range" in caplog.text
+
+
+def test_depth_from_disp_batch(tmp_path):
+    """Test batch depth matches depth of each frame"""
+    Q = _sample_Q()
+    disps = np.stack([_sample_disparity() * scale for scale in [1, 2, 0.5]])
+    expected = np.stack([StereoSupport.depth_from_disp(d, Q) for d in disps])
+    depth = StereoSupport.depth_from_disp_batch(
+        disps, Q, num_threads=3, chunk_rows=5)
+    assert depth.shape == disps.shape + (3,)
+    np.testing.assert_array_equal(depth, expected)
+
+    # Iterator of frames written to a memory mapped output
+    filepath = str(tmp_path / "depth.npy")
+    out = np.lib.format.open_memmap(
+        filepath, mode="w+", dtype=np.float32, shape=depth.shape)
+    StereoSupport.depth_from_disp_batch(
+        iter(disps), Q, out=out, chunk_rows=7)
+    out.flush()
+    np.testing.assert_array_equal(np.load(filepath), expected)
+
+    reprojected = StereoSupport.reprojectImageTo3DBatch(
+        -disps, Q, chunk_rows=4)
+    for frame, disp in zip(reprojected, disps):
+        np.testing.assert_array_equal(
+            frame, StereoSupport.reprojectImageTo3D(-disp, Q))
+    with pytest.raises(ValueError):
+        StereoSupport.depth_from_disp_batch(disps[0], Q)
+
+
+def test_voxel_downsample():
+    """Test voxel downsampling averages points in each voxel"""
+    points = np.zeros(4, StereoSupport.POINT_DTYPE)
+    points["x"] = [0.1, 0.3, 1.5, -0.5]
+    points["z"] = [1.0, 1.0, 1.0, 5.0]
+    points["red"] = [10, 20, 30, 40]
+    voxels = StereoSupport.voxel_downsample(points, 1.0)
+    assert voxels.shape == (3,)
+    first = voxels[np.isclose(voxels["x"], 0.2)]
+    assert first.shape == (1,)
+    assert first["red"][0] == 15
+    clipped = StereoSupport.clip_points(points, (None, 2.0))
+    assert clipped.shape == (3,)
+
+
+def test_point_cloud_stages():
+    """Test point cloud stages report input and output sizes"""
+    Q = _sample_Q()
+    disp = _sample_disparity()
+    valid = StereoSupport.valid_disparity_mask(disp, Q)
+    points, report = StereoSupport.point_cloud(disp, Q)
+    assert [r["stage"] for r in report] == ["compact"]
+    assert report[0]["input"] == disp.size
+    assert report[0]["output"] == valid.sum() == points.shape[0]
+
+    z = points["z"]
+    depth_range = (np.percentile(z, 10), np.percentile(z, 90))
+    points, report = StereoSupport.point_cloud(
+        disp, Q, depth_range=depth_range, voxel_size=50.0)
+    assert [r["stage"] for r in report] == ["compact", "clip", "voxel"]
+    assert report[1]["input"] == report[0]["output"]
+    assert report[1]["output"] == ((z >= depth_range[0]) &
+                                   (z <= depth_range[1])).sum()
+    assert report[2]["output"] == points.shape[0] < report[2]["input"]
+    assert report[2]["output_bytes"] == points.nbytes
+
+
+def test_colormap_renderer():
+    """Test fixed range colormap matches scaling and applyColorMap"""
+    Q = _sample_Q()
+    disp = np.round(_sample_disparity() * 16) / 16
+    renderer = ColormapRenderer(disparity_range=(50, 150), Q=Q)
+    colormap = renderer.render(disp)
+    assert renderer.render(disp) is colormap
+    np.testing.assert_array_equal(renderer.render(to_compact(disp)), colormap)
+
+    valid = StereoSupport.valid_disparity_mask(disp, Q)
+    gray = np.rint(np.clip((-disp - 50) / 100, 0, 1) * 255).astype(np.uint8)
+    expected = cv2.applyColorMap(gray, cv2.COLORMAP_JET)
+    expected[~valid] = 0
+    np.testing.assert_array_equal(colormap, expected)
+
+    # Largest compact disparity is valid, invalid float disparity is not
+    edge = np.array([[-2047.9375, -99999, np.nan, -np.inf, -4096]],
+                    np.float32)
+    renderer = ColormapRenderer(disparity_range=(0, 2048))
+    colors = renderer.render(edge)
+    assert colors[0, 0].any()
+    assert not colors[0, 1:].any()
+    np.testing.assert_array_equal(
+        renderer.render(np.array([[COMPACT_MAX]], np.int16)),
+        colors[:, :1])
+
+    depth = ColormapRenderer(depth_range=(100, 1000), Q=Q).render(disp)
+    assert depth.shape == disp.shape + (3,)
+    assert not depth[~valid].any()
+    with pytest.raises(ValueError):
+        ColormapRenderer(depth_range=(100, 1000))
+
+
+def _command_line(cmd):
+    """Join command into a string using the platform quoting rules"""
+    if os.name == "nt":
+        return subprocess.list2cmdline(cmd)
+    return " ".join(shlex.quote(arg) for arg in cmd)
+
+
+def test_split_command():
+    """Test app command strings are split back into arguments"""
+    cmd = [sys.executable, os.path.join("a folder", "app.py"), "api"]
+    assert split_command(_command_line(cmd)) == cmd
+
+
+def test_batch_cli(tmp_path):
+    """Test batch command writes outputs and resumes"""
+    image_folder = tmp_path / "images"
+    image_folder.mkdir()
+    rng = np.random.RandomState(7)
+    for i in range(3):
+        left = cv2.resize(
+            rng.randint(0, 256, (12, 16)).astype(np.uint8), (64, 48))
+        cv2.imwrite(str(image_folder / "left_{}.png".format(i)), left)
+        cv2.imwrite(str(image_folder / "right_{}.png".format(i)),
+                    np.roll(left, -2, axis=1))
+    profile = tmp_path / "profile.json"
+    profile.write_text('{"disparity_range": 16, "interpolation": false}')
+    output = tmp_path / "output"
+    args = [
+        "batch",
+        "--left", str(image_folder / "left_*.png"),
+        "--right", str(image_folder / "right_*.png"),
+        "--left-cal", os.path.join(SAMPLE_DATA_FOLDER, "sim_left.yaml"),
+        "--right-cal", os.path.join(SAMPLE_DATA_FOLDER, "sim_right.yaml"),
+        "--profile", str(profile), "--output", str(output),
+        "--outputs", "disparity,compact,depth,colormap,ply",
+        "--app-cmd", _command_line(STANDIN_APP_CMD)]
+    assert main(args) == 0
+    for i in range(3):
+        for suffix in ["_disp.tif", "_disp.png", "_depth.npy",
+                       "_colormap.png", ".ply"]:
+            assert (output / "left_{}{}".format(i, suffix)).exists()
+    disp = cv2.imread(str(output / "left_0_disp.tif"), cv2.IMREAD_UNCHANGED)
+    np.testing.assert_array_equal(
+        read_compact(str(output / "left_0_disp.png")), to_compact(disp))
+    assert np.load(str(output / "left_0_depth.npy")).shape == (48, 64, 3)
+
+    # Resume only processes pairs with missing outputs
+    os.remove(str(output / "left_1.ply"))
+    assert main(args + ["--resume"]) == 0
+    assert (output / "left_1.ply").exists()
+    assert not list(output.glob("*.partial*"))
+
+
+def _release_server(folder, app_version):
+    """Local file based release server with a fake I3DRSGMApp zip"""
+    import zipfile
+    release_folder = folder / "v{}".format(app_version)
+    release_folder.mkdir(parents=True)
+    zip_filepath = release_folder / download.release_filename(app_version)
+    with zipfile.ZipFile(str(zip_filepath), "w") as zip_ref:
+        zip_ref.writestr("i3drsgm_app/I3DRSGMApp.exe", b"app")
+        zip_ref.writestr("i3drsgm_app/I3DRSGM.dll", b"dll")
+    return folder.as_uri(), download.file_sha256(str(zip_filepath))
+
+
+def test_provision_from_cache(tmp_path, monkeypatch):
+    """Test app is provisioned through a verified artifact cache"""
+    server = tmp_path / "server"
+    url, sha256 = _release_server(server, "1.0.0")
+    cache = str(tmp_path / "cache")
+    install = tmp_path / "install"
+    install.mkdir()
+    with pytest.raises(IOError):
+        download.provision("1.0.0", cache, url, sha256="0" * 64,
+                           install_folder=str(install), progress=None)
+    assert not (install / "i3drsgm_app").exists()
+    # Pinned checksum of the version is used
+    monkeypatch.setitem(download.APP_SHA256, "1.0.0", "0" * 64)
+    with pytest.raises(IOError):
+        download.provision("1.0.0", cache, url,
+                           install_folder=str(install), progress=None)
+    monkeypatch.delitem(download.APP_SHA256, "1.0.0")
+    # Release without a known checksum is refused unless allowed
+    monkeypatch.delenv(download.ALLOW_UNVERIFIED_ENV, raising=False)
+    with pytest.raises(IOError):
+        download.provision("1.0.0", cache, url, install_folder=str(install),
+                           progress=None)
+    assert not (install / "i3drsgm_app").exists()
+    unverified = str(tmp_path / "unverified")
+    download.provision("1.0.0", unverified, url, progress=None,
+                       install_folder=str(install), allow_unverified=True)
+    assert os.path.isfile(download.app_path(str(install)))
+    # Unverified release is not trusted by later runs
+    assert os.listdir(unverified) == [download.release_filename("1.0.0")]
+    shutil.rmtree(download.app_folder(str(install)))
+
+    path = download.provision("1.0.0", cache, url, sha256,
+                              install_folder=str(install), progress=None)
+    assert path == download.app_path(str(install))
+    assert os.path.isfile(path)
+    assert os.listdir(str(install)) == ["i3drsgm_app"]
+
+    # Cached release is used without the release server
+    for filepath in server.rglob("*.zip"):
+        filepath.unlink()
+    assert main([
+        "provision", "--app-version", "1.0.0", "--cache", cache,
+        "--url", url, "--install-folder", str(install), "--replace"]) == 0
+    assert os.path.isfile(path)
+    # Corrupt cached release is not used
+    with open(os.path.join(cache, download.release_filename("1.0.0")),
+              "ab") as f:
+        f.write(b"corrupt")
+    assert main([
+        "provision", "--app-version", "1.0.0", "--cache", cache,
+        "--url", url, "--install-folder", str(install), "--replace"]) == 1
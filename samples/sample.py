@@ -3,12 +3,8 @@ Sample: Test I3DRSGM functionality
 """
 import os
 import cv2
-import numpy as np
-import pandas as pd
-from pyntcloud import PyntCloud
-from stereo3d.stereocalibration import StereoCalibration
 import i3drsgm
-from i3drsgm import I3DRSGM, StereoSupport
+from i3drsgm import I3DRSGM, StereoSupport, StereoCalibration
 
 # Get folder containing current script
 script_folder = os.path.dirname(os.path.realpath(__file__))
@@ -18,8 +14,7 @@ resource_folder = os.path.join(
 # Load stereo calibration from yamls
 left_cal_file = os.path.join(resource_folder, "sim_left.yaml")
 right_cal_file = os.path.join(resource_folder, "sim_right.yaml")
-stcal = StereoCalibration()
-stcal.get_cal_from_yaml(left_cal_file, right_cal_file)
+stcal = StereoCalibration(left_cal_file, right_cal_file)
 
 # Initalise I3DRSGM
 print("Intitalising I3DRSGM...")
@@ -32,7 +27,7 @@ if i3drsgm_inst.isInit():
     right_gray_img = cv2.cvtColor(right_img, cv2.COLOR_BGR2GRAY)
 
     # Get Q from calibration
-    Q = stcal.stereo_cal["q"]
+    Q = stcal.Q
 
     # Set matcher parameters
     i3drsgm_inst.setDisparityRange(0)
@@ -66,31 +61,11 @@ if i3drsgm_inst.isInit():
             # Display disparity colormap in OpenCV window
             cv2.imshow("display", disp_colormap_resized)
 
-            # Calculate depth from disparity
-            depth = StereoSupport.reprojectImageTo3D(
-                disp_resize, Q, downsample_rate)
-            
-            # Convert gray image to rgb to use as colors in point cloud
-            image = cv2.cvtColor(left_rect_img, cv2.COLOR_GRAY2RGB)
-            
-            # Convert image to float32 to match depth data type
-            image = np.float32(image)
-            image = image/255
-            
-            # Reshape image and depth to list all points rather be the size of the image
-            image = image.reshape(-1, 3)
-            depth = depth.reshape(-1, 3)
-            
-            # Combine image colors and depth points
-            points = np.hstack((depth, image))
-            
-            # Generate point cloud
-            cloud = PyntCloud(pd.DataFrame(
-                # same arguments that you are passing to visualize_pcl
-                data=points,
-                columns=["x", "y", "z", "red", "green", "blue"]))
-            # Save point cloud to file
-            cloud.to_file(os.path.join(script_folder, "sim.ply"))
+            # Save valid points to point cloud file
+            # colored using the rectified left image
+            StereoSupport.write_ply(
+                os.path.join(script_folder, "sim.ply"),
+                disp_resize, Q, downsample_rate, image=left_rect_img)
 
             print("Press any key on image window to close")
             cv2.waitKey(0)